@@ -1,6 +1,6 @@
 import os
 from waitress import serve
-from core import web_app, job_manager, Config
+from core import web_app, job_manager, ingest_queue, Config
 import signal
 import requests
 
@@ -14,6 +14,9 @@ def handle_sigterm(*args):
     """
     print("Received SIGTERM, gracefully stopping tasks...")
 
+    # Write any points still waiting in the write-behind queue
+    ingest_queue.stop(blocking=True)
+
     # Stop the background job manager
     job_manager.stop(blocking=True)
 
@@ -38,4 +41,4 @@ if __name__ == "__main__":
 
 
 
-    serve(web_app, host="0.0.0.0", port=8500)
\ No newline at end of file
+    serve(web_app, host="0.0.0.0", port=8500, threads=Config.WEB_THREADS)
\ No newline at end of file
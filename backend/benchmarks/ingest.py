@@ -0,0 +1,113 @@
+"""
+Compare ingest throughput of the old per-object ORM path with the bulk insert path
+used by /api/v1/gps/batch and /api/v1/gps/overland.
+
+Runs against the database configured through the usual POSTGRES_* environment variables
+and cleans up after itself. Run from the backend directory:
+
+    python -m benchmarks.ingest --points 10000 --batch 1000
+"""
+import argparse
+import os
+import random
+import time
+import uuid
+from datetime import datetime, timedelta
+
+from core import web_app, job_manager
+from core.extensions import db
+from core.ingest import insert_points, owner_ids, parse_batch_entry
+from core.models import GPSData, User
+
+
+def make_entries(count: int) -> list[dict]:
+    start = datetime(2024, 1, 1)
+    lat, lon = 52.52, 13.40
+    entries = []
+    for i in range(count):
+        lat += random.uniform(-0.0005, 0.0005)
+        lon += random.uniform(-0.0005, 0.0005)
+        entries.append({
+            "timestamp": str(int((start + timedelta(seconds=5 * i)).timestamp())),
+            "latitude": lat,
+            "longitude": lon,
+            "horizontal_accuracy": 10.0,
+            "altitude": 40.0,
+            "vertical_accuracy": 3.0,
+            "heading": -1.0,
+            "heading_accuracy": -1.0,
+            "speed": 1.4,
+            "speed_accuracy": 0.5,
+        })
+    return entries
+
+
+def ingest_orm(entries: list[dict], user: User):
+    """The ingest path as it was before bulk inserts: one GPSData object per point."""
+    for entry in entries:
+        db.session.add(GPSData(
+            user_id=user.id,
+            timestamp=datetime.fromtimestamp(int(entry["timestamp"])),
+            latitude=round(float(entry["latitude"]), 8),
+            longitude=round(float(entry["longitude"]), 8),
+            horizontal_accuracy=round(float(entry["horizontal_accuracy"]), 8),
+            altitude=round(float(entry["altitude"]), 8),
+            vertical_accuracy=round(float(entry["vertical_accuracy"]), 8),
+            heading=round(float(entry["heading"]), 8),
+            heading_accuracy=round(float(entry["heading_accuracy"]), 8),
+            speed=round(float(entry["speed"]), 8),
+            speed_accuracy=round(float(entry["speed_accuracy"]), 8),
+        ))
+    db.session.commit()
+
+
+def ingest_bulk(entries: list[dict], user: User):
+    user_id, trace_id = owner_ids(user, None)
+    insert_points([parse_batch_entry(entry, user_id, trace_id) for entry in entries])
+    db.session.commit()
+
+
+def run(method, entries: list[dict], batch: int, user: User) -> float:
+    start = time.perf_counter()
+    for i in range(0, len(entries), batch):
+        method(entries[i:i + batch], user)
+    elapsed = time.perf_counter() - start
+
+    GPSData.query.filter_by(user_id=user.id).delete(synchronize_session=False)
+    db.session.commit()
+
+    return len(entries) / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--points", type=int, default=10000)
+    parser.add_argument("--batch", type=int, default=1000, help="points per request")
+    args = parser.parse_args()
+
+    entries = make_entries(args.points)
+
+    with web_app.app_context():
+        user = User(email=f"benchmark-{uuid.uuid4().hex}@example.com")
+        user.set_password(uuid.uuid4().hex)
+        db.session.add(user)
+        db.session.commit()
+
+        try:
+            before = run(ingest_orm, entries, args.batch, user)
+            after = run(ingest_bulk, entries, args.batch, user)
+        finally:
+            db.session.delete(user)
+            db.session.commit()
+
+    print(f"points={args.points} batch={args.batch}")
+    print(f"orm:  {before:,.0f} points/s")
+    print(f"bulk: {after:,.0f} points/s ({after / before:.1f}x)")
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    finally:
+        job_manager.stop(blocking=True)
+        os._exit(0)
@@ -0,0 +1,142 @@
+"""
+Compare MapView.post date range queries on a plain and a monthly partitioned gps_data layout.
+
+Both layouts are built as scratch tables (bench_gps_plain, bench_gps_partitioned) from the
+same synthetic trajectories, so the real gps_data table is not touched. The query is the one
+MapView.post runs for a date range without viewport. Results are printed as JSON lines like
+benchmarks.suite. Run from the backend directory:
+
+    python -m benchmarks.partitioning --points 1000000 --repeat 50
+"""
+import argparse
+import json
+import os
+import random
+import time
+import uuid
+from datetime import timedelta
+from itertools import islice
+
+from psycopg2.extras import execute_values
+
+from core import web_app, job_manager
+from core.extensions import db
+from core.partitioning import month_range
+
+from .suite import result
+from .synthetic import TrajectoryGenerator
+
+
+COLUMNS = (
+    "user_id", "trace_id", "timestamp", "latitude", "longitude", "horizontal_accuracy",
+    "altitude", "vertical_accuracy", "heading", "heading_accuracy", "speed", "speed_accuracy",
+)
+
+TABLE_SQL = """
+    CREATE TABLE {table} (
+        id BIGSERIAL,
+        user_id UUID, trace_id UUID, timestamp TIMESTAMP NOT NULL,
+        owner_id UUID GENERATED ALWAYS AS (COALESCE(trace_id, user_id)) STORED,
+        latitude FLOAT NOT NULL, longitude FLOAT NOT NULL,
+        horizontal_accuracy FLOAT, altitude FLOAT, vertical_accuracy FLOAT,
+        heading FLOAT, heading_accuracy FLOAT, speed FLOAT, speed_accuracy FLOAT,
+        PRIMARY KEY (id, timestamp)
+    ) {partitioning}
+"""
+
+# The query of MapView.post for a date range without viewport
+MAP_QUERY = """
+    WITH filtered_data AS (
+        SELECT id, user_id, timestamp, latitude, longitude, horizontal_accuracy,
+            altitude, vertical_accuracy, heading, heading_accuracy, speed, speed_accuracy,
+            ROW_NUMBER() OVER (ORDER BY timestamp) AS row_num,
+            COUNT(*) OVER () AS total
+        FROM {table}
+        WHERE owner_id = '{owner_id}'
+        AND timestamp BETWEEN '{start}' AND '{end} 23:59:59'
+    )
+    SELECT id, user_id, timestamp, latitude, longitude, horizontal_accuracy,
+        altitude, vertical_accuracy, heading, heading_accuracy, speed, speed_accuracy
+    FROM filtered_data
+    WHERE total <= 3000
+    OR row_num % CEIL(total::FLOAT / 3000)::INTEGER = 1
+    ORDER BY timestamp;
+"""
+
+
+def create_tables(cursor, first, last):
+    cursor.execute(TABLE_SQL.format(table="bench_gps_plain", partitioning=""))
+    cursor.execute(TABLE_SQL.format(table="bench_gps_partitioned", partitioning="PARTITION BY RANGE (timestamp)"))
+    for year, month in month_range(first, last):
+        end_year, end_month = (year + 1, 1) if month == 12 else (year, month + 1)
+        cursor.execute(
+            f"CREATE TABLE bench_gps_partitioned_p{year:04d}_{month:02d} PARTITION OF bench_gps_partitioned "
+            f"FOR VALUES FROM ('{year:04d}-{month:02d}-01') TO ('{end_year:04d}-{end_month:02d}-01')"
+        )
+
+    # the owner/point index gps_data has
+    for table in ("bench_gps_plain", "bench_gps_partitioned"):
+        cursor.execute(f"CREATE INDEX ON {table} (owner_id, timestamp, latitude, longitude)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--points", type=int, default=1000000)
+    parser.add_argument("--repeat", type=int, default=50, help="queries per layout")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="append results to this file as JSON lines")
+    args = parser.parse_args()
+
+    owner_id = str(uuid.uuid4())
+    points = list(islice(TrajectoryGenerator(seed=args.seed), args.points))
+    rows = [
+        (owner_id, None, p.timestamp, p.latitude, p.longitude, p.horizontal_accuracy, p.altitude,
+         p.vertical_accuracy, p.heading, -1.0, p.speed, p.speed_accuracy)
+        for p in points
+    ]
+    first, last = points[0].timestamp, points[-1].timestamp
+
+    # date windows MapView asks for: a day, a week, a month
+    rng = random.Random(args.seed)
+    windows = []
+    for _ in range(args.repeat):
+        start = first + timedelta(days=rng.randint(0, max(0, (last - first).days - 31)))
+        windows.append((start.date(), (start + timedelta(days=rng.choice((0, 6, 30)))).date()))
+
+    job_manager.stop(blocking=True)
+    with web_app.app_context():
+        connection = db.session.connection().connection
+        cursor = connection.cursor()
+        try:
+            create_tables(cursor, first, last)
+            for table in ("bench_gps_plain", "bench_gps_partitioned"):
+                execute_values(cursor, f"INSERT INTO {table} ({', '.join(COLUMNS)}) VALUES %s", rows, page_size=5000)
+                cursor.execute(f"ANALYZE {table}")
+            connection.commit()
+
+            for name, table in (("map_data_plain", "bench_gps_plain"), ("map_data_partitioned", "bench_gps_partitioned")):
+                durations = []
+                for start, end in windows:
+                    query_start = time.perf_counter()
+                    cursor.execute(MAP_QUERY.format(table=table, owner_id=owner_id, start=start, end=end))
+                    cursor.fetchall()
+                    durations.append(time.perf_counter() - query_start)
+
+                line = json.dumps(result(name, args.points, durations))
+                print(line, flush=True)
+                if args.output:
+                    with open(args.output, "a") as f:
+                        f.write(line + "\n")
+        finally:
+            connection.rollback()
+            cursor.execute("DROP TABLE IF EXISTS bench_gps_plain, bench_gps_partitioned")
+            connection.commit()
+            cursor.close()
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    finally:
+        job_manager.stop(blocking=True)
+        os._exit(0)
@@ -0,0 +1,251 @@
+"""
+Benchmark the hot paths of WayPointDB against synthetic data.
+
+Creates a temporary user with additional traces, loads synthetic trajectories (see
+benchmarks.synthetic) in steps up to each requested size, and after every step times:
+
+    ingest            bulk insert of the step's points (throughput only)
+    import_job        ImportJob on an import file of --import-points points
+    map_data          MapView.post for random viewports and date ranges
+    map_tile          MapTileView.get for random tiles around the data, uncached
+    heatmap_data      HeatMapDataView.get
+    full_statistics   GenerateFullStatisticsJob for the user
+
+Each result is printed as one JSON object per line (and appended to --output if given) with
+the latency percentiles in milliseconds and the throughput in requests/s or points/s.
+Runs against the database configured through the usual POSTGRES_* environment variables and
+removes everything it created. Run from the backend directory:
+
+    python -m benchmarks.suite --sizes 1000000,10000000,50000000 --output results.jsonl
+"""
+import argparse
+import json
+import math
+import os
+import random
+import statistics
+import tempfile
+import time
+import uuid
+from datetime import datetime, timedelta
+from itertools import islice
+
+from core import web_app, job_manager
+from core.config import Config
+from core.extensions import db
+from core.ingest import INSERT_PAGE_SIZE, insert_points, owner_ids, user_owner_ids
+from core.models import AdditionalTrace, DailyStatistic, GPSData, Import, User
+from core.background.jobs import GenerateFullStatisticsJob, ImportJob
+from core.routes import web
+
+from .synthetic import TrajectoryGenerator, generate
+
+
+def percentile(values: list[float], p: float) -> float:
+    """Nearest-rank percentile."""
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)]
+
+
+def result(name: str, points: int, durations: list[float], work: int = None, unit: str = "requests/s") -> dict:
+    """Summarize ``durations`` (seconds) that together handled ``work`` points, or one request each."""
+    return {
+        "benchmark": name,
+        "points": points,
+        "runs": len(durations),
+        "p50_ms": round(percentile(durations, 50) * 1000, 3),
+        "p99_ms": round(percentile(durations, 99) * 1000, 3),
+        "mean_ms": round(statistics.fmean(durations) * 1000, 3),
+        "throughput": round((len(durations) if work is None else work) / sum(durations), 3),
+        "unit": unit,
+        "version": Config.VERSION,
+        "time": datetime.now().isoformat(timespec="seconds"),
+    }
+
+
+def timed(function, *args, **kwargs) -> float:
+    start = time.perf_counter()
+    function(*args, **kwargs)
+    return time.perf_counter() - start
+
+
+class Benchmark:
+    def __init__(self, args):
+        self.args = args
+        self.random = random.Random(args.seed)
+        self.user: User = None
+        self.traces: list[AdditionalTrace] = []
+        self.generators: list[tuple[TrajectoryGenerator, str, str]] = []
+        self.loaded = 0
+        self.client = web_app.test_client()
+
+    # -----------------------------------------------------------------------
+    #  Setup
+    # -----------------------------------------------------------------------
+    def setup(self):
+        self.user = User(email=f"benchmark-{uuid.uuid4().hex}@example.com")
+        self.user.set_password(uuid.uuid4().hex)
+        db.session.add(self.user)
+        db.session.commit()
+
+        for i in range(self.args.traces):
+            trace = AdditionalTrace(owner_id=self.user.id, name=f"Benchmark {i + 1}", share_with_list=[])
+            db.session.add(trace)
+            self.traces.append(trace)
+        db.session.commit()
+
+        for i, trace in enumerate([None] + self.traces):
+            self.generators.append((TrajectoryGenerator(seed=self.args.seed + i), *owner_ids(self.user, trace)))
+
+        with self.client.session_transaction() as session:
+            session["user_id"] = self.user.id
+
+    def cleanup(self):
+        db.session.rollback()
+        owners = [self.user.id] + [trace.id for trace in self.traces]
+        for model in (GPSData, DailyStatistic, Import):
+            model.query.filter(model.owner_id.in_(owners)).delete(synchronize_session=False)
+        for trace in self.traces:
+            db.session.delete(trace)
+        db.session.delete(self.user)
+        db.session.commit()
+
+    def load(self, size: int) -> dict:
+        """Insert synthetic points, spread evenly over the owners, until ``size`` points are stored."""
+        durations = []
+        start = self.loaded
+        while self.loaded < size:
+            count = min(INSERT_PAGE_SIZE, size - self.loaded)
+            rows = []
+            for i, (generator, user_id, trace_id) in enumerate(self.generators):
+                share = count // len(self.generators) + (1 if i < count % len(self.generators) else 0)
+                rows += [point.to_row(user_id, trace_id) for point in islice(generator, share)]
+
+            durations.append(timed(self.insert, rows))
+            self.loaded += len(rows)
+
+        return result("ingest", size, durations, work=self.loaded - start, unit="points/s")
+
+    @staticmethod
+    def insert(rows):
+        insert_points(rows)
+        db.session.commit()
+
+    # -----------------------------------------------------------------------
+    #  Benchmarks
+    # -----------------------------------------------------------------------
+    def bench_import_job(self, size: int) -> dict:
+        points = generate(self.args.import_points, seed=self.args.seed + 1000, start=datetime(2010, 1, 1))
+        with tempfile.NamedTemporaryFile("w", suffix=".json", dir=Config.UPLOAD_FOLDER, delete=False) as f:
+            json.dump([point.to_entry() for point in points], f)
+
+        try:
+            import_obj = Import(user_id=self.user.id, filename=os.path.basename(f.name), total_entries=len(points))
+            db.session.add(import_obj)
+            db.session.commit()
+
+            duration = timed(ImportJob(self.user, import_obj).run)
+
+            GPSData.query.filter_by(import_id=import_obj.id).delete(synchronize_session=False)
+            db.session.delete(import_obj)
+            db.session.commit()
+        finally:
+            os.remove(f.name)
+
+        return result("import_job", size, [duration], work=len(points), unit="points/s")
+
+    def random_viewport(self) -> dict:
+        generator = self.random.choice(self.generators)[0]
+        lat, lon = self.random.choice([generator.home, generator.work] + generator.places)
+        span = self.random.choice((0.01, 0.05, 0.2, 1.0))
+        end = generator.time - timedelta(days=self.random.randint(0, 30))
+        days = self.random.choice((1, 7, 30, 365))
+        return {
+            "ne_lat": lat + span, "ne_lng": lon + span,
+            "sw_lat": lat - span, "sw_lng": lon - span,
+            "start_date": (end - timedelta(days=days)).strftime("%Y-%m-%d"),
+            "end_date": end.strftime("%Y-%m-%d"),
+        }
+
+    def bench_map_data(self, size: int) -> dict:
+        durations = [
+            timed(self.client.post, "/map", json=self.random_viewport())
+            for _ in range(self.args.repeat)
+        ]
+        return result("map_data", size, durations)
+
+    def random_tile(self) -> tuple[int, int, int]:
+        generator = self.random.choice(self.generators)[0]
+        lat, lon = self.random.choice([generator.home, generator.work] + generator.places)
+        z = self.random.randint(10, 16)
+        n = 2 ** z
+        x = int((lon + 180) / 360 * n)
+        y = int((1 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2 * n)
+        return z, x, y
+
+    def bench_map_tile(self, size: int) -> dict:
+        durations = []
+        for _ in range(self.args.repeat):
+            web.map_tile_data_store.clear()
+            z, x, y = self.random_tile()
+            durations.append(timed(self.client.get, f"/tiles/{z}/{x}/{y}.png"))
+        return result("map_tile", size, durations)
+
+    def bench_heatmap_data(self, size: int) -> dict:
+        durations = [timed(self.client.get, "/map/heatmap_data.csv") for _ in range(max(1, self.args.repeat // 10))]
+        return result("heatmap_data", size, durations)
+
+    def bench_full_statistics(self, size: int) -> dict:
+        # the job covers the user and every trace of theirs
+        points = GPSData.query.filter(GPSData.owner_id.in_(user_owner_ids(self.user))).count()
+        duration = timed(GenerateFullStatisticsJob(self.user).run)
+        return result("full_statistics", size, [duration], work=points, unit="points/s")
+
+    def run(self, size: int):
+        yield self.load(size)
+        for name in self.args.benchmarks:
+            yield getattr(self, f"bench_{name}")(size)
+
+
+BENCHMARKS = ["import_job", "map_data", "map_tile", "heatmap_data", "full_statistics"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="1000000,10000000,50000000", help="comma separated total point counts")
+    parser.add_argument("--traces", type=int, default=2, help="additional traces next to the user's own points")
+    parser.add_argument("--repeat", type=int, default=50, help="requests per latency benchmark")
+    parser.add_argument("--import-points", type=int, default=100000)
+    parser.add_argument("--benchmarks", default=",".join(BENCHMARKS))
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="append results to this file as JSON lines")
+    args = parser.parse_args()
+    args.benchmarks = [name for name in args.benchmarks.split(",") if name]
+    sizes = sorted(int(size) for size in args.sizes.split(","))
+
+    # keep background jobs (e.g. the statistics updater) from skewing the timings
+    job_manager.stop(blocking=True)
+
+    output = open(args.output, "a") if args.output else None
+    with web_app.app_context():
+        benchmark = Benchmark(args)
+        benchmark.setup()
+        try:
+            for size in sizes:
+                for line in benchmark.run(size):
+                    print(json.dumps(line), flush=True)
+                    if output:
+                        output.write(json.dumps(line) + "\n")
+                        output.flush()
+        finally:
+            benchmark.cleanup()
+            if output:
+                output.close()
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    finally:
+        job_manager.stop(blocking=True)
+        os._exit(0)
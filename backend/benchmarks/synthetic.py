@@ -0,0 +1,249 @@
+"""
+Synthetic GPS trajectories for benchmarks.
+
+A trajectory follows a simple simulated life: a home and a workplace with weekday commutes,
+errands on weekends, a few trips to another city per year, and stationary GPS jitter while
+staying at a place. Points are dense while moving and sparse while stationary, like the
+trackers WayPointDB usually receives data from. The same seed always gives the same points.
+
+    gen = TrajectoryGenerator(seed=1)
+    for point in itertools.islice(gen, 1000):
+        ...
+
+Run from the backend directory to write an import file:
+
+    python -m benchmarks.synthetic --points 100000 --output synthetic.json
+"""
+import argparse
+import json
+import math
+import random
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from itertools import islice
+
+
+EARTH_RADIUS = 6371000.0
+
+# Some city centers to place homes and trip destinations in
+CITIES = [
+    (52.5200, 13.4050),  # Berlin
+    (48.1351, 11.5820),  # Munich
+    (53.5511, 9.9937),   # Hamburg
+    (50.1109, 8.6821),   # Frankfurt
+    (48.8566, 2.3522),   # Paris
+    (51.5074, -0.1278),  # London
+    (41.9028, 12.4964),  # Rome
+    (40.4168, -3.7038),  # Madrid
+    (47.3769, 8.5417),   # Zurich
+    (59.3293, 18.0686),  # Stockholm
+]
+
+
+@dataclass
+class Point:
+    timestamp: datetime
+    latitude: float
+    longitude: float
+    horizontal_accuracy: float
+    altitude: float
+    vertical_accuracy: float
+    heading: float
+    speed: float
+    speed_accuracy: float
+
+    def to_entry(self) -> dict:
+        """The point as an entry of the import file format."""
+        return {
+            "timestamp": self.timestamp.isoformat(),
+            "latitude": self.latitude,
+            "longitude": self.longitude,
+            "horizontal_accuracy": self.horizontal_accuracy,
+            "altitude": self.altitude,
+            "vertical_accuracy": self.vertical_accuracy,
+            "heading": self.heading,
+            "heading_accuracy": -1.0,
+            "speed": self.speed,
+            "speed_accuracy": self.speed_accuracy,
+        }
+
+    def to_row(self, user_id, trace_id, import_id=None) -> tuple:
+        """The point as a row tuple for insert_points (see GPS_COLUMNS)."""
+        return (
+            user_id, trace_id, import_id, self.timestamp, self.latitude, self.longitude,
+            self.horizontal_accuracy, self.altitude, self.vertical_accuracy, self.heading,
+            -1.0, self.speed, self.speed_accuracy, False,
+        )
+
+
+def offset(lat: float, lon: float, north_m: float, east_m: float) -> tuple[float, float]:
+    """Move a coordinate by a distance in meters."""
+    dlat = math.degrees(north_m / EARTH_RADIUS)
+    dlon = math.degrees(east_m / (EARTH_RADIUS * math.cos(math.radians(lat))))
+    return lat + dlat, lon + dlon
+
+
+def distance(a: tuple[float, float], b: tuple[float, float]) -> float:
+    """Great circle distance in meters."""
+    lat1, lon1, lat2, lon2 = map(math.radians, (a[0], a[1], b[0], b[1]))
+    h = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS * math.asin(math.sqrt(h))
+
+
+def bearing(a: tuple[float, float], b: tuple[float, float]) -> float:
+    lat1, lon1, lat2, lon2 = map(math.radians, (a[0], a[1], b[0], b[1]))
+    y = math.sin(lon2 - lon1) * math.cos(lat2)
+    x = math.cos(lat1) * math.sin(lat2) - math.sin(lat1) * math.cos(lat2) * math.cos(lon2 - lon1)
+    return (math.degrees(math.atan2(y, x)) + 360) % 360
+
+
+class TrajectoryGenerator:
+    """
+    Endless iterator of Points, starting at ``start``.
+
+    ``moving_interval`` and ``stationary_interval`` are the seconds between points while
+    moving and while staying at a place.
+    """
+
+    def __init__(self, seed: int = 0, start: datetime = datetime(2020, 1, 1), moving_interval: int = 5, stationary_interval: int = 120):
+        self.random = random.Random(seed)
+        self.moving_interval = moving_interval
+        self.stationary_interval = stationary_interval
+
+        self.city = self.random.choice(CITIES)
+        self.home = offset(*self.city, self.random.uniform(-6000, 6000), self.random.uniform(-6000, 6000))
+        self.work = offset(*self.city, self.random.uniform(-4000, 4000), self.random.uniform(-4000, 4000))
+        self.places = [
+            offset(*self.city, self.random.uniform(-10000, 10000), self.random.uniform(-10000, 10000))
+            for _ in range(8)
+        ]
+        self.altitude = self.random.uniform(20, 500)
+
+        self.time = start
+        self.position = self.home
+
+    def __iter__(self):
+        while True:
+            yield from self.day()
+
+    # -----------------------------------------------------------------------
+    #  Segments
+    # -----------------------------------------------------------------------
+    def stay(self, until: datetime):
+        """Stationary jitter at the current position."""
+        while self.time < until:
+            north, east = self.random.gauss(0, 8), self.random.gauss(0, 8)
+            lat, lon = offset(*self.position, north, east)
+            yield Point(
+                self.time, round(lat, 8), round(lon, 8),
+                round(self.random.uniform(5, 35), 2),
+                round(self.altitude + self.random.gauss(0, 3), 2),
+                round(self.random.uniform(3, 10), 2),
+                -1.0, 0.0, -1.0,
+            )
+            self.time += timedelta(seconds=self.stationary_interval + self.random.randint(-10, 10))
+
+    def move(self, target: tuple[float, float], speed: float):
+        """Travel to ``target`` at roughly ``speed`` m/s, via a waypoint so paths are not straight."""
+        via = offset(
+            (self.position[0] + target[0]) / 2, (self.position[1] + target[1]) / 2,
+            self.random.gauss(0, distance(self.position, target) / 8), self.random.gauss(0, distance(self.position, target) / 8),
+        )
+        for leg_target in (via, target):
+            start = self.position
+            length = distance(start, leg_target)
+            course = bearing(start, leg_target)
+            travelled = 0.0
+            while travelled < length:
+                current_speed = max(0.5, speed * self.random.uniform(0.6, 1.3))
+                travelled = min(length, travelled + current_speed * self.moving_interval)
+                fraction = travelled / length
+                lat = start[0] + (leg_target[0] - start[0]) * fraction
+                lon = start[1] + (leg_target[1] - start[1]) * fraction
+                lat, lon = offset(lat, lon, self.random.gauss(0, 4), self.random.gauss(0, 4))
+                self.time += timedelta(seconds=self.moving_interval)
+                yield Point(
+                    self.time, round(lat, 8), round(lon, 8),
+                    round(self.random.uniform(3, 15), 2),
+                    round(self.altitude + self.random.gauss(0, 5), 2),
+                    round(self.random.uniform(2, 8), 2),
+                    round(course, 2), round(current_speed, 2), round(self.random.uniform(0.3, 2), 2),
+                )
+            self.position = leg_target
+
+    def fly(self, target: tuple[float, float]):
+        """Long distance trip: no points during the flight, like a phone in flight mode."""
+        self.time += timedelta(seconds=distance(self.position, target) / 220 + 3 * 3600)
+        self.position = target
+        return iter(())
+
+    # -----------------------------------------------------------------------
+    #  Days
+    # -----------------------------------------------------------------------
+    def at(self, hour: float) -> datetime:
+        day = datetime(self.time.year, self.time.month, self.time.day)
+        return max(self.time, day + timedelta(hours=hour + self.random.gauss(0, 0.3)))
+
+    def next_morning(self) -> datetime:
+        day = datetime(self.time.year, self.time.month, self.time.day) + timedelta(days=1)
+        return day + timedelta(hours=7 + self.random.uniform(0, 1.5))
+
+    def day(self):
+        if self.random.random() < 3 / 365:
+            yield from self.trip()
+            return
+
+        if self.time.weekday() < 5:
+            # weekday: commute to work and back, sometimes an errand on the way home
+            yield from self.stay(self.at(8))
+            yield from self.move(self.work, self.random.choice((4.0, 9.0, 13.0)))
+            yield from self.stay(self.at(17.5))
+            if self.random.random() < 0.3:
+                yield from self.move(self.random.choice(self.places), 8.0)
+                yield from self.stay(self.time + timedelta(minutes=self.random.uniform(10, 60)))
+            yield from self.move(self.home, self.random.choice((4.0, 9.0, 13.0)))
+        else:
+            # weekend: a few errands or a walk
+            for _ in range(self.random.randint(0, 3)):
+                yield from self.stay(self.at(self.random.uniform(9, 18)))
+                yield from self.move(self.random.choice(self.places), self.random.choice((1.4, 4.0, 12.0)))
+                yield from self.stay(self.time + timedelta(minutes=self.random.uniform(20, 120)))
+                yield from self.move(self.home, self.random.choice((1.4, 4.0, 12.0)))
+
+        yield from self.stay(self.next_morning())
+
+    def trip(self):
+        """A few days in another city, exploring by foot and public transport."""
+        destination = self.random.choice([city for city in CITIES if city != self.city])
+        hotel = offset(*destination, self.random.uniform(-2000, 2000), self.random.uniform(-2000, 2000))
+
+        yield from self.fly(hotel)
+        for _ in range(self.random.randint(2, 6)):
+            for _ in range(self.random.randint(2, 5)):
+                sight = offset(*destination, self.random.uniform(-5000, 5000), self.random.uniform(-5000, 5000))
+                yield from self.move(sight, self.random.choice((1.4, 8.0)))
+                yield from self.stay(self.time + timedelta(minutes=self.random.uniform(15, 90)))
+            yield from self.move(hotel, 8.0)
+            yield from self.stay(self.next_morning())
+
+        yield from self.fly(self.home)
+        yield from self.stay(self.next_morning())
+
+
+def generate(count: int, seed: int = 0, **kwargs) -> list[Point]:
+    return list(islice(TrajectoryGenerator(seed, **kwargs), count))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--points", type=int, default=100000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="synthetic.json")
+    args = parser.parse_args()
+
+    with open(args.output, "w") as f:
+        json.dump([point.to_entry() for point in generate(args.points, args.seed)], f)
+
+
+if __name__ == "__main__":
+    main()
@@ -3,12 +3,20 @@ import threading
 from flask import Flask, g, render_template
 from jinja2 import ChoiceLoader, FileSystemLoader
 
+from .archive import archive_cache
+from .places import place_cache
+from .response_cache import response_cache
+from .track_levels import track_level_cache
 from .config import Config
 from .extensions import init_extensions, api_v1
-from .routes.web import web_bp
+from .extensions import db
+from .metrics import init_metrics, state_collector
+from .middleware import DecompressRequestMiddleware
+from .routes.web import vector_tile_cache, web_bp
 from .routes.api import api_gps_ns, api_account_ns
-from .utils import check_db, create_default_user
+from .utils import api_key_cache, check_db, create_default_user
 from .background import job_manager
+from .ingest import ingest_queue
 
 
 def inject_user():
@@ -52,6 +60,9 @@ def create_web_app(config_class = Config):
     # Initialize Extensions (DB, Migrate, RESTx, etc.)
     init_extensions(app)
 
+    # Accept compressed request bodies on the ingest endpoints
+    app.wsgi_app = DecompressRequestMiddleware(app.wsgi_app, "/api/v1/gps/", config_class.INGEST_MAX_DECOMPRESSED_SIZE)
+
     # Register Blueprints
     app.register_blueprint(web_bp, url_prefix="")
     api_v1.add_namespace(api_gps_ns)
@@ -60,18 +71,35 @@ def create_web_app(config_class = Config):
 
     # Create DB tables and default user if needed
     with app.app_context():
+        init_metrics(app, db.engines)
         create_default_user()
         check_db()
 
+    state_collector.ttl_caches["api_key"] = api_key_cache
+    state_collector.ttl_caches["archive"] = archive_cache
+    state_collector.ttl_caches["place"] = place_cache
+    state_collector.ttl_caches["track_level"] = track_level_cache
+    state_collector.ttl_caches["vector_tile"] = vector_tile_cache
+    state_collector.ttl_caches["response"] = response_cache
+
     return app
 
 def create_job_app(config_class = Config, app=None):
     job_manager.set_config(config_class)
     job_manager.set_web_app(app=app)
+    state_collector.job_manager = job_manager
     thread = threading.Thread(target=job_manager.run)
     thread.start()
     return job_manager
 
+def create_ingest_queue(config_class = Config, app=None):
+    ingest_queue.set_config(config_class)
+    ingest_queue.set_web_app(app)
+    if config_class.INGEST_WRITE_BEHIND:
+        ingest_queue.start()
+    return ingest_queue
+
 
 web_app = create_web_app()
-job_manager = create_job_app(app=web_app)
\ No newline at end of file
+job_manager = create_job_app(app=web_app)
+ingest_queue = create_ingest_queue(app=web_app)
\ No newline at end of file
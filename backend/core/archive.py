@@ -0,0 +1,386 @@
+"""
+Cold storage for old GPS data.
+
+ArchiveOldMonthsJob packs every owner-month older than ARCHIVE_AFTER_MONTHS into one
+ArchivedMonth row and deletes its gps_data rows. The blob is columnar and zstd compressed
+(all values little-endian, before compression):
+
+    header          "WPDA", u8 version, u32 count, u32 dictionary length
+    dictionary      JSON object of the distinct values of each string column
+    int64[count]    point id deltas
+    int64[count]    timestamp deltas in microseconds, the first relative to 1970-01-01
+    int64[count]    latitude deltas in degrees * 1e7
+    int64[count]    longitude deltas in degrees * 1e7
+    float32[count]  one column per ARCHIVE_FLOAT_COLUMNS entry, NaN = null
+    uint8[count]    reverse_geocoded
+    uint32[count]   one column per ARCHIVE_STRING_COLUMNS entry, index into its dictionary + 1, 0 = null
+
+Read paths get archived points through ``archived_points`` and merge them with the live rows.
+Edits and deletes only work on gps_data, so ``restore_archived`` moves months back first.
+
+Archiving deletes gps_data rows per owner-month, since a partition (GPS_DATA_PARTITIONING)
+holds the month of every owner. Once all of them are archived, the empty partition is dropped.
+"""
+from array import array
+from collections import namedtuple
+from datetime import date, datetime, timedelta
+from heapq import merge
+from itertools import accumulate
+import json
+import math
+import struct
+import sys
+import uuid
+
+from psycopg2.extras import execute_values
+from sqlalchemy import any_, bindparam, func, or_, text
+from sqlalchemy.orm import defer
+import zstandard
+
+from .cache import SizedLRUCache
+from .config import Config
+from .database import raw_cursor
+from .extensions import db
+from .ingest import BINARY_COORD_SCALE, BINARY_OPTIONAL_COLUMNS, _read_column
+from .models import ArchivedMonth, GPSData, stored_rows
+from .partitioning import ensure_partitions
+from .places import PLACE_FIELDS, place_ids
+
+
+ARCHIVE_MAGIC = b"WPDA"
+ARCHIVE_VERSION = 1
+ARCHIVE_HEADER = struct.Struct("<4sBII")
+ARCHIVE_FLOAT_COLUMNS = BINARY_OPTIONAL_COLUMNS
+ARCHIVE_STRING_COLUMNS = (*PLACE_FIELDS, "import_id")
+ARCHIVE_COMPRESSION_LEVEL = 10
+
+EPOCH = datetime(1970, 1, 1)
+MICROSECOND = timedelta(microseconds=1)
+
+# Has the attributes of GPSData that read paths use, so both can be mixed
+ArchivedPoint = namedtuple("ArchivedPoint", (
+    "id", "user_id", "trace_id", "timestamp", "latitude", "longitude",
+    *ARCHIVE_FLOAT_COLUMNS, "reverse_geocoded", *ARCHIVE_STRING_COLUMNS,
+))
+
+# rough memory of one decoded ArchivedPoint: the tuple, its datetime, ints and floats
+ARCHIVED_POINT_BYTES = 500
+
+# archive id -> decoded points. Archives are never changed in place, merging creates a new row
+archive_cache = SizedLRUCache(maxbytes=Config.ARCHIVE_CACHE_MB * 1024 * 1024, size=lambda points: len(points) * ARCHIVED_POINT_BYTES)
+
+
+def _column_bytes(column: array) -> bytes:
+    if sys.byteorder != "little":
+        column = array(column.typecode, column)
+        column.byteswap()
+    return column.tobytes()
+
+
+def _deltas(values: list[int]) -> array:
+    return array("q", [b - a for a, b in zip([0] + values, values)])
+
+
+def encode_points(points) -> bytes:
+    """Pack points (GPSData or ArchivedPoint, sorted by timestamp) into an archive blob."""
+    count = len(points)
+    dictionaries = {name: [] for name in ARCHIVE_STRING_COLUMNS}
+    indexes = {name: {} for name in ARCHIVE_STRING_COLUMNS}
+    string_columns = {name: array("I") for name in ARCHIVE_STRING_COLUMNS}
+
+    for point in points:
+        for name in ARCHIVE_STRING_COLUMNS:
+            value = getattr(point, name)
+            if value is None:
+                string_columns[name].append(0)
+                continue
+
+            value = str(value)
+            if value not in indexes[name]:
+                indexes[name][value] = len(dictionaries[name]) + 1
+                dictionaries[name].append(value)
+            string_columns[name].append(indexes[name][value])
+
+    dictionary = json.dumps(dictionaries, separators=(",", ":")).encode()
+
+    payload = bytearray(ARCHIVE_HEADER.pack(ARCHIVE_MAGIC, ARCHIVE_VERSION, count, len(dictionary)))
+    payload += dictionary
+    payload += _column_bytes(_deltas([point.id for point in points]))
+    payload += _column_bytes(_deltas([(point.timestamp - EPOCH) // MICROSECOND for point in points]))
+    payload += _column_bytes(_deltas([round(point.latitude * BINARY_COORD_SCALE) for point in points]))
+    payload += _column_bytes(_deltas([round(point.longitude * BINARY_COORD_SCALE) for point in points]))
+    for name in ARCHIVE_FLOAT_COLUMNS:
+        values = (getattr(point, name) for point in points)
+        payload += _column_bytes(array("f", (math.nan if value is None else value for value in values)))
+    payload += _column_bytes(array("B", (bool(point.reverse_geocoded) for point in points)))
+    for name in ARCHIVE_STRING_COLUMNS:
+        payload += _column_bytes(string_columns[name])
+
+    return zstandard.ZstdCompressor(level=ARCHIVE_COMPRESSION_LEVEL).compress(bytes(payload))
+
+
+def decode_points(data: bytes, user_id=None, trace_id=None) -> list[ArchivedPoint]:
+    """Unpack an archive blob into ArchivedPoints sorted by timestamp. Broken blobs raise ValueError."""
+    try:
+        data = zstandard.ZstdDecompressor().decompress(data)
+    except zstandard.ZstdError as e:
+        raise ValueError(f"Broken archive: {e}")
+    if len(data) < ARCHIVE_HEADER.size:
+        raise ValueError("Archive is shorter than its header")
+
+    magic, version, count, dictionary_length = ARCHIVE_HEADER.unpack_from(data)
+    if magic != ARCHIVE_MAGIC or version != ARCHIVE_VERSION:
+        raise ValueError("Unknown archive format")
+
+    offset = ARCHIVE_HEADER.size
+    if offset + dictionary_length > len(data):
+        raise ValueError("Data ends inside the archive dictionary")
+    dictionaries = json.loads(data[offset:offset + dictionary_length])
+    offset += dictionary_length
+
+    integer_columns = []
+    for _ in range(4):
+        column, offset = _read_column(data, offset, "q", count)
+        integer_columns.append(accumulate(column))
+    ids, timestamps, lats, lons = integer_columns
+
+    float_columns = []
+    for _ in ARCHIVE_FLOAT_COLUMNS:
+        column, offset = _read_column(data, offset, "f", count)
+        float_columns.append([None if math.isnan(v) else round(v, 4) for v in column])  # float32 precision
+
+    reverse_geocoded, offset = _read_column(data, offset, "B", count)
+
+    string_columns = []
+    for name in ARCHIVE_STRING_COLUMNS:
+        column, offset = _read_column(data, offset, "I", count)
+        values = [None] + dictionaries[name]
+        string_columns.append([values[i] for i in column])
+
+    return [
+        ArchivedPoint(
+            point_id, user_id, trace_id, EPOCH + timedelta(microseconds=ts),
+            lat / BINARY_COORD_SCALE, lon / BINARY_COORD_SCALE,
+            *rest[:len(ARCHIVE_FLOAT_COLUMNS)],
+            bool(rest[len(ARCHIVE_FLOAT_COLUMNS)]),
+            *rest[len(ARCHIVE_FLOAT_COLUMNS) + 1:],
+        )
+        for point_id, ts, lat, lon, *rest in zip(ids, timestamps, lats, lons, *float_columns, reverse_geocoded, *string_columns)
+    ]
+
+
+def _decoded(archive: ArchivedMonth) -> list[ArchivedPoint]:
+    points = archive_cache.get(archive.id)
+    if points is None:
+        points = decode_points(archive.data, archive.user_id, archive.trace_id)
+        archive_cache.set(archive.id, points)
+    return points
+
+
+def _archives(query_kwargs: dict, start: datetime = None, end: datetime = None, bbox: tuple = None):
+    query = ArchivedMonth.query.filter_by(**query_kwargs).options(defer(ArchivedMonth.data))
+    if start is not None:
+        query = query.filter(ArchivedMonth.last_timestamp >= start)
+    if end is not None:
+        query = query.filter(ArchivedMonth.first_timestamp <= end)
+    if bbox is not None:
+        south, west, north, east = bbox
+        query = query.filter(
+            ArchivedMonth.max_latitude >= south, ArchivedMonth.min_latitude <= north,
+            ArchivedMonth.max_longitude >= west, ArchivedMonth.min_longitude <= east,
+        )
+    return query.order_by(ArchivedMonth.month).all()
+
+
+def archived_points(query_kwargs: dict, start: datetime = None, end: datetime = None, bbox: tuple = None) -> list[ArchivedPoint]:
+    """
+    Archived points of an owner (``query_kwargs`` like g.trace_query), sorted by timestamp,
+    optionally limited to ``start <= timestamp <= end`` and a (south, west, north, east) box.
+    """
+    points = []
+    for archive in _archives(query_kwargs, start, end, bbox):
+        for point in _decoded(archive):
+            if start is not None and point.timestamp < start:
+                continue
+            if end is not None and point.timestamp > end:
+                continue
+            if bbox is not None and not (bbox[0] <= point.latitude <= bbox[2] and bbox[1] <= point.longitude <= bbox[3]):
+                continue
+            points.append(point)
+    return points
+
+
+def _archived_sum(column, query_kwargs: dict, year: int = None) -> int:
+    query = db.session.query(func.coalesce(func.sum(column), 0)).filter_by(**query_kwargs)
+    if year is not None:
+        query = query.filter(ArchivedMonth.month >= date(year, 1, 1), ArchivedMonth.month < date(year + 1, 1, 1))
+    return query.scalar()
+
+
+def archived_point_count(query_kwargs: dict, year: int = None) -> int:
+    """Number of archived points of an owner, optionally of one year."""
+    return _archived_sum(ArchivedMonth.point_count, query_kwargs, year)
+
+
+def archived_geocoded_counts(query_kwargs: dict) -> tuple[int, int]:
+    """Archived points of an owner that were reverse geocoded, and those of them without a country."""
+    return _archived_sum(ArchivedMonth.geocoded_count, query_kwargs), _archived_sum(ArchivedMonth.unplaced_count, query_kwargs)
+
+
+def with_archived(points: list, query_kwargs: dict, start: datetime = None, end: datetime = None, bbox: tuple = None) -> list:
+    """Merge live points (sorted by timestamp) with the matching archived points."""
+    archived = archived_points(query_kwargs, start, end, bbox)
+    if not archived:
+        return points
+    return list(merge(points, archived, key=lambda point: point.timestamp))
+
+
+def month_bounds(month: date) -> tuple[datetime, datetime]:
+    start = datetime(month.year, month.month, 1)
+    return start, datetime(start.year + start.month // 12, start.month % 12 + 1, 1)
+
+
+def archive_month(query_kwargs: dict, month: date) -> int:
+    """
+    Move the gps_data rows of one owner-month into its ArchivedMonth, merging them with
+    an existing archive of that month. The caller commits. Returns the number of rows moved.
+    """
+    start, end = month_bounds(month)
+    live = (
+        GPSData.query.filter_by(**query_kwargs)
+        .filter(GPSData.timestamp >= start, GPSData.timestamp < end)
+        .order_by(GPSData.timestamp)
+        .all()
+    )
+    if not live:
+        return 0
+
+    points = live
+    existing = ArchivedMonth.query.filter_by(**query_kwargs, month=start.date()).first()
+    if existing:
+        # points uploaded again after archiving are only unique within gps_data, drop them here
+        seen = set()
+        points = []
+        for point in merge(_decoded(existing), live, key=lambda point: point.timestamp):
+            # archived coordinates come back quantized, compare both at the resolution of the archive
+            key = (point.timestamp, round(point.latitude * BINARY_COORD_SCALE), round(point.longitude * BINARY_COORD_SCALE))
+            if key not in seen:
+                seen.add(key)
+                points.append(point)
+        archive_cache.pop(existing.id)
+        db.session.delete(existing)
+        db.session.flush()
+
+    db.session.add(ArchivedMonth(
+        user_id=live[0].user_id,
+        trace_id=live[0].trace_id,
+        month=start.date(),
+        point_count=len(points),
+        first_timestamp=points[0].timestamp,
+        last_timestamp=points[-1].timestamp,
+        min_latitude=min(point.latitude for point in points),
+        max_latitude=max(point.latitude for point in points),
+        min_longitude=min(point.longitude for point in points),
+        max_longitude=max(point.longitude for point in points),
+        min_id=min(point.id for point in points),
+        max_id=max(point.id for point in points),
+        import_ids=sorted({uuid.UUID(str(point.import_id)) for point in points if point.import_id}),
+        geocoded_count=sum(1 for point in points if point.reverse_geocoded),
+        unplaced_count=sum(1 for point in points if point.reverse_geocoded and point.country is None),
+        data=encode_points(points),
+    ))
+
+    db.session.execute(text("DELETE FROM gps_data WHERE id = ANY(:ids)"), {"ids": [point.id for point in live]})
+    return len(live)
+
+
+# ArchivedPoint fields are named like their gps_data columns, except for the place which
+# archives keep as strings so they do not depend on the place table
+RESTORE_COLUMNS = tuple(name for name in ArchivedPoint._fields if name not in PLACE_FIELDS) + ("place_id",)
+
+
+def _restore_rows(points: list[ArchivedPoint]) -> list[tuple]:
+    places = place_ids([tuple(getattr(point, name) for name in PLACE_FIELDS) for point in points])
+    rows = []
+    for point, place_id in zip(points, places):
+        point = point._replace(
+            user_id=str(point.user_id) if point.user_id else None,
+            trace_id=str(point.trace_id) if point.trace_id else None,
+        )
+        rows.append(tuple(getattr(point, name) for name in RESTORE_COLUMNS[:-1]) + (place_id,))
+    return rows
+
+
+def restore_archived(query_kwargs: dict, ids: list[int] = None, import_id=None) -> int:
+    """
+    Move archived months of an owner back into gps_data, with their original ids, so they can
+    be edited or deleted. Only months containing one of ``ids`` or points of ``import_id`` are
+    restored. The next archive run packs them again. The caller commits.
+    """
+    ids = set(ids or [])
+    import_id = str(import_id) if import_id else None
+
+    # candidates by id range and import ids, only those are decoded
+    conditions = []
+    if ids:
+        conditions.append(text(
+            "EXISTS (SELECT 1 FROM unnest(:ids) AS point_id "
+            "WHERE point_id BETWEEN archived_month.min_id AND archived_month.max_id)"
+        ).bindparams(bindparam("ids", sorted(ids))))
+    if import_id:
+        conditions.append(any_(ArchivedMonth.import_ids) == uuid.UUID(import_id))
+    if not conditions:
+        return 0
+
+    archives = (
+        ArchivedMonth.query.filter_by(**query_kwargs).filter(or_(*conditions))
+        .options(defer(ArchivedMonth.data)).order_by(ArchivedMonth.month).all()
+    )
+
+    restored = 0
+    cursor = raw_cursor()
+    try:
+        for archive in archives:
+            points = _decoded(archive)
+            # import ids are exact, but the id ranges of months can overlap
+            matches_import = import_id is not None and uuid.UUID(import_id) in archive.import_ids
+            if not matches_import and not any(point.id in ids for point in points):
+                continue
+
+            if Config.GPS_DATA_PARTITIONING:
+                ensure_partitions({archive.first_timestamp, archive.last_timestamp})
+
+            columns, rows = stored_rows(RESTORE_COLUMNS, _restore_rows(points))
+            execute_values(
+                cursor,
+                f"INSERT INTO gps_data ({', '.join(columns)}) VALUES %s ON CONFLICT DO NOTHING",
+                rows,
+                page_size=5000,
+            )
+            archive_cache.pop(archive.id)
+            db.session.delete(archive)
+            restored += len(points)
+    finally:
+        cursor.close()
+
+    return restored
+
+
+def archive_cutoff() -> datetime:
+    """Start of the first month that is not archived yet, see ARCHIVE_AFTER_MONTHS."""
+    today = date.today()
+    months = today.year * 12 + today.month - 1 - Config.ARCHIVE_AFTER_MONTHS
+    return datetime(months // 12, months % 12 + 1, 1)
+
+
+def months_to_archive(query_kwargs: dict) -> list[date]:
+    """Months of an owner with live points that are older than ARCHIVE_AFTER_MONTHS."""
+    cutoff = archive_cutoff()
+
+    month = func.date_trunc("month", GPSData.timestamp)
+    return [
+        value.date()
+        for (value,) in db.session.query(month).select_from(GPSData)
+        .filter_by(**query_kwargs).filter(GPSData.timestamp < cutoff)
+        .distinct().order_by(month)
+    ]
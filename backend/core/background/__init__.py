@@ -4,9 +4,14 @@ import traceback
 
 from flask import Flask
 
-from ..models import User
+from ..metrics import JOB_ROWS, JOB_SECONDS
+from ..ingest import user_owner_ids
+from ..extensions import db
+from ..models import DailyStatisticDirty, User
+from ..partitioning import create_upcoming_partitions
+from ..track_levels import levels_complete
 from ..config import Config
-from .jobs import ConcurrencyLimitType, GenerateFullStatisticsJob, Job, PhotonFillJob
+from .jobs import ArchiveOldMonthsJob, BuildTrackLevelsJob, ConcurrencyLimitType, Job, PhotonFillJob, UpdateDailyStatisticsJob
 
 
 
@@ -51,11 +56,21 @@ class JobManager:
 
         job.done = True
 
-        print(f"Job {job.__class__.__name__} finished in {time.time() - job.start_time:.3f} seconds.")
+        elapsed = time.time() - job.start_time
+        JOB_SECONDS.labels(job=job.__class__.__name__).observe(elapsed)
+        JOB_ROWS.labels(job=job.__class__.__name__).inc(job.rows_processed)
+
+        print(f"Job {job.__class__.__name__} finished in {elapsed:.3f} seconds.")
 
     def run(self):
         last_day = time.localtime().tm_mday
+        last_statistics_check = 0
         self.running = True
+        try:
+            self.check_partitions()
+        except Exception:
+            print(traceback.format_exc())
+
         while True:
             if self.stop_requested:
                 break
@@ -64,11 +79,15 @@ class JobManager:
                 if len(self.threads) < self.config.BACKGROUND_MAX_THREADS:
                     running_global_types = [job.concurrency_limit_type for job in self.running_jobs if job.user is None]
                     running_user_types = [str(job.user.email)+str(job.concurrency_limit_type) for job in self.running_jobs if job.user is not None]
+                    running_types = [job.concurrency_limit_type for job in self.running_jobs]
 
 
                     for job in self.queued_jobs:
                         if job.concurrency_limit_type in running_global_types or (job.user is not None and str(job.user.email)+str(job.concurrency_limit_type) in running_user_types):
                             continue
+                        # a global job with a type also waits for the users' jobs of that type
+                        if job.user is None and job.concurrency_limit_type is not None and job.concurrency_limit_type in running_types:
+                            continue
 
                         job.running = True
                         job.start_time = time.time()
@@ -76,6 +95,11 @@ class JobManager:
                         job.thread.start()
                         self.threads.append(job.thread)
                         self.running_jobs.append(job)
+                        running_types.append(job.concurrency_limit_type)
+                        if job.user is None:
+                            running_global_types.append(job.concurrency_limit_type)
+                        else:
+                            running_user_types.append(str(job.user.email)+str(job.concurrency_limit_type))
 
                     self.queued_jobs = [job for job in self.queued_jobs if job not in self.running_jobs]
 
@@ -113,9 +137,14 @@ class JobManager:
 
 
                 if time.localtime().tm_mday != last_day:
+                    self.check_partitions()
                     self.check_for_daily_jobs()
                     last_day = time.localtime().tm_mday
 
+                if time.time() - last_statistics_check > self.config.STATISTICS_UPDATE_INTERVAL:
+                    self.check_for_dirty_statistics()
+                    last_statistics_check = time.time()
+
             except Exception:
                 print(traceback.format_exc())
 
@@ -123,6 +152,15 @@ class JobManager:
 
         self.running = False
 
+    def check_partitions(self):
+        """Create next month's gps_data partition before the first point of it arrives."""
+        if not self.config.GPS_DATA_PARTITIONING:
+            return
+
+        with self.web_app.app_context():
+            create_upcoming_partitions()
+            db.session.commit()
+
     def check_for_daily_jobs(self):
         with self.web_app.app_context():
             for user in User.query.all():
@@ -130,8 +168,23 @@ class JobManager:
                     if PhotonFillJob.__name__ not in [job.__class__.__name__ for job in self.queued_jobs + self.running_jobs]:
                         self.add_job(PhotonFillJob(user))
 
-                if GenerateFullStatisticsJob.__name__ not in [job.__class__.__name__ for job in self.queued_jobs + self.running_jobs]:
-                    self.add_job(GenerateFullStatisticsJob(user))
+                if self.config.ARCHIVE_AFTER_MONTHS > 0:
+                    if (ArchiveOldMonthsJob.__name__, user.id) not in [(job.__class__.__name__, job.user and job.user.id) for job in self.queued_jobs + self.running_jobs]:
+                        self.add_job(ArchiveOldMonthsJob(user))
+
+                # the map levels of existing data are built once per zoom setting, afterwards the statistics update keeps them current
+                if self.config.TRACK_LEVEL_ZOOMS and not all(levels_complete(owner_id) for owner_id in user_owner_ids(user)):
+                    if (BuildTrackLevelsJob.__name__, user.id) not in [(job.__class__.__name__, job.user and job.user.id) for job in self.queued_jobs + self.running_jobs]:
+                        self.add_job(BuildTrackLevelsJob(user))
+
+    def check_for_dirty_statistics(self):
+        """Queue an update of the daily statistics if any of their days were marked dirty."""
+        if UpdateDailyStatisticsJob.__name__ in [job.__class__.__name__ for job in self.queued_jobs + self.running_jobs]:
+            return
+
+        with self.web_app.app_context():
+            if DailyStatisticDirty.query.first():
+                self.add_job(UpdateDailyStatisticsJob())
 
             
 
@@ -1,17 +1,27 @@
-from datetime import datetime
-import json
+from collections import defaultdict
+from datetime import date, datetime, time as dt_time, timedelta
+import os
 from threading import Thread
 import traceback
 from typing import Optional
 import uuid
 from flask import Flask
+import ijson
 import requests
 import time
 import geopy.distance
+from sqlalchemy import func, text, tuple_
 
-from ..models import AdditionalTrace, DailyStatistic, GPSData, Import, User
+from ..models import AdditionalTrace, DailyStatistic, GPSData, Import, Place, User
 from . import Config
+from ..archive import archive_cutoff, archive_month, archived_points, month_bounds, months_to_archive, with_archived
 from ..extensions import db
+from ..importers import detect_import_format, iter_import_rows
+from ..partitioning import drop_empty_partitions
+from ..places import photon_place, place_ids
+from ..response_cache import data_changed
+from ..ingest import InvalidPointError, derive_speeds, insert_points, mark_days_dirty, owner_ids, user_owner_ids
+from ..track_levels import mark_levels_complete, owner_months, rebuild_days
 
 
 
@@ -34,6 +44,7 @@ class Job:
         self.thread: Thread = None
         self.start_time = None
         self.progress = 0 # 0-1
+        self.rows_processed = 0
         self.running = False
         self.done = False
         self.stop_requested = False
@@ -91,6 +102,30 @@ class QueryPhotonJob(Job):
 
         return (point.id, data)
 
+    def write_results(self, buffer: list[tuple[str, dict]]):
+        """Store the buffered Photon responses as place ids on their points and clear the buffer."""
+        results = [(point_id, data) for point_id, data in buffer if data and "features" in data]
+        buffer.clear()
+
+        places = place_ids([photon_place(data["features"][0]["properties"]) if data["features"] else None for _, data in results])
+
+        dirty_days = set()
+        owners = set()
+        for (point_id, data), place_id in zip(results, places):
+            point = GPSData.query.get(point_id)
+            if not point:
+                continue
+
+            point.reverse_geocoded = True
+            owners.add(point.owner_id)
+            if data["features"]:
+                point.place_id = place_id
+                dirty_days.add((point.user_id, point.trace_id, point.timestamp.date()))
+
+        mark_days_dirty(dirty_days)
+        data_changed(owners)
+        db.session.commit()
+
     def run(self):
         buffer_dump_interval = 100
 
@@ -107,6 +142,7 @@ class QueryPhotonJob(Job):
             point: GPSData = GPSData.query.get(point_id)
             if not point:
                 continue
+            self.rows_processed += 1
 
             try:
                 buffer.append(self.do_with_point(point))
@@ -115,24 +151,9 @@ class QueryPhotonJob(Job):
                 continue
 
             if len(buffer) >= buffer_dump_interval:
-                while buffer:
-                    point_id, data = buffer.pop(0)
-                    if data and "features" in data:
-                        point = GPSData.query.get(point_id)
-                        if len(data["features"]) == 0:
-                            point.reverse_geocoded = True
-                            continue
-
-                        feature: dict[str, dict] = data["features"][0]
-                        point.reverse_geocoded = True
-                        point.country = feature["properties"].get("country")
-                        point.city = feature["properties"].get("city")
-                        point.state = feature["properties"].get("state")
-                        point.postal_code = feature["properties"].get("postcode")
-                        point.street = feature["properties"].get("street")
-                        point.street_number = feature["properties"].get("housenumber")
-                        
-                db.session.commit()
+                self.write_results(buffer)
+
+        self.write_results(buffer)
 
         self.done = True
 
@@ -148,10 +169,7 @@ class PhotonFullJob(QueryPhotonJob):
         self.user = user
 
     def run(self):
-        points = GPSData.query.filter_by(user_id=self.user.id).all()
-
-        additional_traces = AdditionalTrace.query.filter_by(owner_id=self.user.id).all()
-        points += [point for trace in additional_traces for point in GPSData.query.filter_by(trace_id=trace.id).all()]
+        points = GPSData.query.filter(GPSData.owner_id.in_(user_owner_ids(self.user))).all()
 
         point_ids = [point.id for point in points]
         self.point_ids = point_ids
@@ -167,10 +185,7 @@ class PhotonFillJob(QueryPhotonJob):
         self.user = user
 
     def run(self):
-        points = GPSData.query.filter_by(user_id=self.user.id, reverse_geocoded=False).all()
-
-        additional_traces = AdditionalTrace.query.filter_by(owner_id=self.user.id).all()
-        points += [point for trace in additional_traces for point in GPSData.query.filter_by(trace_id=trace.id, reverse_geocoded=False).all()]
+        points = GPSData.query.filter(GPSData.owner_id.in_(user_owner_ids(self.user))).filter_by(reverse_geocoded=False).all()
 
         point_ids = [point.id for point in points]
         self.point_ids = point_ids
@@ -189,10 +204,12 @@ class ResetPointsWithNoGeocodingJob(Job):
         self.user = user
 
     def run(self):
-        points: list[GPSData] = GPSData.query.filter_by(user_id=self.user.id, reverse_geocoded=True, country=None).all()
-
-        additional_traces = AdditionalTrace.query.filter_by(owner_id=self.user.id).all()
-        points += [point for trace in additional_traces for point in GPSData.query.filter_by(trace_id=trace.id, reverse_geocoded=True, country=None).all()]
+        points: list[GPSData] = (
+            GPSData.query.filter(GPSData.owner_id.in_(user_owner_ids(self.user)))
+            .filter_by(reverse_geocoded=True)
+            .outerjoin(Place, GPSData.place_id == Place.id).filter(Place.country == None)
+            .all()
+        )
 
         i = 0
         total_count = len(points)
@@ -208,6 +225,7 @@ class ResetPointsWithNoGeocodingJob(Job):
             if i % 1000 == 0:
                 db.session.commit()
 
+        data_changed(user_owner_ids(self.user))
         db.session.commit()
 
         self.done = True
@@ -216,6 +234,10 @@ class ResetPointsWithNoGeocodingJob(Job):
 
 
 class GenerateSpeedDataJob(Job):
+    """
+    Backfill speed for points that have none. New points get their speed at ingest time,
+    so this only matters for data written before that, and runs month by month in SQL.
+    """
     PARAMETERS = {
         "user": User
     }
@@ -224,53 +246,34 @@ class GenerateSpeedDataJob(Job):
         super().__init__()
         self.user = user
 
-    def generate_speed(self, points: list[GPSData], points_done=0, total_points=1):
+    @staticmethod
+    def month_ranges(first: datetime, last: datetime):
+        start = datetime(first.year, first.month, 1)
+        while start <= last:
+            end = datetime(start.year + start.month // 12, start.month % 12 + 1, 1)
+            yield start, min(end - timedelta(microseconds=1), last)
+            start = end
+
+    def run(self):
+        ranges = []
+        owner_ranges = (
+            db.session.query(GPSData.owner_id, func.min(GPSData.timestamp), func.max(GPSData.timestamp))
+            .filter(GPSData.owner_id.in_(user_owner_ids(self.user)))
+            .group_by(GPSData.owner_id)
+        )
+        for owner_id, first, last in owner_ranges:
+            ranges += [(owner_id, start, end) for start, end in self.month_ranges(first, last)]
 
         i = 0
-        added = 1
-        for data in points:
+        for owner_id, start, end in ranges:
             if self.stop_requested:
                 break
 
-            if data.speed is not None and data.speed > 0:
-                i += 1
-                self.progress = ((points_done + i) / total_points)
-                continue
-
-            if i > 0:
-                prev = points[i - 1]
-                distance = geopy.distance.distance((prev.latitude, prev.longitude), (data.latitude, data.longitude)).m
-                time_diff = (data.timestamp - prev.timestamp).total_seconds()
-                if time_diff > 0:
-                    data.speed = distance / time_diff
-                    added += 1
-
-            if added % 1000 == 0:
-                db.session.commit()
-                added = 1
+            self.rows_processed += derive_speeds(owner_id, start, end)
+            db.session.commit()
 
             i += 1
-            self.progress = ((points_done + i) / total_points)
-
-        db.session.commit()
-
-    def run(self):
-        gps_data = GPSData.query.filter_by(user_id=self.user.id).order_by(GPSData.timestamp).all()
-        additional_traces = AdditionalTrace.query.filter_by(owner_id=self.user.id).all()
-        additional_traces = [GPSData.query.filter_by(trace_id=trace.id).order_by(GPSData.timestamp).all() for trace in additional_traces]
-
-        total_points = len(gps_data) + sum([len(trace) for trace in additional_traces])
-        points_done = 0
-
-        if gps_data:
-            self.generate_speed(gps_data, total_points=total_points)
-            points_done += len(gps_data)
-        
-        for trace_data in additional_traces:
-            if trace_data:
-                self.generate_speed(trace_data, points_done=points_done, total_points=total_points)
-                points_done += len(trace_data)
-        
+            self.progress = i / len(ranges)
 
         self.done = True
 
@@ -293,16 +296,30 @@ class GenerateFullStatisticsJob(Job):
         # return geopy.distance.distance(coords1, coords2).m # most accurate
         return geopy.distance.great_circle(coords1, coords2).m # about 20 times faster
     
-    def generate_statistics(self, gps_data, query_kwargs: dict, points_done=0, total_points=1):
-
-        DailyStatistic.query.filter_by(**query_kwargs).delete()
-
-        
+    @staticmethod
+    def place_of(point, place_names: dict):
+        """The place key of a point, its (country, city) is added to ``place_names`` on first sight."""
+        place = point.place_id if isinstance(point, GPSData) else (point.country, point.city)
+        if place not in place_names:
+            place_names[place] = (point.country, point.city)
+        return place
+
+    def build_daily_statistics(self, gps_data, previous: GPSData = None, points_done=0, total_points=1):
+        """
+        Build DailyStatistic objects for the days covered by ``gps_data`` (points of one owner, sorted by timestamp).
+        ``previous`` is the point right before ``gps_data``, if it does not start at the beginning of the history.
+        """
         i = 0
         daily_stats: dict[str, DailyStatistic] = {}
-        # daily_stats_country_city_count: dict[str, dict[tuple[str, str], int]] = {}
-        daily_stats_country_city_count: dict[str, tuple[dict[str, int], dict[tuple[str, str], int]]] = {}
-        last_point: GPSData = None
+        # day -> place -> seconds spent in the same country / city as the next point. Places are
+        # place_ids (or the names of archived points), their names are only looked up once
+        daily_country_seconds: dict[str, dict] = {}
+        daily_city_seconds: dict[str, dict] = {}
+        place_names: dict = {}
+        last_point: GPSData = previous
+        last_place = None
+        if previous is not None:
+            last_place = self.place_of(previous, place_names)
         for point in gps_data:
             if self.stop_requested:
                 break
@@ -310,55 +327,64 @@ class GenerateFullStatisticsJob(Job):
             key = f"{point.timestamp.year}-{point.timestamp.month}-{point.timestamp.day}"
             if key not in daily_stats:
                 daily_stats[key] = DailyStatistic(
-                    **query_kwargs,
+                    user_id=point.user_id,
+                    trace_id=point.trace_id,
                     year=point.timestamp.year,
                     month=point.timestamp.month,
                     day=point.timestamp.day,
                 )
+                daily_country_seconds[key] = defaultdict(float)
+                daily_city_seconds[key] = defaultdict(float)
                 
-            if i > 0:
-                prev = gps_data[i - 1]
+            prev = gps_data[i - 1] if i > 0 else previous
+            if prev:
                 distance = self.get_distance(prev, point)
                 if daily_stats[key].total_distance_m is None:
                     daily_stats[key].total_distance_m = 0.0
                 daily_stats[key].total_distance_m += distance
-                
-            if key not in daily_stats_country_city_count:
-                daily_stats_country_city_count[key] = ({}, {})
-
-            if last_point and last_point.country and last_point.country == point.country:
-                duration = (point.timestamp - last_point.timestamp).total_seconds()
-
-                if last_point.country not in daily_stats_country_city_count[key][0]:
-                    daily_stats_country_city_count[key][0][last_point.country] = 0
-
-                daily_stats_country_city_count[key][0][last_point.country] += duration
 
-            if last_point and last_point.city and last_point.city == point.city:
-                city_country_key = (last_point.city, last_point.country)
+            place = self.place_of(point, place_names)
+            if last_point:
+                country, city = place_names[place]
+                last_country, last_city = place_names[last_place]
                 duration = (point.timestamp - last_point.timestamp).total_seconds()
-                
-                if city_country_key not in daily_stats_country_city_count[key][1]:
-                    daily_stats_country_city_count[key][1][city_country_key] = 0
 
-                daily_stats_country_city_count[key][1][city_country_key] += duration
+                if last_country and last_country == country:
+                    daily_country_seconds[key][last_place] += duration
+                if last_city and last_city == city:
+                    daily_city_seconds[key][last_place] += duration
 
             last_point = point
+            last_place = place
 
             i += 1
             self.progress = ((points_done + i) / total_points) * 0.9
 
-        for stat in daily_stats.values():
+        for key, stat in daily_stats.items():
             if self.stop_requested:
                 break
 
-            key = f"{stat.year}-{stat.month}-{stat.day}"
-            if key in daily_stats_country_city_count:
-                country_count, city_count = daily_stats_country_city_count[key]
-                if country_count:
-                    stat.visited_countries = [country for country, duration in country_count.items() if duration > self.config.MIN_COUNTRY_VISIT_DURATION_FOR_STATS]
-                if city_count:
-                    stat.visited_cities = [(city, country) for (city, country), duration in city_count.items() if duration > self.config.MIN_CITY_VISIT_DURATION_FOR_STATS]
+            country_seconds = defaultdict(float)
+            for place, seconds in daily_country_seconds[key].items():
+                country_seconds[place_names[place][0]] += seconds
+            city_seconds = defaultdict(float)
+            for place, seconds in daily_city_seconds[key].items():
+                country, city = place_names[place]
+                city_seconds[(city, country)] += seconds
+
+            if country_seconds:
+                stat.visited_countries = [country for country, duration in country_seconds.items() if duration > self.config.MIN_COUNTRY_VISIT_DURATION_FOR_STATS]
+            if city_seconds:
+                stat.visited_cities = [(city, country) for (city, country), duration in city_seconds.items() if duration > self.config.MIN_CITY_VISIT_DURATION_FOR_STATS]
+
+        return daily_stats
+
+    def generate_statistics(self, gps_data, owner_id, points_done=0, total_points=1):
+
+        DailyStatistic.query.filter_by(owner_id=owner_id).delete()
+        data_changed([owner_id])
+
+        daily_stats = self.build_daily_statistics(gps_data, points_done=points_done, total_points=total_points)
 
         i = 0
         for stat in daily_stats.values():
@@ -374,26 +400,24 @@ class GenerateFullStatisticsJob(Job):
 
         print("COMMITTING", i)
 
+        data_changed([owner_id])
         db.session.commit()
 
 
     def run(self):
-        # Get all GPS data for the user sorted by timestamp
-        gps_data: list[GPSData] = GPSData.query.filter_by(user_id=self.user.id).order_by(GPSData.timestamp).all()
-        additional_traces = AdditionalTrace.query.filter_by(owner_id=self.user.id).all()
-        additional_traces = [GPSData.query.filter_by(trace_id=trace.id).order_by(GPSData.timestamp).all() for trace in additional_traces]
+        # Get all GPS data for the user and each trace sorted by timestamp, archived months included
+        owners = [
+            (owner_id, with_archived(GPSData.query.filter_by(owner_id=owner_id).order_by(GPSData.timestamp).all(), {"owner_id": owner_id}))
+            for owner_id in user_owner_ids(self.user)
+        ]
 
-        total_points = len(gps_data) + sum([len(trace) for trace in additional_traces])
+        total_points = sum([len(gps_data) for _, gps_data in owners])
         points_done = 0
 
-        if gps_data:
-            self.generate_statistics(gps_data, {"user_id": self.user.id}, total_points=total_points)
-            points_done += len(gps_data)
-
-        for trace_data in additional_traces:
-            if trace_data:
-                self.generate_statistics(trace_data, {"trace_id": trace_data[0].trace_id}, points_done=points_done, total_points=total_points)
-                points_done += len(trace_data)
+        for owner_id, gps_data in owners:
+            if gps_data:
+                self.generate_statistics(gps_data, owner_id, points_done=points_done, total_points=total_points)
+                points_done += len(gps_data)
 
         
         self.done = True
@@ -401,6 +425,102 @@ class GenerateFullStatisticsJob(Job):
 
 
 
+class UpdateDailyStatisticsJob(GenerateFullStatisticsJob):
+    """
+    Recompute only the DailyStatistic rows of days that were marked dirty by ingest, imports or edits.
+    The day after each dirty day is recomputed too, since its first distance depends on the day before.
+    """
+    PARAMETERS = {}
+
+    def __init__(self):
+        super().__init__(user=None)
+
+    @staticmethod
+    def day_ranges(days: list[date]):
+        """Group sorted days into (start, end) datetime ranges of consecutive days, end exclusive."""
+        ranges = []
+        for day in days:
+            start = datetime.combine(day, dt_time.min)
+            if ranges and ranges[-1][1] == start:
+                ranges[-1][1] = start + timedelta(days=1)
+            else:
+                ranges.append([start, start + timedelta(days=1)])
+        return ranges
+
+    def update_days(self, owner_id, days: list[date]):
+        query_kwargs = {"owner_id": owner_id}
+        for start, end in self.day_ranges(days):
+            previous = (
+                GPSData.query.filter_by(**query_kwargs)
+                .filter(GPSData.timestamp < start)
+                .order_by(GPSData.timestamp.desc())
+                .first()
+            )
+            # an archived point can only come after the live one if there is no live one or they interleave
+            archived = archived_points(query_kwargs, start=previous.timestamp if previous else None, end=start - timedelta(microseconds=1))
+            if archived:
+                previous = archived[-1] if previous is None or archived[-1].timestamp > previous.timestamp else previous
+
+            points = (
+                GPSData.query.filter_by(**query_kwargs)
+                .filter(GPSData.timestamp >= start, GPSData.timestamp < end)
+                .order_by(GPSData.timestamp)
+                .all()
+            )
+            points = with_archived(points, query_kwargs, start, end - timedelta(microseconds=1))
+            self.rows_processed += len(points)
+
+            range_days = [(d.year, d.month, d.day) for d in (start + timedelta(days=n) for n in range((end - start).days))]
+            DailyStatistic.query.filter_by(**query_kwargs).filter(
+                tuple_(DailyStatistic.year, DailyStatistic.month, DailyStatistic.day).in_(range_days)
+            ).delete(synchronize_session=False)
+
+            for stat in self.build_daily_statistics(points, previous=previous).values():
+                db.session.add(stat)
+
+            rebuild_days(query_kwargs, [start.date() + timedelta(days=n) for n in range((end - start).days)], points)
+
+        data_changed([owner_id])
+
+    @staticmethod
+    def claim_days(owner_id) -> list[date]:
+        """
+        Delete the dirty days of an owner in the current transaction and return them. Rows
+        locked by another run are skipped. Until the transaction commits, other sessions still
+        see the days as dirty, and ingest marking one of them again waits for the commit.
+        """
+        return [day for (day,) in db.session.execute(text("""
+            DELETE FROM daily_statistic_dirty WHERE id IN (
+                SELECT id FROM daily_statistic_dirty
+                WHERE COALESCE(trace_id, user_id) = :owner_id
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING day
+        """), {"owner_id": owner_id})]
+
+    def run(self):
+        owners = [owner_id for (owner_id,) in db.session.execute(
+            text("SELECT DISTINCT COALESCE(trace_id, user_id) FROM daily_statistic_dirty")
+        )]
+        db.session.commit()
+
+        # one transaction per owner: its dirty days are only gone once their statistics are written
+        for i, owner_id in enumerate(owners):
+            if self.stop_requested:
+                break
+
+            days = set(self.claim_days(owner_id))
+            if days:
+                self.update_days(owner_id, sorted(days | {day + timedelta(days=1) for day in days}))
+            db.session.commit()
+
+            self.progress = (i + 1) / len(owners)
+
+        self.done = True
+
+
+
+
 class FilterLargeAccuracyJob(Job):
     PARAMETERS = {
         "user": User,
@@ -414,9 +534,7 @@ class FilterLargeAccuracyJob(Job):
         self.maximum_accuracy = maximum_accuracy
 
     def run(self):
-        gps_data: list[GPSData] = GPSData.query.filter_by(user_id=self.user.id).all()
-        additional_traces = AdditionalTrace.query.filter_by(owner_id=self.user.id).all()
-        gps_data += [point for trace in additional_traces for point in GPSData.query.filter_by(trace_id=trace.id).all()]
+        gps_data: list[GPSData] = GPSData.query.filter(GPSData.owner_id.in_(user_owner_ids(self.user))).all()
 
         if not gps_data:
             self.done = True
@@ -425,11 +543,13 @@ class FilterLargeAccuracyJob(Job):
         i = 0
         total_count = len(gps_data)
         deleted = 1
+        dirty_days = set()
         for data in gps_data:
             if self.stop_requested:
                 break
 
             if data.horizontal_accuracy is not None and data.horizontal_accuracy > self.maximum_accuracy:
+                dirty_days.add((data.user_id, data.trace_id, data.timestamp.date()))
                 db.session.delete(data)
                 deleted += 1
 
@@ -440,6 +560,7 @@ class FilterLargeAccuracyJob(Job):
                 db.session.commit()
                 deleted = 1
 
+        mark_days_dirty(dirty_days)
         db.session.commit()
 
         self.done = True
@@ -459,9 +580,7 @@ class FilterLargeSpeedJob(Job):
         self.maximum_speed = maximum_speed_kmh / 3.6
 
     def run(self):
-        gps_data: list[GPSData] = GPSData.query.filter_by(user_id=self.user.id).all()
-        additional_traces = AdditionalTrace.query.filter_by(owner_id=self.user.id).all()
-        gps_data += [point for trace in additional_traces for point in GPSData.query.filter_by(trace_id=trace.id).all()]
+        gps_data: list[GPSData] = GPSData.query.filter(GPSData.owner_id.in_(user_owner_ids(self.user))).all()
 
         if not gps_data:
             self.done = True
@@ -471,6 +590,7 @@ class FilterLargeSpeedJob(Job):
         total_count = len(gps_data)
         deleted = 1
         delete_buffer = []
+        dirty_days = set()
         for data in gps_data:
             if self.stop_requested:
                 break
@@ -479,7 +599,9 @@ class FilterLargeSpeedJob(Job):
                 delete_buffer.append(data)
             else:
                 while delete_buffer:
-                    db.session.delete(delete_buffer.pop(0))
+                    point = delete_buffer.pop(0)
+                    dirty_days.add((point.user_id, point.trace_id, point.timestamp.date()))
+                    db.session.delete(point)
                     deleted += 1
 
             i += 1
@@ -489,6 +611,7 @@ class FilterLargeSpeedJob(Job):
                 db.session.commit()
                 deleted = 1
 
+        mark_days_dirty(dirty_days)
         db.session.commit()
 
         self.done = True
@@ -509,10 +632,12 @@ class FilterClustersJob(Job):
         self.maximum_distance = maximum_distance
 
     def run(self):
-        # Get all GPS data for the user sorted by timestamp
-        gps_data: list[GPSData] = GPSData.query.filter_by(user_id=self.user.id).order_by(GPSData.timestamp).all()
-        additional_traces = AdditionalTrace.query.filter_by(owner_id=self.user.id).all()
-        gps_data += [point for trace in additional_traces for point in GPSData.query.filter_by(trace_id=trace.id).order_by(GPSData.timestamp).all()]
+        # Get all GPS data for the user and each trace sorted by timestamp
+        gps_data: list[GPSData] = (
+            GPSData.query.filter(GPSData.owner_id.in_(user_owner_ids(self.user)))
+            .order_by(GPSData.owner_id, GPSData.timestamp)
+            .all()
+        )
 
         if not gps_data:
             self.done = True
@@ -521,6 +646,7 @@ class FilterClustersJob(Job):
         i = 0
         total_count = len(gps_data)
         deleted = 1
+        dirty_days = set()
         for data in gps_data:
             if self.stop_requested:
                 break
@@ -529,6 +655,7 @@ class FilterClustersJob(Job):
                 prev = gps_data[i - 1]
                 distance = geopy.distance.great_circle((prev.latitude, prev.longitude), (data.latitude, data.longitude)).m
                 if distance < self.maximum_distance:
+                    dirty_days.add((prev.user_id, prev.trace_id, prev.timestamp.date()))
                     db.session.delete(prev)
                     deleted += 1
 
@@ -539,6 +666,7 @@ class FilterClustersJob(Job):
                 db.session.commit()
                 deleted = 1
 
+        mark_days_dirty(dirty_days)
         db.session.commit()
 
         self.done = True
@@ -547,90 +675,41 @@ class FilterClustersJob(Job):
 
 
 
-class ImportJob(Job):
+class ArchiveOldMonthsJob(Job):
+    """
+    Move the points of every month older than ARCHIVE_AFTER_MONTHS into compressed
+    ArchivedMonth rows, one owner-month per transaction. See core.archive.
+    """
     PARAMETERS = {
-        "user": User,
-        "import": Import,
-        "trace": Optional[AdditionalTrace]
+        "user": User
     }
 
-    def __init__(self, user: User, import_obj: Import, trace: Optional[AdditionalTrace] = None):
+    def __init__(self, user: User):
         super().__init__()
         self.user = user
-        self.import_obj = import_obj
-        self.trace = trace
 
     def run(self):
-        # Read the file and parse the GPS data
-        with open(Config.UPLOAD_FOLDER + "/" + self.import_obj.filename, "r") as f:
-            data = f.read()
-
-        json_data = json.loads(data)
-        if not json_data:
+        if self.config.ARCHIVE_AFTER_MONTHS <= 0:
             self.done = True
             return
 
-        # Load existing GPS data in memory for fast lookup
-        existing_points = set(
-            (r.timestamp, r.latitude, r.longitude)
-            # for r in GPSData.query.filter(GPSData.import_id == self.import_obj.id).all()
-            for r in GPSData.query.filter_by(import_id=self.import_obj.id).all()
-        )
+        owners = [{"owner_id": owner_id} for owner_id in user_owner_ids(self.user)]
+        months = [(query_kwargs, month) for query_kwargs in owners for month in months_to_archive(query_kwargs)]
 
         i = 0
-        new_records = []  # Store new records in batch
-        for entry in json_data:
-            ts_str = entry.get("timestamp")
-            try:
-                ts = datetime.fromisoformat(ts_str)  # Parse timestamp as ISO 8601
-            except Exception as e:
-                print(f"Error parsing timestamp {ts_str}: {e}")
-                ts = datetime.now()  # Fallback to current timestamp
-
-            lat = entry["latitude"]
-            lon = entry["longitude"]
-
-            # Skip if record already exists
-            if (ts, lat, lon) in existing_points:
-                continue
-
-            kwarg = {"user_id": self.user.id}
-            if self.trace:
-                kwarg = {"trace_id": self.trace.id}
-
-            gps_record = GPSData(
-                **kwarg,
-                import_id=self.import_obj.id,
-                timestamp=ts,
-                latitude=lat,
-                longitude=lon,
-                horizontal_accuracy=entry.get("horizontal_accuracy"),
-                altitude=entry.get("altitude"),
-                vertical_accuracy=entry.get("vertical_accuracy"),
-                heading=entry.get("heading"),
-                heading_accuracy=entry.get("heading_accuracy"),
-                speed=entry.get("speed"),
-                speed_accuracy=entry.get("speed_accuracy"),
-            )
-
-            new_records.append(gps_record)
+        for query_kwargs, month in months:
+            if self.stop_requested:
+                break
 
-            # Batch insert every 1000 records
-            if len(new_records) >= 1000:
-                db.session.bulk_save_objects(new_records)
-                db.session.commit()
-                new_records = []  # Clear batch after commit
+            self.rows_processed += archive_month(query_kwargs, month)
+            db.session.commit()
 
             i += 1
-            self.progress = i / len(json_data)
+            self.progress = i / len(months)
 
-        # Final commit for remaining records
-        if new_records:
-            db.session.bulk_save_objects(new_records)
+        if self.config.GPS_DATA_PARTITIONING and not self.stop_requested:
+            drop_empty_partitions(archive_cutoff())
             db.session.commit()
-        
-        self.import_obj.done_importing = True
-        db.session.commit()
 
         self.done = True
 
@@ -638,52 +717,127 @@ class ImportJob(Job):
 
 
 
-class DeleteDuplicatesJob(Job):
+class BuildTrackLevelsJob(Job):
+    """
+    Build the precomputed map levels (see core.track_levels) of every day of a user and
+    their traces, one owner-month per transaction. Later changes are picked up by
+    UpdateDailyStatisticsJob.
+    """
     PARAMETERS = {
         "user": User
     }
 
     def __init__(self, user: User):
         super().__init__()
-        self.concurrency_limit_type = ConcurrencyLimitType.GLOBAl
+        # writes the same track_level rows as UpdateDailyStatisticsJob, which must not run at the same time
+        self.concurrency_limit_type = ConcurrencyLimitType.GENERATE_STATS
         self.user = user
 
     def run(self):
-        # Get all GPS data for the user sorted by timestamp
-        gps_data: list[GPSData] = GPSData.query.filter_by(user_id=self.user.id).order_by(GPSData.timestamp).all()
-        additional_traces = AdditionalTrace.query.filter_by(owner_id=self.user.id).all()
-        gps_data += [point for trace in additional_traces for point in GPSData.query.filter_by(trace_id=trace.id).order_by(GPSData.timestamp).all()]
-
-        if not gps_data:
-            self.done = True
-            return
+        owners = [({"owner_id": owner_id}, owner_months({"owner_id": owner_id})) for owner_id in user_owner_ids(self.user)]
+        total = sum(len(months) for _, months in owners)
 
         i = 0
-        total_count = len(gps_data)
-        deleted = 1
-        for data in gps_data:
-            if self.stop_requested:
-                break
+        for query_kwargs, months in owners:
+            for month in months:
+                if self.stop_requested:
+                    self.done = True
+                    return
+
+                start, end = month_bounds(month)
+                points = (
+                    GPSData.query.filter_by(**query_kwargs)
+                    .filter(GPSData.timestamp >= start, GPSData.timestamp < end)
+                    .order_by(GPSData.timestamp)
+                    .all()
+                )
+                points = with_archived(points, query_kwargs, start, end - timedelta(microseconds=1))
+                rebuild_days(query_kwargs, [start.date() + timedelta(days=n) for n in range((end - start).days)], points)
+                db.session.commit()
+                self.rows_processed += len(points)
 
-            if i > 0:
-                prev = gps_data[i - 1]
-                if prev.timestamp == data.timestamp and prev.latitude == data.latitude and prev.longitude == data.longitude:
-                    db.session.delete(prev)
-                    deleted += 1
+                i += 1
+                self.progress = i / max(total, 1)
 
-            i += 1
-            self.progress = (i / total_count)
+            # from now on the map relies on the levels of this owner, see track_level_rows
+            mark_levels_complete(query_kwargs["owner_id"])
+            data_changed([query_kwargs["owner_id"]])
+            db.session.commit()
 
-            if deleted % 1000 == 0:
-                deleted = 1
-                db.session.commit()
+        self.done = True
 
-        db.session.commit()
 
-        self.done = True
 
 
 
+class ImportJob(Job):
+    PARAMETERS = {
+        "user": User,
+        "import": Import,
+        "trace": Optional[AdditionalTrace]
+    }
+
+    def __init__(self, user: User, import_obj: Import, trace: Optional[AdditionalTrace] = None):
+        super().__init__()
+        self.user = user
+        self.import_obj = import_obj
+        self.trace = trace
+
+    def run(self):
+        path = Config.UPLOAD_FOLDER + "/" + self.import_obj.filename
+        size = max(os.path.getsize(path), 1)
+
+        user_id, trace_id = owner_ids(self.user, self.trace)
+        import_id = str(self.import_obj.id)
+        self.import_obj.error = None
+        self.import_obj.skipped_entries = 0
+
+        def skip(_error):
+            self.import_obj.skipped_entries += 1
+
+        # Stream the file in its native format, so memory use does not grow with its size
+        with open(path, "rb") as f:
+            try:
+                import_format = detect_import_format(f)
+                total = 0
+                new_records = []  # Store new records in batch
+                for row in iter_import_rows(f, import_format, user_id, trace_id, import_id, on_skip=skip):
+                    if self.stop_requested:
+                        break
+
+                    new_records.append(row)
+                    total += 1
+
+                    # Batch insert every 1000 records, points that already exist are skipped by the database
+                    if len(new_records) >= 1000:
+                        self.rows_processed += insert_points(new_records)
+                        self.import_obj.total_entries = total
+                        db.session.commit()
+                        new_records = []  # Clear batch after commit
+                        self.progress = min(f.tell() / size, 1)
+
+                # Final commit for remaining records
+                if new_records:
+                    self.rows_processed += insert_points(new_records)
+                self.import_obj.total_entries = total
+                db.session.commit()
+            except (InvalidPointError, ijson.JSONError) as e:
+                # unsupported or broken file, the points read so far stay imported
+                db.session.rollback()
+                print(e)
+                self.import_obj.error = str(e)[:255]
+                db.session.commit()
+                self.done = True
+                return
+
+        if self.stop_requested:
+            self.done = True
+            return
+
+        self.import_obj.done_importing = True
+        db.session.commit()
+
+        self.done = True
 
 
 
@@ -695,10 +849,15 @@ JOB_TYPES: dict[str, Job] = {
     "filter_accuracy": FilterLargeAccuracyJob,
     "filter_speed": FilterLargeSpeedJob,
     "filter_clusters": FilterClustersJob,
-    "delete_duplicates": DeleteDuplicatesJob,
     "reset_no_geocoding": ResetPointsWithNoGeocodingJob,
 }
 
+if Config.ARCHIVE_AFTER_MONTHS > 0:
+    JOB_TYPES["archive_months"] = ArchiveOldMonthsJob
+
+if Config.TRACK_LEVEL_ZOOMS:
+    JOB_TYPES["track_levels"] = BuildTrackLevelsJob
+
 if len(Config.PHOTON_SERVER_HOST) != 0:
     JOB_TYPES["photon_full"] = PhotonFullJob
     JOB_TYPES["photon_fill"] = PhotonFillJob
\ No newline at end of file
@@ -14,6 +14,46 @@ class Config:
     MIN_CITY_VISIT_DURATION_FOR_STATS = int(os.getenv("MIN_CITY_VISIT_DURATION_FOR_STATS", 60 * 60))
     SQLALCHEMY_DATABASE_URI = f"postgresql://{DB_USER}:{DB_PASS}@{DB_HOST}/{DB_NAME}"
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    WEB_THREADS = int(os.getenv("WEB_THREADS", 4)) # waitress worker threads
+    DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 8)) # connections kept open, shared by requests, jobs and ingest
+    DB_POOL_MAX_OVERFLOW = int(os.getenv("DB_POOL_MAX_OVERFLOW", 4)) # extra connections opened under load
+    DB_POOL_TIMEOUT = int(os.getenv("DB_POOL_TIMEOUT", 30)) # seconds to wait for a free connection
+    DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", 1800)) # seconds before a connection is reopened
+    DB_PREPARED_STATEMENTS = os.getenv("DB_PREPARED_STATEMENTS", "false").lower() == "true" # server-side prepared statements for raw map queries
+    SQLALCHEMY_ENGINE_OPTIONS = {
+        "pool_size": DB_POOL_SIZE,
+        "max_overflow": DB_POOL_MAX_OVERFLOW,
+        "pool_timeout": DB_POOL_TIMEOUT,
+        "pool_recycle": DB_POOL_RECYCLE,
+        "pool_pre_ping": True,
+    }
+    DB_REPLICA_HOST = os.environ.get("POSTGRES_REPLICA_HOST", "") # streaming replica with the same database and credentials
+    DB_REPLICA_URI = os.getenv("DB_REPLICA_URI", f"postgresql://{DB_USER}:{DB_PASS}@{DB_REPLICA_HOST}/{DB_NAME}" if DB_REPLICA_HOST else "")
+    DB_REPLICA_MAX_LAG = int(os.getenv("DB_REPLICA_MAX_LAG", 30)) # seconds of replication lag before reads go to the primary again
+    DB_REPLICA_CHECK_INTERVAL = int(os.getenv("DB_REPLICA_CHECK_INTERVAL", 10)) # seconds between replica health checks
+    SQLALCHEMY_BINDS = {"replica": {"url": DB_REPLICA_URI, "connect_args": {"connect_timeout": 5}}} if DB_REPLICA_URI else {}
     PHOTON_SERVER_HOST = os.getenv("PHOTON_SERVER_HOST", "")
     PHOTON_SERVER_HTTPS = os.getenv("PHOTON_SERVER_HTTPS", True)
     PHOTON_SERVER_API_KEY = os.getenv("PHOTON_SERVER_API_KEY", "")
+    API_KEY_CACHE_SIZE = int(os.getenv("API_KEY_CACHE_SIZE", 1024))
+    API_KEY_CACHE_TTL = int(os.getenv("API_KEY_CACHE_TTL", 60))
+    INGEST_WRITE_BEHIND = os.getenv("INGEST_WRITE_BEHIND", "false").lower() == "true"
+    INGEST_ACK_MODE = os.getenv("INGEST_ACK_MODE", "commit") # "commit" or "enqueue"
+    INGEST_ACK_TIMEOUT = float(os.getenv("INGEST_ACK_TIMEOUT", 30)) # seconds a request waits for its queued rows to be committed, then 503
+    INGEST_FLUSH_INTERVAL_MS = int(os.getenv("INGEST_FLUSH_INTERVAL_MS", 500))
+    INGEST_FLUSH_ROWS = int(os.getenv("INGEST_FLUSH_ROWS", 5000))
+    INGEST_QUEUE_SIZE = int(os.getenv("INGEST_QUEUE_SIZE", 100000))
+    INGEST_CHUNK_SIZE = int(os.getenv("INGEST_CHUNK_SIZE", 1000))
+    INGEST_SPOOL_MEMORY = int(os.getenv("INGEST_SPOOL_MEMORY", 16 * 1024 * 1024)) # parsed rows of a request kept in memory before spilling to a temp file
+    INGEST_MAX_DECOMPRESSED_SIZE = int(os.getenv("INGEST_MAX_DECOMPRESSED_SIZE", 256 * 1024 * 1024))
+    STATISTICS_UPDATE_INTERVAL = int(os.getenv("STATISTICS_UPDATE_INTERVAL", 10))
+    POSTGIS_ENABLED = os.getenv("POSTGIS_ENABLED", "false").lower() == "true" # needs a PostGIS image, e.g. postgis/postgis:15-3.4
+    GPS_DATA_PARTITIONING = os.getenv("GPS_DATA_PARTITIONING", "false").lower() == "true" # one-way migration to monthly partitions
+    GPS_DATA_COMPACT = os.getenv("GPS_DATA_COMPACT", "false").lower() == "true" # one-way migration to int4 coordinates and float4 measurements
+    ARCHIVE_AFTER_MONTHS = int(os.getenv("ARCHIVE_AFTER_MONTHS", 0)) # archive points older than this many months, 0 = never
+    ARCHIVE_CACHE_MB = int(os.getenv("ARCHIVE_CACHE_MB", 256)) # memory for decoded archive months
+    TRACK_LEVEL_ZOOMS = [int(zoom) for zoom in os.getenv("TRACK_LEVEL_ZOOMS", "4,6,8,10,12,14").split(",") if zoom.strip()] # precomputed map levels, empty = off
+    TRACK_LEVEL_CACHE_SIZE = int(os.getenv("TRACK_LEVEL_CACHE_SIZE", 4096)) # decoded track level days kept in memory
+    RESPONSE_CACHE_MB = int(os.getenv("RESPONSE_CACHE_MB", 64)) # memory for cached map, heatmap and statistics responses
+    MAP_SIMPLIFY_TOLERANCE = float(os.getenv("MAP_SIMPLIFY_TOLERANCE", 1.0)) # pixels a simplified map track may deviate from the recorded one
+    METRICS_TOKEN = os.getenv("METRICS_TOKEN", "") # if set, /metrics requires "Authorization: Bearer <token>", otherwise it only answers localhost
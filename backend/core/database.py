@@ -0,0 +1,63 @@
+"""
+Raw SQL on the connection pool of the SQLAlchemy engine.
+
+ORM queries and raw psycopg2 cursors share one pool (sized by DB_POOL_SIZE and
+DB_POOL_MAX_OVERFLOW), so hot paths like MapView.post do not open a connection per request.
+With DB_PREPARED_STATEMENTS, ``execute`` prepares each distinct statement once per pooled
+connection and only sends EXECUTE with the parameters afterwards.
+"""
+import hashlib
+import re
+
+from .config import Config
+from .extensions import db
+
+
+# %s placeholders of psycopg2, %% is a literal percent sign
+PLACEHOLDER = re.compile(r"%%|%s")
+
+
+def raw_cursor(name: str = None):
+    """
+    A psycopg2 cursor on the connection of the current session, returned to the pool with it.
+    With a ``name`` it is a server-side cursor, which fetches ``itersize`` rows at a time while iterating.
+    """
+    return db.session.connection().connection.cursor(name=name)
+
+
+def _prepared_sql(sql: str) -> str:
+    """``sql`` with $1, $2, ... instead of the psycopg2 placeholders."""
+    count = 0
+
+    def replace(match):
+        nonlocal count
+        if match.group() == "%%":
+            return "%"
+        count += 1
+        return f"${count}"
+
+    return PLACEHOLDER.sub(replace, sql)
+
+
+def execute(cursor, sql: str, params: list = None):
+    """
+    Run ``sql`` (with psycopg2 %s placeholders) on a cursor from raw_cursor.
+    Parameters must not be lists, they are sent as the statement's parameters.
+    Server-side cursors can not run prepared statements, they always send the query.
+    """
+    params = params or []
+    if not Config.DB_PREPARED_STATEMENTS or cursor.name:
+        cursor.execute(sql, params)
+        return
+
+    name = "wpdb_" + hashlib.md5(sql.encode()).hexdigest()[:16]
+    # the pool keeps .info with the DBAPI connection, and prepared statements live as long as it
+    prepared = db.session.connection().connection.info.setdefault("prepared_statements", set())
+    if name not in prepared:
+        cursor.execute(f"PREPARE {name} AS {_prepared_sql(sql)}")
+        prepared.add(name)
+
+    if params:
+        cursor.execute(f"EXECUTE {name} ({', '.join(['%s'] * len(params))})", params)
+    else:
+        cursor.execute(f"EXECUTE {name}")
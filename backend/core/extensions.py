@@ -1,10 +1,64 @@
 from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy.session import Session
 from flask_migrate import Migrate
 from flask_restx import Api
-from flask import Flask
-from sqlalchemy import create_engine
+from flask import Flask, g, has_request_context
+from sqlalchemy import create_engine, text
+from sqlalchemy.exc import SQLAlchemyError
 
-db = SQLAlchemy()
+from .cache import TTLCache
+from .config import Config
+
+
+REPLICA_BIND = "replica"
+
+# the result of the last replica health check, see replica_available
+replica_status = TTLCache(maxsize=1, ttl=Config.DB_REPLICA_CHECK_INTERVAL)
+
+
+def replica_available(engine) -> bool:
+    """
+    Whether the replica answers and replays the primary's changes with less than
+    DB_REPLICA_MAX_LAG seconds of lag. Checked at most every DB_REPLICA_CHECK_INTERVAL.
+    """
+    available = replica_status.get(REPLICA_BIND)
+    if available is not None:
+        return available
+
+    try:
+        with engine.connect() as connection:
+            # NULL if it is not a standby, or has not replayed anything yet
+            lag = connection.execute(text(
+                "SELECT EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())"
+            )).scalar()
+        available = lag is None or lag <= Config.DB_REPLICA_MAX_LAG
+        if not available:
+            print(f"Read replica is {lag:.0f}s behind, reading from the primary")
+    except SQLAlchemyError as e:
+        print(f"Read replica is not available, reading from the primary: {e}")
+        available = False
+
+    replica_status.set(REPLICA_BIND, available)
+    return available
+
+
+class RoutingSession(Session):
+    """Sends the queries of requests marked with utils.read_replica to the read replica, if one is configured."""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if (
+            bind is None
+            and not self._flushing
+            and has_request_context()
+            and g.get("read_replica")
+            and REPLICA_BIND in self._db.engines
+            and replica_available(self._db.engines[REPLICA_BIND])
+        ):
+            return self._db.engines[REPLICA_BIND]
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+db = SQLAlchemy(session_options={"class_": RoutingSession})
 migrate = Migrate()
 api_v1 = Api(
     version="1.0",
@@ -0,0 +1,319 @@
+"""
+Streaming parsers for the import file formats.
+
+Every format is read incrementally from the open (binary) file, so even multi-GB exports
+are imported with constant memory: JSON formats with ijson, GPX with a SAX parser.
+``iter_import_rows`` yields row tuples (see ingest.GPS_COLUMNS) ready for insert_points.
+"""
+from datetime import datetime, timedelta, timezone
+from itertools import islice
+import re
+import xml.sax
+
+import ijson
+
+from .ingest import InvalidPointError, optional_float, parse_import_entry
+
+
+READ_CHUNK_SIZE = 64 * 1024
+
+
+def parse_timestamp(value) -> datetime:
+    """Epoch seconds or milliseconds (as number or string), or an ISO 8601 string."""
+    try:
+        if isinstance(value, (int, float)) or (isinstance(value, str) and re.fullmatch(r"\d+(\.\d+)?", value)):
+            seconds = float(value)
+            if seconds > 1e11:
+                seconds /= 1000
+            return datetime.fromtimestamp(seconds, tz=timezone.utc)
+        return datetime.fromisoformat(value)
+    except (TypeError, ValueError, OverflowError, OSError) as e:
+        raise InvalidPointError(f"Invalid timestamp {value!r}: {e}")
+
+
+def make_row(user_id, trace_id, import_id, timestamp, latitude, longitude, horizontal_accuracy=None,
+             altitude=None, vertical_accuracy=None, heading=None, speed=None) -> tuple:
+    try:
+        return (
+            user_id, trace_id, import_id, parse_timestamp(timestamp),
+            round(float(latitude), 8),
+            round(float(longitude), 8),
+            optional_float(horizontal_accuracy),
+            optional_float(altitude),
+            optional_float(vertical_accuracy),
+            optional_float(heading),
+            None,
+            optional_float(speed),
+            None,
+            False,
+        )
+    except (TypeError, ValueError) as e:
+        raise InvalidPointError(f"Invalid import entry: {e}")
+
+
+# ---------------------------------------------------------------------------
+#  WayPointDB JSON: [{"timestamp": ..., "latitude": ..., "longitude": ...}, ...]
+# ---------------------------------------------------------------------------
+def iter_waypointdb(f):
+    yield from ijson.items(f, "item", use_float=True)
+
+
+# ---------------------------------------------------------------------------
+#  GeoJSON FeatureCollection of points, e.g. exports of other trackers
+# ---------------------------------------------------------------------------
+def iter_geojson(f):
+    yield from ijson.items(f, "features.item", use_float=True)
+
+
+def parse_geojson_feature(feature: dict, user_id, trace_id, import_id) -> tuple:
+    properties = feature.get("properties") or {}
+    coords = (feature.get("geometry") or {}).get("coordinates") or [None, None]
+
+    velocity = optional_float(properties.get("velocity"))  # km/h
+    return make_row(
+        user_id, trace_id, import_id,
+        properties.get("timestamp"),
+        properties.get("latitude", coords[1]),
+        properties.get("longitude", coords[0]),
+        horizontal_accuracy=properties.get("accuracy", properties.get("horizontal_accuracy")),
+        altitude=properties.get("altitude"),
+        vertical_accuracy=properties.get("vertical_accuracy"),
+        heading=properties.get("course", properties.get("heading")),
+        speed=velocity / 3.6 if velocity is not None else properties.get("speed"),
+    )
+
+
+# ---------------------------------------------------------------------------
+#  Polarsteps: {"locations": [{"lat": ..., "lon": ..., "time": ...}, ...]}
+# ---------------------------------------------------------------------------
+def iter_polarsteps(f):
+    yield from ijson.items(f, "locations.item", use_float=True)
+
+
+def parse_polarsteps_location(location: dict, user_id, trace_id, import_id) -> tuple:
+    return make_row(user_id, trace_id, import_id, location.get("time"), location.get("lat"), location.get("lon"))
+
+
+# ---------------------------------------------------------------------------
+#  Google Takeout Records.json: {"locations": [{"latitudeE7": ..., "longitudeE7": ..., ...}]}
+# ---------------------------------------------------------------------------
+def iter_google_records(f):
+    yield from ijson.items(f, "locations.item", use_float=True)
+
+
+def parse_google_record(record: dict, user_id, trace_id, import_id) -> tuple:
+    try:
+        latitude = record["latitudeE7"] / 1e7
+        longitude = record["longitudeE7"] / 1e7
+    except (KeyError, TypeError) as e:
+        raise InvalidPointError(f"Invalid Google location record: {e}")
+
+    return make_row(
+        user_id, trace_id, import_id,
+        record.get("timestamp", record.get("timestampMs")),
+        latitude, longitude,
+        horizontal_accuracy=record.get("accuracy"),
+        altitude=record.get("altitude"),
+        vertical_accuracy=record.get("verticalAccuracy"),
+        heading=record.get("heading"),
+        speed=record.get("velocity"),
+    )
+
+
+# ---------------------------------------------------------------------------
+#  Google Timeline exported on the phone, either the older list of segments or the
+#  newer {"semanticSegments": [...], "rawSignals": [...]} layout
+# ---------------------------------------------------------------------------
+GOOGLE_POINT = re.compile(r"(?:geo:)?\s*(-?\d+(?:\.\d+)?)°?\s*,\s*(-?\d+(?:\.\d+)?)°?")
+
+
+def google_timeline_points(segment: dict):
+    start = segment.get("startTime")
+    for point in segment.get("timelinePath") or []:
+        if "time" in point:
+            timestamp = point["time"]
+        else:
+            try:
+                offset = timedelta(minutes=int(point.get("durationMinutesOffsetFromStartTime", 0)))
+                timestamp = (parse_timestamp(start) + offset).isoformat()
+            except (InvalidPointError, TypeError, ValueError):
+                timestamp = None  # rejected by the parser, without ending the import
+        yield {"point": point.get("point"), "timestamp": timestamp}
+
+
+def iter_google_timeline(f):
+    for segment in ijson.items(f, "item", use_float=True):
+        yield from google_timeline_points(segment)
+
+
+def iter_google_semantic_timeline(f):
+    for segment in ijson.items(f, "semanticSegments.item", use_float=True):
+        yield from google_timeline_points(segment)
+
+    # raw signals carry the accurate positions, they come after the segments in the file
+    f.seek(0)
+    for signal in ijson.items(f, "rawSignals.item", use_float=True):
+        position = signal.get("position")
+        if position:
+            yield {
+                "point": position.get("LatLng"),
+                "timestamp": position.get("timestamp"),
+                "accuracy": position.get("accuracyMeters"),
+                "altitude": position.get("altitudeMeters"),
+                "speed": position.get("speedMetersPerSecond"),
+            }
+
+
+def parse_google_timeline_point(point: dict, user_id, trace_id, import_id) -> tuple:
+    match = GOOGLE_POINT.match(point.get("point") or "")
+    if not match:
+        raise InvalidPointError(f"Invalid Google timeline point: {point.get('point')!r}")
+
+    return make_row(
+        user_id, trace_id, import_id,
+        point.get("timestamp"), match.group(1), match.group(2),
+        horizontal_accuracy=point.get("accuracy"),
+        altitude=point.get("altitude"),
+        speed=point.get("speed"),
+    )
+
+
+# ---------------------------------------------------------------------------
+#  GPX track, route and waypoints
+# ---------------------------------------------------------------------------
+class GPXHandler(xml.sax.handler.ContentHandler):
+    """Collects <trkpt>, <rtept> and <wpt> elements as dicts in ``points``."""
+    POINT_TAGS = {"trkpt", "rtept", "wpt"}
+    FIELD_TAGS = {"time", "ele", "speed", "course", "hdop"}
+
+    def __init__(self):
+        super().__init__()
+        self.points = []
+        self.point = None
+        self.field = None
+        self.text = []
+
+    @staticmethod
+    def local_name(name: str) -> str:
+        return name.rsplit(":", 1)[-1]
+
+    def startElement(self, name, attrs):
+        name = self.local_name(name)
+        if name in self.POINT_TAGS:
+            self.point = {"lat": attrs.get("lat"), "lon": attrs.get("lon")}
+        elif self.point is not None and name in self.FIELD_TAGS:
+            self.field = name
+            self.text = []
+
+    def characters(self, content):
+        if self.field:
+            self.text.append(content)
+
+    def endElement(self, name):
+        name = self.local_name(name)
+        if self.field == name:
+            self.point[name] = "".join(self.text).strip()
+            self.field = None
+        elif name in self.POINT_TAGS and self.point is not None:
+            self.points.append(self.point)
+            self.point = None
+
+
+def iter_gpx(f):
+    handler = GPXHandler()
+    parser = xml.sax.make_parser()
+    parser.setFeature(xml.sax.handler.feature_external_ges, False)
+    parser.setContentHandler(handler)
+
+    try:
+        while chunk := f.read(READ_CHUNK_SIZE):
+            parser.feed(chunk)
+            yield from handler.points
+            handler.points.clear()
+        parser.close()
+    except xml.sax.SAXException as e:
+        raise InvalidPointError(f"Invalid GPX file: {e}")
+    yield from handler.points
+
+
+def parse_gpx_point(point: dict, user_id, trace_id, import_id) -> tuple:
+    return make_row(
+        user_id, trace_id, import_id,
+        point.get("time"), point.get("lat"), point.get("lon"),
+        altitude=point.get("ele"),
+        heading=point.get("course"),
+        speed=point.get("speed"),
+    )
+
+
+# format name: (label, item iterator over the open file, item -> row tuple)
+IMPORT_FORMATS = {
+    "waypointdb": ("WayPointDB JSON", iter_waypointdb, parse_import_entry),
+    "gpx": ("GPX", iter_gpx, parse_gpx_point),
+    "geojson": ("GeoJSON", iter_geojson, parse_geojson_feature),
+    "google_records": ("Google Takeout (Records.json)", iter_google_records, parse_google_record),
+    "google_timeline": ("Google Timeline (phone export)", iter_google_timeline, parse_google_timeline_point),
+    "google_semantic_timeline": ("Google Timeline (phone export)", iter_google_semantic_timeline, parse_google_timeline_point),
+    "polarsteps": ("Polarsteps", iter_polarsteps, parse_polarsteps_location),
+}
+
+
+# JSON events read to find a known top-level key, so a large unknown file is not parsed to the end
+DETECT_MAX_EVENTS = 10000
+
+
+def detect_import_format(f) -> str:
+    """
+    Guess the format of an import file from its first bytes and first JSON item,
+    without reading the whole file. Raises InvalidPointError if it is not supported.
+    The file position is reset to the start.
+    """
+    try:
+        head = f.read(1024).lstrip()
+        f.seek(0)
+        if head.startswith(b"<"):
+            return "gpx"
+
+        events = ijson.parse(f)
+        _, event, _ = next(events)
+        if event == "start_array":
+            first = next(ijson.items(_restart(f), "item"), None)
+            if isinstance(first, dict) and ("timelinePath" in first or "startTime" in first):
+                return "google_timeline"
+            return "waypointdb"
+
+        if event == "start_map":
+            for prefix, event, value in islice(events, DETECT_MAX_EVENTS):
+                if prefix == "" and event == "map_key":
+                    if value == "features":
+                        return "geojson"
+                    if value in ("semanticSegments", "rawSignals"):
+                        return "google_semantic_timeline"
+                    if value == "locations":
+                        first = next(ijson.items(_restart(f), "locations.item"), None) or {}
+                        return "google_records" if "latitudeE7" in first else "polarsteps"
+    except (ijson.JSONError, StopIteration) as e:
+        raise InvalidPointError(f"Unsupported import file: {e}")
+    finally:
+        f.seek(0)
+
+    raise InvalidPointError("Unsupported import file")
+
+
+def _restart(f):
+    f.seek(0)
+    return f
+
+
+def iter_import_rows(f, import_format: str, user_id, trace_id, import_id, on_skip=None):
+    """
+    Yield row tuples from an import file. Invalid entries are skipped and reported to
+    ``on_skip`` with their InvalidPointError.
+    """
+    _, items, parse = IMPORT_FORMATS[import_format]
+    for item in items(f):
+        try:
+            yield parse(item, user_id, trace_id, import_id)
+        except InvalidPointError as e:
+            if on_skip is not None:
+                on_skip(e)
@@ -0,0 +1,584 @@
+from array import array
+from collections import deque
+from datetime import datetime, timezone
+from itertools import accumulate
+import math
+import pickle
+import struct
+import sys
+import tempfile
+import threading
+import time
+import traceback
+from typing import Iterator
+
+from flask import Flask
+import ijson
+from psycopg2.extras import execute_values
+from sqlalchemy import Date, cast, text
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+from .config import Config
+from .database import raw_cursor
+from .extensions import db
+from .metrics import INGEST_POINTS, INGEST_POINTS_RECEIVED, record_query
+from .partitioning import ensure_partitions
+from .response_cache import data_changed
+from .models import LATITUDE_SQL, LONGITUDE_SQL, AdditionalTrace, DailyStatisticDirty, GPSData, stored_rows
+
+
+# Column order of the tuples produced by the parse_* helpers and consumed by insert_points
+GPS_COLUMNS = (
+    "user_id", "trace_id", "import_id", "timestamp", "latitude", "longitude",
+    "horizontal_accuracy", "altitude", "vertical_accuracy", "heading",
+    "heading_accuracy", "speed", "speed_accuracy", "reverse_geocoded",
+)
+
+# Rows per INSERT statement. Large batches are split into statements of this size.
+INSERT_PAGE_SIZE = 5000
+
+
+class InvalidPointError(ValueError):
+    """Raised when an entry of an ingest payload cannot be turned into a row."""
+
+
+class IngestTimeoutError(Exception):
+    """Raised when queued rows are not committed within INGEST_ACK_TIMEOUT. They may still be."""
+
+
+def owner_ids(user, trace) -> tuple[str, str]:
+    """Return the (user_id, trace_id) pair a new point is stored under."""
+    if trace:
+        return None, str(trace.id)
+    return str(user.id), None
+
+
+def user_owner_ids(user) -> list:
+    """The owner_id of the user's own points, followed by those of each of their additional traces."""
+    return [user.id] + [trace.id for trace in AdditionalTrace.query.filter_by(owner_id=user.id).all()]
+
+
+def optional_float(value, digits=8):
+    if value is None:
+        return None
+    return round(float(value), digits)
+
+
+def parse_batch_entry(entry: dict, user_id, trace_id, import_id=None) -> tuple:
+    """Turn one entry of a /gps/batch payload into a row tuple."""
+    ts_str = entry.get("timestamp")
+    try:
+        ts = datetime.fromtimestamp(int(ts_str), tz=datetime.now().astimezone().tzinfo)
+    except:
+        ts = datetime.now()  # fallback if parse fails
+
+    try:
+        return (
+            user_id, trace_id, import_id, ts,
+            round(float(entry["latitude"]), 8),
+            round(float(entry["longitude"]), 8),
+            optional_float(entry.get("horizontal_accuracy")),
+            optional_float(entry.get("altitude")),
+            optional_float(entry.get("vertical_accuracy")),
+            optional_float(entry.get("heading")),
+            optional_float(entry.get("heading_accuracy")),
+            optional_float(entry.get("speed")),
+            optional_float(entry.get("speed_accuracy")),
+            False,
+        )
+    except (KeyError, TypeError, ValueError, AttributeError) as e:
+        raise InvalidPointError(f"Invalid GPS entry: {e}")
+
+
+def parse_overland_feature(feature: dict, user_id, trace_id) -> tuple:
+    """Turn one Overland GeoJSON feature into a row tuple, or None if it is not a point feature."""
+    if not isinstance(feature, dict) or feature.get("type") != "Feature":
+        return None
+
+    geometry = feature.get("geometry") or {}
+    properties = feature.get("properties") or {}
+
+    # Ensure geometry is a "Point" with [longitude, latitude]
+    coords = geometry.get("coordinates") or []
+    if len(coords) != 2 or geometry.get("type") != "Point":
+        return None
+
+    ts_str = properties.get("timestamp")
+    try:
+        ts = datetime.fromisoformat(ts_str) # e.g. "2025-04-19T20:12:44Z"
+    except Exception:
+        ts = datetime.now()
+
+    try:
+        return (
+            user_id, trace_id, None, ts,
+            float(coords[1]),
+            float(coords[0]),
+            optional_float(properties.get("horizontal_accuracy")),
+            optional_float(properties.get("altitude")),
+            optional_float(properties.get("vertical_accuracy")),
+            optional_float(properties.get("course")),  # "course" is equivalent to heading
+            optional_float(properties.get("course_accuracy")),
+            optional_float(properties.get("speed")),
+            optional_float(properties.get("speed_accuracy")),
+            False,
+        )
+    except (TypeError, ValueError) as e:
+        raise InvalidPointError(f"Invalid Overland feature: {e}")
+
+
+def parse_owntracks(data: dict, user_id, trace_id) -> tuple:
+    """Turn an OwnTracks location message into a row tuple."""
+    # The OwnTracks payload uses epoch timestamps in "tst" and lat/lon in "lat"/"lon"
+    try:
+        ts = datetime.fromtimestamp(int(data["tst"]), tz=datetime.now().astimezone().tzinfo)
+    except:
+        ts = datetime.now()
+
+    # Heading / speed and their accuracies are not part of the location message
+    try:
+        return (
+            user_id, trace_id, None, ts,
+            float(data["lat"]),
+            float(data["lon"]),
+            optional_float(data.get("acc")),
+            optional_float(data.get("alt")),
+            optional_float(data.get("vac")),
+            None, None, None, None,
+            False,
+        )
+    except (KeyError, TypeError, ValueError) as e:
+        raise InvalidPointError(f"Invalid OwnTracks message: {e}")
+
+
+def parse_import_entry(entry: dict, user_id, trace_id, import_id) -> tuple:
+    """Turn one entry of an import file into a row tuple."""
+    ts_str = entry.get("timestamp")
+    try:
+        ts = datetime.fromisoformat(ts_str)  # Parse timestamp as ISO 8601
+    except Exception as e:
+        print(f"Error parsing timestamp {ts_str}: {e}")
+        ts = datetime.now()  # Fallback to current timestamp
+
+    try:
+        return (
+            user_id, trace_id, import_id, ts,
+            float(entry["latitude"]),
+            float(entry["longitude"]),
+            optional_float(entry.get("horizontal_accuracy")),
+            optional_float(entry.get("altitude")),
+            optional_float(entry.get("vertical_accuracy")),
+            optional_float(entry.get("heading")),
+            optional_float(entry.get("heading_accuracy")),
+            optional_float(entry.get("speed")),
+            optional_float(entry.get("speed_accuracy")),
+            False,
+        )
+    except (KeyError, TypeError, ValueError, AttributeError) as e:
+        raise InvalidPointError(f"Invalid import entry: {e}")
+
+
+# Binary batch format (all values little-endian):
+#   header   "WPDB", u8 version, u8 column flags, u16 reserved, u32 count, i64 base timestamp (epoch s)
+#   int32[count]    timestamp deltas in seconds, the first relative to the base timestamp
+#   int32[count]    latitudes in degrees * 1e7
+#   int32[count]    longitudes in degrees * 1e7
+#   float32[count]  one column per bit set in the flags, in BINARY_OPTIONAL_COLUMNS order, NaN = null
+BINARY_MAGIC = b"WPDB"
+BINARY_VERSION = 1
+BINARY_HEADER = struct.Struct("<4sBBHIq")
+BINARY_COORD_SCALE = 1e7
+BINARY_OPTIONAL_COLUMNS = (
+    "horizontal_accuracy", "altitude", "vertical_accuracy", "heading",
+    "heading_accuracy", "speed", "speed_accuracy",
+)
+
+
+def _read_column(data: bytes, offset: int, typecode: str, count: int) -> tuple[array, int]:
+    column = array(typecode)
+    end = offset + column.itemsize * count
+    if end > len(data):
+        raise ValueError("Data ends inside a column")
+    column.frombytes(data[offset:end])
+    if sys.byteorder != "little":
+        column.byteswap()
+    return column, end
+
+
+def decode_binary_batch(data: bytes, user_id, trace_id) -> list[tuple]:
+    """Decode a columnar binary batch (see BINARY_HEADER) into row tuples."""
+    if len(data) < BINARY_HEADER.size:
+        raise InvalidPointError("Binary batch is shorter than its header")
+
+    magic, version, flags, _, count, base_ts = BINARY_HEADER.unpack_from(data)
+    if magic != BINARY_MAGIC or version != BINARY_VERSION:
+        raise InvalidPointError("Unknown binary batch format")
+
+    optional = [i for i in range(len(BINARY_OPTIONAL_COLUMNS)) if flags & (1 << i)]
+    expected = BINARY_HEADER.size + count * 4 * (3 + len(optional))
+    if len(data) != expected:
+        raise InvalidPointError(f"Binary batch should be {expected} bytes for {count} points, got {len(data)}")
+
+    offset = BINARY_HEADER.size
+    deltas, offset = _read_column(data, offset, "i", count)
+    lats, offset = _read_column(data, offset, "i", count)
+    lons, offset = _read_column(data, offset, "i", count)
+    if count and (
+        max(lats) > 90 * BINARY_COORD_SCALE or min(lats) < -90 * BINARY_COORD_SCALE
+        or max(lons) > 180 * BINARY_COORD_SCALE or min(lons) < -180 * BINARY_COORD_SCALE
+    ):
+        raise InvalidPointError("Coordinates out of range in binary batch")
+
+    columns = [[None] * count for _ in BINARY_OPTIONAL_COLUMNS]
+    for i in optional:
+        values, offset = _read_column(data, offset, "f", count)
+        columns[i] = [None if math.isnan(v) else round(v, 8) for v in values]
+
+    timestamps = accumulate(deltas, initial=base_ts)
+    next(timestamps)  # skip the base itself
+
+    try:
+        return [
+            (
+                user_id, trace_id, None, datetime.fromtimestamp(ts, tz=timezone.utc),
+                lat / BINARY_COORD_SCALE, lon / BINARY_COORD_SCALE,
+                *optional_values,
+                False,
+            )
+            for ts, lat, lon, *optional_values in zip(timestamps, lats, lons, *columns)
+        ]
+    except (OverflowError, OSError, ValueError) as e:
+        raise InvalidPointError(f"Invalid timestamp in binary batch: {e}")
+
+
+def iter_row_chunks(stream, key: str, parse, *args, chunk_size: int = None):
+    """
+    Incrementally parse the list under ``key`` of a JSON document read from ``stream`` and
+    yield lists of at most ``chunk_size`` row tuples built by ``parse(entry, *args)``.
+    Only one chunk of entries is held in memory at a time, however large the payload is.
+    Entries for which ``parse`` returns None are skipped.
+    """
+    chunk_size = chunk_size or Config.INGEST_CHUNK_SIZE
+    seen = False
+    rows = []
+    try:
+        for entry in ijson.items(stream, f"{key}.item", use_float=True):
+            seen = True
+            row = parse(entry, *args)
+            if row is not None:
+                rows.append(row)
+
+            if len(rows) >= chunk_size:
+                yield rows
+                rows = []
+    except ijson.JSONError as e:
+        raise InvalidPointError(f"Invalid JSON: {e}")
+
+    if not seen:
+        raise InvalidPointError(f"Invalid data format: '{key}' should be a non-empty list")
+
+    if rows:
+        yield rows
+
+
+def spooled_row_chunks(stream, key: str, parse, *args, chunk_size: int = None) -> Iterator[list[tuple]]:
+    """
+    Like iter_row_chunks, but the whole document is parsed and validated before this returns,
+    so an invalid entry anywhere rejects the request before any of it is written. The chunks
+    wait in a temporary file that stays in memory up to INGEST_SPOOL_MEMORY bytes.
+    """
+    spool = tempfile.SpooledTemporaryFile(max_size=Config.INGEST_SPOOL_MEMORY)
+    count = 0
+    try:
+        for rows in iter_row_chunks(stream, key, parse, *args, chunk_size=chunk_size):
+            pickle.dump(rows, spool, protocol=pickle.HIGHEST_PROTOCOL)
+            count += 1
+    except BaseException:
+        spool.close()
+        raise
+    spool.seek(0)
+
+    def chunks():
+        with spool:
+            for _ in range(count):
+                yield pickle.load(spool)
+
+    return chunks()
+
+
+def insert_points(rows: list[tuple]) -> int:
+    """
+    Write row tuples (see GPS_COLUMNS) to gps_data using multi-row INSERT statements
+    on the current session's connection. The caller is responsible for committing.
+
+    Points that already exist for the same owner, timestamp and position are skipped,
+    so retried uploads do not create duplicates. The days of newly written points are
+    marked for a statistics update in the same statement, and points written without a
+    speed get one derived from their predecessor. Returns the number of rows written.
+    """
+    if not rows:
+        return 0
+
+    if Config.GPS_DATA_PARTITIONING:
+        ensure_partitions({row[3] for row in rows})
+
+    columns, rows = stored_rows(GPS_COLUMNS, rows)
+    sql = f"""
+        WITH inserted AS (
+            INSERT INTO gps_data ({', '.join(columns)}) VALUES %s
+            ON CONFLICT DO NOTHING
+            RETURNING user_id, trace_id, owner_id, timestamp, speed
+        ), dirty AS (
+            INSERT INTO daily_statistic_dirty (user_id, trace_id, day)
+            SELECT DISTINCT user_id, trace_id, timestamp::date FROM inserted
+            ON CONFLICT DO NOTHING
+        )
+        SELECT
+            owner_id,
+            COUNT(*),
+            MIN(timestamp) FILTER (WHERE speed IS NULL OR speed <= 0),
+            MAX(timestamp) FILTER (WHERE speed IS NULL OR speed <= 0)
+        FROM inserted
+        GROUP BY 1
+    """
+
+    inserted = 0
+    missing_speed = []
+    cursor = raw_cursor()
+    try:
+        for i in range(0, len(rows), INSERT_PAGE_SIZE):
+            page = rows[i:i + INSERT_PAGE_SIZE]
+            # raw cursors bypass the SQLAlchemy events, so time the statement here
+            query_start = time.perf_counter()
+            result = execute_values(cursor, sql, page, page_size=len(page), fetch=True)
+            record_query(time.perf_counter() - query_start)
+            data_changed(owner_id for owner_id, _, _, _ in result)
+            for owner_id, count, start, end in result:
+                inserted += count
+                if start is not None:
+                    missing_speed.append((owner_id, start, end))
+    finally:
+        cursor.close()
+
+    INGEST_POINTS_RECEIVED.inc(len(rows))
+    INGEST_POINTS.inc(inserted)
+
+    for owner_id, start, end in missing_speed:
+        derive_speeds(owner_id, start, end)
+
+    return inserted
+
+
+# Great-circle speed of each point relative to the owner's previous point, for points in
+# [:start, :end] without a speed. The window starts at the last point before :start.
+DERIVE_SPEEDS_SQL = text(f"""
+    UPDATE gps_data AS p
+    SET speed = s.derived_speed
+    FROM (
+        SELECT id,
+            2 * 6371000 * ASIN(LEAST(1, SQRT(
+                POWER(SIN(RADIANS(latitude - prev_lat) / 2), 2)
+                + COS(RADIANS(prev_lat)) * COS(RADIANS(latitude)) * POWER(SIN(RADIANS(longitude - prev_lng) / 2), 2)
+            ))) / EXTRACT(EPOCH FROM timestamp - prev_ts)::float8 AS derived_speed
+        FROM (
+            SELECT id, timestamp, {LATITUDE_SQL} AS latitude, {LONGITUDE_SQL} AS longitude, speed,
+                LAG({LATITUDE_SQL}) OVER w AS prev_lat,
+                LAG({LONGITUDE_SQL}) OVER w AS prev_lng,
+                LAG(timestamp) OVER w AS prev_ts
+            FROM gps_data
+            WHERE owner_id = :owner_id
+              AND timestamp >= COALESCE((
+                  SELECT MAX(timestamp) FROM gps_data
+                  WHERE owner_id = :owner_id AND timestamp < :start
+              ), :start)
+              AND timestamp <= :end
+            WINDOW w AS (ORDER BY timestamp)
+        ) AS pairs
+        WHERE prev_ts IS NOT NULL
+          AND timestamp > prev_ts
+          AND (speed IS NULL OR speed <= 0)
+    ) AS s
+    WHERE p.id = s.id
+""")
+
+
+def derive_speeds(owner_id, start: datetime, end: datetime) -> int:
+    """
+    Fill in the speed of an owner's points between ``start`` and ``end`` that have none,
+    using the distance and time to the previous point. The caller is responsible for committing.
+    Returns the number of points updated.
+    """
+    result = db.session.execute(DERIVE_SPEEDS_SQL, {"owner_id": owner_id, "start": start, "end": end})
+    if result.rowcount:
+        data_changed([owner_id])
+    return result.rowcount
+
+
+def mark_days_dirty(days):
+    """Mark (user_id, trace_id, date) triples for a statistics update. The caller is responsible for committing."""
+    if not days:
+        return
+
+    data_changed({trace_id or user_id for user_id, trace_id, _ in days})
+    db.session.execute(
+        pg_insert(DailyStatisticDirty)
+        .values([{"user_id": user_id, "trace_id": trace_id, "day": day} for user_id, trace_id, day in set(days)])
+        .on_conflict_do_nothing()
+    )
+
+
+def mark_days_dirty_for(query):
+    """Mark the days of all GPSData rows matched by ``query`` for a statistics update, e.g. before deleting them."""
+    data_changed(owner_id for (owner_id,) in query.with_entities(GPSData.owner_id).distinct())
+    days = query.with_entities(GPSData.user_id, GPSData.trace_id, cast(GPSData.timestamp, Date)).distinct()
+    db.session.execute(
+        pg_insert(DailyStatisticDirty)
+        .from_select(["user_id", "trace_id", "day"], days.statement)
+        .on_conflict_do_nothing()
+    )
+
+
+class _PendingBatch:
+    def __init__(self, rows: list[tuple], wait: bool):
+        self.rows = rows
+        self.done = threading.Event() if wait else None
+        self.error: Exception = None
+
+
+class IngestQueue:
+    """
+    Optional write-behind buffer for the ingest endpoints.
+
+    Endpoints hand their rows to submit(). While the flusher thread is running, rows are
+    queued and written by a single group commit every INGEST_FLUSH_INTERVAL_MS or as soon as
+    INGEST_FLUSH_ROWS are pending. With INGEST_ACK_MODE=commit, submit() returns once the rows
+    are committed, raises the flusher's exception if they could not be, or IngestTimeoutError
+    after INGEST_ACK_TIMEOUT; with INGEST_ACK_MODE=enqueue it returns as soon as they are queued.
+    If the queue is disabled, stopped or full, rows are written synchronously instead.
+    """
+
+    def __init__(self):
+        self.config = Config
+        self.web_app: Flask = None
+        self.thread: threading.Thread = None
+        self.batches: deque[_PendingBatch] = deque()
+        self.pending_rows = 0
+        self.condition = threading.Condition()
+
+        self.running = False
+        self.stop_requested = False
+
+    def set_config(self, config: Config):
+        self.config = config
+
+    def set_web_app(self, app: Flask):
+        self.web_app = app
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.run)
+        self.thread.start()
+
+    def submit(self, rows: list[tuple]):
+        """Store rows, either through the queue or directly in the current session."""
+        self.submit_chunks([rows])
+
+    def submit_chunks(self, chunks):
+        """
+        Store the row chunks of one request. All of them are queued before waiting, so the
+        request waits for one group commit instead of one per chunk.
+        """
+        batches = []
+        direct = False
+        for rows in chunks:
+            if not rows:
+                continue
+
+            batch = _PendingBatch(rows, wait=self.config.INGEST_ACK_MODE != "enqueue")
+            with self.condition:
+                queued = (
+                    self.running and not self.stop_requested
+                    and self.pending_rows + len(rows) <= self.config.INGEST_QUEUE_SIZE
+                )
+                if queued:
+                    self.batches.append(batch)
+                    self.pending_rows += len(rows)
+                    if self.pending_rows >= self.config.INGEST_FLUSH_ROWS:
+                        self.condition.notify()
+
+            if queued:
+                batches.append(batch)
+            else:
+                insert_points(rows)
+                direct = True
+
+        if direct:
+            db.session.commit()
+
+        deadline = time.monotonic() + self.config.INGEST_ACK_TIMEOUT
+        for batch in batches:
+            if batch.done:
+                if not batch.done.wait(max(deadline - time.monotonic(), 0)):
+                    raise IngestTimeoutError("GPS data could not be stored in time, try again later")
+                if batch.error:
+                    raise batch.error
+
+    def run(self):
+        interval = self.config.INGEST_FLUSH_INTERVAL_MS / 1000
+        while True:
+            with self.condition:
+                if self.stop_requested and not self.batches:
+                    break
+
+                if not self.stop_requested and self.pending_rows < self.config.INGEST_FLUSH_ROWS:
+                    self.condition.wait(timeout=interval)
+
+                batches = list(self.batches)
+                self.batches.clear()
+                self.pending_rows = 0
+
+            if batches:
+                self.flush(batches)
+
+        self.running = False
+
+    def flush(self, batches: list[_PendingBatch]):
+        try:
+            with self.web_app.app_context():
+                try:
+                    insert_points([row for batch in batches for row in batch.rows])
+                    db.session.commit()
+                except Exception:
+                    print(traceback.format_exc())
+                    db.session.rollback()
+
+                    # retry one request at a time so a single bad batch does not drop the others
+                    for batch in batches:
+                        try:
+                            insert_points(batch.rows)
+                            db.session.commit()
+                        except Exception as e:
+                            print(traceback.format_exc())
+                            db.session.rollback()
+                            batch.error = e
+        except Exception as e:
+            # waiting requests get the error instead of waiting for their timeout
+            print(traceback.format_exc())
+            for batch in batches:
+                batch.error = batch.error or e
+        finally:
+            for batch in batches:
+                if batch.done:
+                    batch.done.set()
+
+    def stop(self, blocking=False):
+        """Stop accepting rows and write everything that is still queued."""
+        with self.condition:
+            self.stop_requested = True
+            self.condition.notify()
+
+        if blocking and self.thread:
+            self.thread.join()
+
+
+ingest_queue = IngestQueue()
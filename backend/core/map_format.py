@@ -0,0 +1,141 @@
+"""
+Compact columnar format of the map data, the binary alternative to the JSON of MapView.post.
+
+Clients ask for it with ``Accept: application/vnd.waypointdb.map``. Every column is a
+little-endian typed array aligned to 4 bytes, so a browser reads it with Int32Array and
+Float32Array views on the response buffer instead of JSON.parse. Layout:
+
+  header          see MAP_HEADER: "WPDM", u8 version, u8 column flags, u16 reserved,
+                  u32 point count, i64 base timestamp (epoch seconds), u32 dictionary length
+  dictionary      JSON list of the user ids, padded with spaces to a multiple of 4 bytes
+  int32[count]    id deltas
+  int32[count]    timestamp deltas in seconds, the first relative to the base timestamp
+  int32[count]    latitude deltas in degrees * 1e7
+  int32[count]    longitude deltas in degrees * 1e7
+  uint32[count]   user id, 1-based index into the dictionary, 0 = null
+  float32[count]  one column per bit set in the flags, in BINARY_OPTIONAL_COLUMNS order, NaN = null
+
+Deltas wrap around like int32 arithmetic, ``value = (value + delta) | 0`` in JavaScript.
+Columns that are null for every point are left out and their flag bit is not set.
+``decode_map_rows`` is the reference decoder, the map page has its own in map.jinja.
+"""
+from datetime import datetime, timezone
+from itertools import accumulate
+import json
+import math
+import struct
+import sys
+from array import array
+
+from .ingest import BINARY_COORD_SCALE, BINARY_OPTIONAL_COLUMNS, _read_column
+
+
+MAP_MIMETYPE = "application/vnd.waypointdb.map"
+MAP_MAGIC = b"WPDM"
+MAP_VERSION = 1
+MAP_HEADER = struct.Struct("<4sBBHIqI")
+
+# position of the optional columns in the rows of MapView.post, see map_row
+ROW_OPTIONAL_COLUMNS = dict(zip(BINARY_OPTIONAL_COLUMNS, range(5, 12)))
+
+
+def _column_bytes(column: array) -> bytes:
+    if sys.byteorder != "little":
+        column = array(column.typecode, column)
+        column.byteswap()
+    return column.tobytes()
+
+
+def _int32_deltas(values: list[int]) -> array:
+    return array("i", [(b - a + 2 ** 31) % 2 ** 32 - 2 ** 31 for a, b in zip([0] + values, values)])
+
+
+def encode_map_rows(rows: list[tuple]) -> bytes:
+    """Encode map rows (see map_row, sorted by timestamp) in the compact format."""
+    count = len(rows)
+    timestamps = [math.floor(row[2].timestamp()) for row in rows]
+    base_timestamp = timestamps[0] if rows else 0
+
+    dictionary, indexes = [], {}
+    user_ids = array("I")
+    for row in rows:
+        if row[1] is None:
+            user_ids.append(0)
+            continue
+        user_id = str(row[1])
+        if user_id not in indexes:
+            dictionary.append(user_id)
+            indexes[user_id] = len(dictionary)
+        user_ids.append(indexes[user_id])
+
+    flags = 0
+    optional = []
+    for bit, name in enumerate(BINARY_OPTIONAL_COLUMNS):
+        values = [row[ROW_OPTIONAL_COLUMNS[name]] for row in rows]
+        if any(value is not None for value in values):
+            flags |= 1 << bit
+            optional.append(array("f", (math.nan if value is None else value for value in values)))
+
+    dictionary = json.dumps(dictionary, separators=(",", ":")).encode()
+    dictionary += b" " * (-len(dictionary) % 4)
+
+    payload = bytearray(MAP_HEADER.pack(MAP_MAGIC, MAP_VERSION, flags, 0, count, base_timestamp, len(dictionary)))
+    payload += dictionary
+    payload += _column_bytes(_int32_deltas([row[0] for row in rows]))
+    payload += _column_bytes(array("i", [b - a for a, b in zip([base_timestamp] + timestamps, timestamps)]))
+    payload += _column_bytes(_int32_deltas([round(row[3] * BINARY_COORD_SCALE) for row in rows]))
+    payload += _column_bytes(_int32_deltas([round(row[4] * BINARY_COORD_SCALE) for row in rows]))
+    payload += _column_bytes(user_ids)
+    for column in optional:
+        payload += _column_bytes(column)
+    return bytes(payload)
+
+
+def _int32_sums(deltas: array) -> list[int]:
+    return [(value + 2 ** 31) % 2 ** 32 - 2 ** 31 for value in accumulate(deltas)]
+
+
+def decode_map_rows(data: bytes) -> list[tuple]:
+    """Decode the compact format back into map rows. Broken data raises ValueError."""
+    if len(data) < MAP_HEADER.size:
+        raise ValueError("Map data is shorter than its header")
+
+    magic, version, flags, _, count, base_timestamp, dictionary_length = MAP_HEADER.unpack_from(data)
+    if magic != MAP_MAGIC or version != MAP_VERSION:
+        raise ValueError("Unknown map data format")
+
+    offset = MAP_HEADER.size
+    if offset + dictionary_length > len(data):
+        raise ValueError("Data ends inside the map dictionary")
+    dictionary = [None] + json.loads(data[offset:offset + dictionary_length])
+    offset += dictionary_length
+
+    ids, offset = _read_column(data, offset, "i", count)
+    time_deltas, offset = _read_column(data, offset, "i", count)
+    lats, offset = _read_column(data, offset, "i", count)
+    lons, offset = _read_column(data, offset, "i", count)
+    user_ids, offset = _read_column(data, offset, "I", count)
+
+    optional = {}
+    for bit, name in enumerate(BINARY_OPTIONAL_COLUMNS):
+        if flags & (1 << bit):
+            values, offset = _read_column(data, offset, "f", count)
+            optional[name] = [None if math.isnan(value) else value for value in values]
+        else:
+            optional[name] = [None] * count
+    if offset != len(data):
+        raise ValueError("Map data has trailing bytes")
+
+    timestamps = accumulate(time_deltas, initial=base_timestamp)
+    next(timestamps)  # skip the base itself
+
+    return [
+        (
+            point_id, dictionary[user_index], datetime.fromtimestamp(ts, tz=timezone.utc),
+            lat / BINARY_COORD_SCALE, lon / BINARY_COORD_SCALE, *optional_values,
+        )
+        for point_id, user_index, ts, lat, lon, *optional_values in zip(
+            _int32_sums(ids), user_ids, timestamps, _int32_sums(lats), _int32_sums(lons),
+            *(optional[name] for name in ROW_OPTIONAL_COLUMNS),
+        )
+    ]
@@ -0,0 +1,172 @@
+from collections import defaultdict
+import threading
+import time
+
+from flask import Flask, g, has_request_context, request
+from prometheus_client import CollectorRegistry, Counter, Histogram
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+from sqlalchemy import event
+from sqlalchemy.pool import QueuePool
+
+
+registry = CollectorRegistry()
+
+REQUEST_SECONDS = Histogram(
+    "waypointdb_request_seconds", "Request latency by endpoint",
+    ["endpoint", "method", "status"], registry=registry,
+)
+REQUEST_SQL_QUERIES = Histogram(
+    "waypointdb_request_sql_queries", "SQL queries executed per request",
+    ["endpoint"], buckets=(0, 1, 2, 5, 10, 20, 50, 100, 500, 1000), registry=registry,
+)
+REQUEST_SQL_SECONDS = Histogram(
+    "waypointdb_request_sql_seconds", "Time spent in SQL per request",
+    ["endpoint"], registry=registry,
+)
+SQL_QUERIES = Counter(
+    "waypointdb_sql_queries_total", "SQL queries executed, by request or background context",
+    ["context"], registry=registry,
+)
+SQL_SECONDS = Counter(
+    "waypointdb_sql_seconds_total", "Time spent in SQL, by request or background context",
+    ["context"], registry=registry,
+)
+INGEST_POINTS = Counter(
+    "waypointdb_ingest_points_total", "GPS points written to gps_data (duplicates excluded)",
+    registry=registry,
+)
+INGEST_POINTS_RECEIVED = Counter(
+    "waypointdb_ingest_points_received_total", "GPS points handed to insert_points",
+    registry=registry,
+)
+JOB_ROWS = Counter(
+    "waypointdb_job_rows_total", "Rows processed by finished background jobs",
+    ["job"], registry=registry,
+)
+JOB_SECONDS = Histogram(
+    "waypointdb_job_seconds", "Run time of finished background jobs",
+    ["job"], buckets=(0.1, 1, 10, 60, 300, 900, 3600, 4 * 3600, 24 * 3600), registry=registry,
+)
+
+_cache_lookups: dict[tuple[str, str], int] = defaultdict(int)
+_cache_lookups_lock = threading.Lock()
+
+
+def cache_lookup(cache: str, hit: bool):
+    """Count a lookup in a plain dict cache. TTLCache instances count their own lookups."""
+    with _cache_lookups_lock:
+        _cache_lookups[(cache, "hit" if hit else "miss")] += 1
+
+
+def record_query(seconds: float):
+    """Account for one SQL statement, also for raw cursors that bypass SQLAlchemy."""
+    context = "request" if has_request_context() else "background"
+    SQL_QUERIES.labels(context=context).inc()
+    SQL_SECONDS.labels(context=context).inc(seconds)
+
+    if has_request_context():
+        g.metrics_sql_queries = g.get("metrics_sql_queries", 0) + 1
+        g.metrics_sql_seconds = g.get("metrics_sql_seconds", 0.0) + seconds
+
+
+class StateCollector:
+    """Exposes the job manager and cache state at scrape time."""
+
+    def __init__(self):
+        self.job_manager = None
+        self.ttl_caches = {}
+        self.engines = {}
+
+    def collect(self):
+        if self.job_manager is not None:
+            queued = GaugeMetricFamily("waypointdb_jobs_queued", "Jobs waiting in the job manager queue")
+            queued.add_metric([], len(self.job_manager.queued_jobs))
+            yield queued
+
+            running = GaugeMetricFamily("waypointdb_jobs_running", "Running jobs by type", labels=["job"])
+            rows_per_second = GaugeMetricFamily(
+                "waypointdb_job_rows_per_second", "Throughput of running jobs", labels=["job", "id"]
+            )
+            counts = {}
+            for job in list(self.job_manager.running_jobs):
+                name = job.__class__.__name__
+                counts[name] = counts.get(name, 0) + 1
+                if job.start_time:
+                    elapsed = max(time.time() - job.start_time, 1e-3)
+                    rows_per_second.add_metric([name, job.id], job.rows_processed / elapsed)
+            for name, count in counts.items():
+                running.add_metric([name], count)
+            yield running
+            yield rows_per_second
+
+        if self.engines:
+            connections = GaugeMetricFamily(
+                "waypointdb_db_pool_connections", "Connections of the database pools", labels=["database", "state"]
+            )
+            size = GaugeMetricFamily("waypointdb_db_pool_size", "Connections the database pools keep open", labels=["database"])
+            # negative while a pool has not opened pool_size connections yet
+            overflow = GaugeMetricFamily("waypointdb_db_pool_overflow", "Connections opened beyond the pool size", labels=["database"])
+            for name, engine in self.engines.items():
+                pool = engine.pool
+                if not isinstance(pool, QueuePool):
+                    continue
+                connections.add_metric([name, "checked_out"], pool.checkedout())
+                connections.add_metric([name, "idle"], pool.checkedin())
+                size.add_metric([name], pool.size())
+                overflow.add_metric([name], pool.overflow())
+            yield connections
+            yield size
+            yield overflow
+
+        lookups = CounterMetricFamily("waypointdb_cache_requests", "Lookups in in-process caches", labels=["cache", "result"])
+        with _cache_lookups_lock:
+            for (name, result), count in _cache_lookups.items():
+                lookups.add_metric([name, result], count)
+        for name, cache in self.ttl_caches.items():
+            lookups.add_metric([name, "hit"], cache.hits)
+            lookups.add_metric([name, "miss"], cache.misses)
+        yield lookups
+
+
+state_collector = StateCollector()
+registry.register(state_collector)
+
+
+def _before_request():
+    g.metrics_start = time.perf_counter()
+
+
+def _after_request(response):
+    start = g.get("metrics_start")
+    if start is None:
+        return response
+
+    endpoint = request.endpoint or "unknown"
+    REQUEST_SECONDS.labels(endpoint=endpoint, method=request.method, status=response.status_code).observe(
+        time.perf_counter() - start
+    )
+    REQUEST_SQL_QUERIES.labels(endpoint=endpoint).observe(g.get("metrics_sql_queries", 0))
+    REQUEST_SQL_SECONDS.labels(endpoint=endpoint).observe(g.get("metrics_sql_seconds", 0.0))
+    return response
+
+
+# the start time lives on the execution context, so a failed statement leaves nothing behind
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if context is not None:
+        context.metrics_query_start = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    start = getattr(context, "metrics_query_start", None)
+    if start is not None:
+        record_query(time.perf_counter() - start)
+
+
+def init_metrics(app: Flask, engines: dict):
+    """Instrument the app's requests and the SQLAlchemy engines (by bind key, None is the primary)."""
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+    for bind_key, engine in engines.items():
+        state_collector.engines[bind_key or "primary"] = engine
+        event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+        event.listen(engine, "after_cursor_execute", _after_cursor_execute)
@@ -0,0 +1,111 @@
+import gzip
+import io
+import zlib
+
+import zstandard
+from werkzeug.exceptions import RequestEntityTooLarge, UnsupportedMediaType
+from werkzeug.wsgi import LimitedStream
+
+
+class _DeflateReader(io.RawIOBase):
+    """Readable stream of a zlib-wrapped (or raw) deflate body."""
+
+    def __init__(self, stream, chunk_size=64 * 1024):
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.decompressor = None
+        self.eof = False
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        size = len(buffer)
+        while not self.eof:
+            if self.decompressor is not None and self.decompressor.unconsumed_tail:
+                data = self.decompressor.decompress(self.decompressor.unconsumed_tail, size)
+            else:
+                compressed = self.stream.read(self.chunk_size)
+                if not compressed:
+                    data = self.decompressor.flush() if self.decompressor else b""
+                    self.eof = True
+                else:
+                    if self.decompressor is None:
+                        # some clients send raw deflate, a zlib header always starts with 0x78
+                        wbits = zlib.MAX_WBITS if compressed[0] == 0x78 else -zlib.MAX_WBITS
+                        self.decompressor = zlib.decompressobj(wbits)
+                    data = self.decompressor.decompress(compressed, size)
+
+            if data:
+                buffer[:len(data)] = data
+                return len(data)
+
+        return 0
+
+
+class _SizeLimitedReader(io.RawIOBase):
+    """Wrap a decompressing reader and abort once more than ``max_size`` bytes were produced."""
+
+    def __init__(self, reader, max_size: int):
+        self.reader = reader
+        self.max_size = max_size
+        self.total = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self.reader.read(len(buffer))
+        self.total += len(data)
+        if self.total > self.max_size:
+            raise RequestEntityTooLarge("Decompressed request body is too large")
+
+        buffer[:len(data)] = data
+        return len(data)
+
+
+class DecompressRequestMiddleware:
+    """
+    WSGI middleware that transparently decompresses ``Content-Encoding: gzip``,
+    ``deflate`` and ``zstd`` request bodies for paths starting with ``path_prefix``.
+
+    The body is decompressed lazily while the view reads it, so streaming parsers still
+    see constant memory use, and reading stops with a 413 once ``max_size`` bytes of
+    decompressed data were produced.
+    """
+
+    def __init__(self, app, path_prefix: str, max_size: int):
+        self.app = app
+        self.path_prefix = path_prefix
+        self.max_size = max_size
+
+    def open_reader(self, encoding: str, stream):
+        if encoding in ("gzip", "x-gzip"):
+            return gzip.GzipFile(fileobj=stream, mode="rb")
+        if encoding == "deflate":
+            return _DeflateReader(stream)
+        if encoding == "zstd":
+            return zstandard.ZstdDecompressor().stream_reader(stream, read_across_frames=True)
+        return None
+
+    def __call__(self, environ, start_response):
+        encoding = environ.get("HTTP_CONTENT_ENCODING", "").strip().lower()
+        if not encoding or encoding == "identity" or not environ.get("PATH_INFO", "").startswith(self.path_prefix):
+            return self.app(environ, start_response)
+
+        stream = environ["wsgi.input"]
+        content_length = environ.get("CONTENT_LENGTH")
+        if content_length:
+            stream = LimitedStream(stream, int(content_length))
+
+        reader = self.open_reader(encoding, stream)
+        if reader is None:
+            return UnsupportedMediaType(f"Unsupported Content-Encoding: {encoding}")(environ, start_response)
+
+        # The decompressed length is unknown, so let the request read until the end of the stream
+        environ["wsgi.input"] = io.BufferedReader(_SizeLimitedReader(reader, self.max_size))
+        environ["wsgi.input_terminated"] = True
+        environ.pop("CONTENT_LENGTH", None)
+        environ.pop("HTTP_CONTENT_ENCODING", None)
+
+        return self.app(environ, start_response)
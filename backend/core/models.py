@@ -2,19 +2,22 @@ from dataclasses import dataclass, field
 from datetime import datetime, timezone
 import uuid
 from werkzeug.security import generate_password_hash, check_password_hash
+from .config import Config
 from .extensions import db
-from sqlalchemy.dialects.postgresql import UUID, JSON
+from sqlalchemy import REAL, Float, cast, func
+from sqlalchemy.ext.hybrid import hybrid_property
+from sqlalchemy.dialects.postgresql import ARRAY, UUID, JSON
 from sqlalchemy.ext.mutable import MutableList
 
 class User(db.Model):
-    """Simple User model with is_admin boolean and a single API key."""
+    """Simple User model with is_admin boolean. API keys live in the ``api_key`` table."""
     __tablename__ = "user"
 
     id = db.Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
     email = db.Column(db.String(255), unique=True, nullable=False)
     password = db.Column(db.String(255), nullable=False)
     is_admin = db.Column(db.Boolean, default=False)
-    api_keys = db.Column(MutableList.as_mutable(JSON), default=list[tuple[str, str]])
+    api_keys = db.Column(MutableList.as_mutable(JSON), default=list[tuple[str, str]]) # legacy, migrated into ApiKey by check_db
 
     def set_password(self, raw_password):
         self.password = generate_password_hash(raw_password)
@@ -22,18 +25,17 @@ class User(db.Model):
     def check_password(self, raw_password):
         return check_password_hash(self.password, raw_password)
     
-    def get_user_from_api_key(api_key):
-        for user in User.query.all():
-            for key, trace_id in user.api_keys:
-                if key == api_key:
-                    return user
-    
-    def get_trace_from_api_key(api_key):
-        for user in User.query.all():
-            for key, trace_id in user.api_keys:
-                if key == api_key:
-                    return AdditionalTrace.query.get(trace_id)
-    
+
+class ApiKey(db.Model):
+    """Maps an API key to its user and optional additional trace."""
+    __tablename__ = "api_key"
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    key = db.Column(db.String(255), unique=True, nullable=False)
+    user_id = db.Column(UUID(as_uuid=True), db.ForeignKey("user.id", ondelete="CASCADE"), nullable=False, index=True)
+    trace_id = db.Column(UUID(as_uuid=True), db.ForeignKey("additional_trace.id", ondelete="CASCADE"), nullable=True)
+    created_at = db.Column(db.DateTime, nullable=False, default=lambda: datetime.now(timezone.utc))
+
 
 class AdditionalTrace(db.Model):
     """Stores additional traces for a user."""
@@ -53,14 +55,89 @@ class Import(db.Model):
     id = db.Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
     user_id = db.Column(UUID(as_uuid=True), db.ForeignKey("user.id"), nullable=True)
     trace_id = db.Column(UUID(as_uuid=True), db.ForeignKey("additional_trace.id"), nullable=True)
+    owner_id = db.Column(UUID(as_uuid=True), db.Computed("COALESCE(trace_id, user_id)", persisted=True))
     filename = db.Column(db.String(255), nullable=False)
     original_filename = db.Column(db.String(255), nullable=True)
     created_at = db.Column(db.DateTime, nullable=False, default=datetime.now(timezone.utc))
     total_entries = db.Column(db.Integer, default=0)
     done_importing = db.Column(db.Boolean, default=False)
+    error = db.Column(db.String(255), nullable=True)  # why the last import job stopped early
+    skipped_entries = db.Column(db.Integer, default=0)  # invalid entries left out by the last import job
 
     __table_args__ = (
         db.CheckConstraint("user_id IS NOT NULL OR trace_id IS NOT NULL"),
+        db.Index("ix_import_owner_created_at", owner_id, created_at),
+    )
+
+
+# Optional compact layout of gps_data (GPS_DATA_COMPACT): the coordinates are stored as int4 in
+# units of 1e-7 degrees (about 1 cm) in latitude_e7/longitude_e7, the measurements as float4.
+# GPSData exposes float degrees either way, raw SQL uses the names and expressions below.
+COORDINATE_SCALE = 10_000_000
+LATITUDE_COLUMN = "latitude_e7" if Config.GPS_DATA_COMPACT else "latitude"
+LONGITUDE_COLUMN = "longitude_e7" if Config.GPS_DATA_COMPACT else "longitude"
+# the coordinates in degrees
+LATITUDE_SQL = f"({LATITUDE_COLUMN}::float8 / {COORDINATE_SCALE})" if Config.GPS_DATA_COMPACT else LATITUDE_COLUMN
+LONGITUDE_SQL = f"({LONGITUDE_COLUMN}::float8 / {COORDINATE_SCALE})" if Config.GPS_DATA_COMPACT else LONGITUDE_COLUMN
+MEASUREMENT_TYPE = REAL if Config.GPS_DATA_COMPACT else Float
+
+
+def stored_coordinate(degrees: float):
+    """A coordinate in degrees as stored in gps_data."""
+    return round(degrees * COORDINATE_SCALE) if Config.GPS_DATA_COMPACT else degrees
+
+
+def stored_rows(columns: tuple, rows: list) -> tuple[tuple, list]:
+    """
+    Column names and row tuples for an INSERT into gps_data of ``rows`` with ``columns``,
+    the coordinates converted to the stored layout.
+    """
+    if not Config.GPS_DATA_COMPACT:
+        return columns, rows
+
+    lat, lon = columns.index("latitude"), columns.index("longitude")
+    stored = []
+    for row in rows:
+        row = list(row)
+        row[lat] = round(row[lat] * COORDINATE_SCALE)
+        row[lon] = round(row[lon] * COORDINATE_SCALE)
+        stored.append(row)
+
+    columns = tuple({"latitude": LATITUDE_COLUMN, "longitude": LONGITUDE_COLUMN}.get(name, name) for name in columns)
+    return columns, stored
+
+
+def fixed_point_coordinate(column: str) -> hybrid_property:
+    """A float degrees attribute over an int4 column of 1e-7 degrees."""
+    def fget(self):
+        value = getattr(self, column)
+        return None if value is None else value / COORDINATE_SCALE
+
+    def fset(self, degrees):
+        setattr(self, column, None if degrees is None else round(degrees * COORDINATE_SCALE))
+
+    def expr(cls):
+        return cast(getattr(cls, column), Float) / float(COORDINATE_SCALE)
+
+    return hybrid_property(fget, fset, expr=expr)
+
+
+class Place(db.Model):
+    """A distinct reverse geocoding result, referenced by GPSData.place_id (see places.py)."""
+    __tablename__ = "place"
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    key = db.Column(db.String(32), unique=True, nullable=False)  # md5 of the fields below, see places.place_key
+    country = db.Column(db.String(255))
+    city = db.Column(db.String(255))
+    state = db.Column(db.String(255))
+    postal_code = db.Column(db.String(255))
+    street = db.Column(db.String(255))
+    street_number = db.Column(db.String(255))
+
+    __table_args__ = (
+        db.Index("ix_place_country_city", country, city),
+        db.Index("ix_place_city", city),
     )
 
 
@@ -72,29 +149,55 @@ class GPSData(db.Model):
     user_id = db.Column(UUID(as_uuid=True), db.ForeignKey("user.id"), nullable=True)
     trace_id = db.Column(UUID(as_uuid=True), db.ForeignKey("additional_trace.id"), nullable=True)
     import_id = db.Column(UUID(as_uuid=True), db.ForeignKey("import.id"), nullable=True)
+    # the trace of a point, or the user itself for their own points (the main trace). Maintained by the database
+    owner_id = db.Column(UUID(as_uuid=True), db.Computed("COALESCE(trace_id, user_id)", persisted=True))
 
     timestamp = db.Column(db.DateTime, nullable=False, default=datetime.now(timezone.utc))
-    latitude = db.Column(db.Float, nullable=False)
-    longitude = db.Column(db.Float, nullable=False)
-    horizontal_accuracy = db.Column(db.Float)
-    altitude = db.Column(db.Float)
-    vertical_accuracy = db.Column(db.Float)
-    heading = db.Column(db.Float)
-    heading_accuracy = db.Column(db.Float)
-    speed = db.Column(db.Float)
-    speed_accuracy = db.Column(db.Float)
+    if Config.GPS_DATA_COMPACT:
+        latitude_e7 = db.Column(db.Integer, nullable=False)
+        longitude_e7 = db.Column(db.Integer, nullable=False)
+        latitude = fixed_point_coordinate("latitude_e7")
+        longitude = fixed_point_coordinate("longitude_e7")
+    else:
+        latitude = db.Column(db.Float, nullable=False)
+        longitude = db.Column(db.Float, nullable=False)
+    horizontal_accuracy = db.Column(MEASUREMENT_TYPE)
+    altitude = db.Column(MEASUREMENT_TYPE)
+    vertical_accuracy = db.Column(MEASUREMENT_TYPE)
+    heading = db.Column(MEASUREMENT_TYPE)
+    heading_accuracy = db.Column(MEASUREMENT_TYPE)
+    speed = db.Column(MEASUREMENT_TYPE)
+    speed_accuracy = db.Column(MEASUREMENT_TYPE)
 
     reverse_geocoded = db.Column(db.Boolean, default=False)
-    country = db.Column(db.String(255))
-    city = db.Column(db.String(255))
-    state = db.Column(db.String(255))
-    postal_code = db.Column(db.String(255))
-    street = db.Column(db.String(255))
-    street_number = db.Column(db.String(255))
+    place_id = db.Column(db.Integer, db.ForeignKey("place.id"), nullable=True)
+    place = db.relationship(Place, lazy="joined")
+
+    # the reverse geocoding result, read only. QueryPhotonJob sets place_id
+    @property
+    def country(self): return self.place.country if self.place else None
+
+    @property
+    def city(self): return self.place.city if self.place else None
+
+    @property
+    def state(self): return self.place.state if self.place else None
 
+    @property
+    def postal_code(self): return self.place.postal_code if self.place else None
+
+    @property
+    def street(self): return self.place.street if self.place else None
+
+    @property
+    def street_number(self): return self.place.street_number if self.place else None
 
     __table_args__ = (
         db.CheckConstraint("user_id IS NOT NULL OR trace_id IS NOT NULL"),
+        # a point is identified by its owner, time and position, so retried uploads can be ignored.
+        # Also the (owner, timestamp) index every per-owner query runs on
+        db.Index("uq_gps_data_owner_point", owner_id, timestamp, LATITUDE_COLUMN, LONGITUDE_COLUMN, unique=True),
+        db.Index("ix_gps_data_owner_place", owner_id, place_id),
     )
 
 
@@ -107,6 +210,7 @@ class DailyStatistic(db.Model):
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     user_id = db.Column(UUID(as_uuid=True), db.ForeignKey("user.id"), nullable=True)
     trace_id = db.Column(UUID(as_uuid=True), db.ForeignKey("additional_trace.id"), nullable=True)
+    owner_id = db.Column(UUID(as_uuid=True), db.Computed("COALESCE(trace_id, user_id)", persisted=True))
     year = db.Column(db.Integer, nullable=False)
     month = db.Column(db.Integer, nullable=False)
     day = db.Column(db.Integer, nullable=False)
@@ -116,4 +220,82 @@ class DailyStatistic(db.Model):
 
     __table_args__ = (
         db.CheckConstraint("user_id IS NOT NULL OR trace_id IS NOT NULL"),
-    )
\ No newline at end of file
+        db.Index("ix_daily_statistic_owner_day", owner_id, year, month, day),
+    )
+
+
+class DailyStatisticDirty(db.Model):
+    """Days whose DailyStatistic has to be recomputed because their points changed."""
+    __tablename__ = "daily_statistic_dirty"
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    user_id = db.Column(UUID(as_uuid=True), db.ForeignKey("user.id", ondelete="CASCADE"), nullable=True)
+    trace_id = db.Column(UUID(as_uuid=True), db.ForeignKey("additional_trace.id", ondelete="CASCADE"), nullable=True)
+    day = db.Column(db.Date, nullable=False)
+
+    __table_args__ = (
+        db.CheckConstraint("user_id IS NOT NULL OR trace_id IS NOT NULL"),
+        db.Index("uq_daily_statistic_dirty_owner_day", func.coalesce(trace_id, user_id), day, unique=True),
+    )
+
+
+class ArchivedMonth(db.Model):
+    """One month of an owner's GPS points, packed into a compressed columnar blob (see archive.py)."""
+    __tablename__ = "archived_month"
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    user_id = db.Column(UUID(as_uuid=True), db.ForeignKey("user.id", ondelete="CASCADE"), nullable=True)
+    trace_id = db.Column(UUID(as_uuid=True), db.ForeignKey("additional_trace.id", ondelete="CASCADE"), nullable=True)
+    owner_id = db.Column(UUID(as_uuid=True), db.Computed("COALESCE(trace_id, user_id)", persisted=True))
+    month = db.Column(db.Date, nullable=False)  # first day of the month
+    point_count = db.Column(db.Integer, nullable=False)
+    first_timestamp = db.Column(db.DateTime, nullable=False)
+    last_timestamp = db.Column(db.DateTime, nullable=False)
+    min_latitude = db.Column(db.Float, nullable=False)
+    max_latitude = db.Column(db.Float, nullable=False)
+    min_longitude = db.Column(db.Float, nullable=False)
+    max_longitude = db.Column(db.Float, nullable=False)
+    min_id = db.Column(db.Integer, nullable=False)  # gps_data ids of the points, so restores find their month without decoding
+    max_id = db.Column(db.Integer, nullable=False)
+    import_ids = db.Column(ARRAY(UUID(as_uuid=True)), nullable=False, default=list)
+    geocoded_count = db.Column(db.Integer, nullable=False, default=0)  # reverse geocoded points, for the statistics
+    unplaced_count = db.Column(db.Integer, nullable=False, default=0)  # reverse geocoded points without a country
+    data = db.Column(db.LargeBinary, nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False, default=lambda: datetime.now(timezone.utc))
+
+    __table_args__ = (
+        db.CheckConstraint("user_id IS NOT NULL OR trace_id IS NOT NULL"),
+        db.Index("uq_archived_month_owner_month", owner_id, month, unique=True),
+    )
+
+
+class TrackLevel(db.Model):
+    """One day of an owner's track, simplified for one zoom level of the map (see track_levels.py)."""
+    __tablename__ = "track_level"
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    user_id = db.Column(UUID(as_uuid=True), db.ForeignKey("user.id", ondelete="CASCADE"), nullable=True)
+    trace_id = db.Column(UUID(as_uuid=True), db.ForeignKey("additional_trace.id", ondelete="CASCADE"), nullable=True)
+    owner_id = db.Column(UUID(as_uuid=True), db.Computed("COALESCE(trace_id, user_id)", persisted=True))
+    day = db.Column(db.Date, nullable=False)
+    zoom = db.Column(db.SmallInteger, nullable=False)
+    point_count = db.Column(db.Integer, nullable=False)
+    min_latitude = db.Column(db.Float, nullable=False)
+    max_latitude = db.Column(db.Float, nullable=False)
+    min_longitude = db.Column(db.Float, nullable=False)
+    max_longitude = db.Column(db.Float, nullable=False)
+    data = db.Column(db.LargeBinary, nullable=False)  # encoded like ArchivedMonth.data
+
+    __table_args__ = (
+        db.CheckConstraint("user_id IS NOT NULL OR trace_id IS NOT NULL"),
+        db.Index("uq_track_level_owner_zoom_day", owner_id, zoom, day, unique=True),
+    )
+
+
+class TrackLevelOwner(db.Model):
+    """Owners whose track levels were built for all of their days, at the listed zooms (see track_levels.py)."""
+    __tablename__ = "track_level_owner"
+
+    owner_id = db.Column(UUID(as_uuid=True), primary_key=True)  # user or trace
+    zooms = db.Column(db.String, nullable=False)
+    built_at = db.Column(db.DateTime, nullable=False)
@@ -0,0 +1,171 @@
+"""
+Mapbox Vector Tile (MVT 2.1) encoding.
+
+A tile is a protobuf message of named layers, each a list of features with a geometry in
+integer tile coordinates (0..extent, y pointing down) and key/value properties. Only points
+and line strings are written, which is all the map draws. The few protobuf wire types the
+format needs are written by hand, so there is no dependency on a protobuf library.
+"""
+import struct
+
+
+EXTENT = 4096
+
+GEOMETRY_TYPES = {"Point": 1, "LineString": 2}
+
+MOVE_TO = 1
+LINE_TO = 2
+
+# protobuf wire types
+VARINT = 0
+FIXED64 = 1
+LENGTH_DELIMITED = 2
+
+
+def _varint(value: int) -> bytes:
+    out = bytearray()
+    while value > 0x7F:
+        out.append(value & 0x7F | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def _zigzag(value: int) -> int:
+    return (value << 1) ^ (value >> 63)
+
+
+def _key(field: int, wire_type: int) -> bytes:
+    return _varint(field << 3 | wire_type)
+
+
+def _message(field: int, payload: bytes) -> bytes:
+    return _key(field, LENGTH_DELIMITED) + _varint(len(payload)) + payload
+
+
+def _packed(field: int, values: list[int]) -> bytes:
+    return _message(field, b"".join(_varint(value) for value in values))
+
+
+def _value(value) -> bytes:
+    """A Value message, see the MVT spec for the field numbers."""
+    if isinstance(value, bool):
+        return _key(7, VARINT) + _varint(int(value))
+    if isinstance(value, int):
+        return _key(6, VARINT) + _varint(_zigzag(value))
+    if isinstance(value, float):
+        return _key(3, FIXED64) + struct.pack("<d", value)
+    return _message(1, str(value).encode())
+
+
+def _command(command: int, count: int) -> int:
+    return command & 0x7 | count << 3
+
+
+def _geometry(geometry_type: str, coordinates: list[tuple[int, int]]) -> list[int] | None:
+    """
+    The geometry commands of a feature. Repeated coordinates are dropped, a line string
+    needs two different ones. None if nothing is left to draw.
+    """
+    points = []
+    for x, y in coordinates:
+        if not points or (x, y) != points[-1]:
+            points.append((x, y))
+
+    if geometry_type == "Point":
+        points = points[:1]
+    elif len(points) < 2:
+        return None
+
+    commands = []
+    cursor_x = cursor_y = 0
+    for i, (x, y) in enumerate(points):
+        if i == 0:
+            commands.append(_command(MOVE_TO, 1))
+        elif i == 1:
+            commands.append(_command(LINE_TO, len(points) - 1))
+        commands += [_zigzag(x - cursor_x), _zigzag(y - cursor_y)]
+        cursor_x, cursor_y = x, y
+    return commands
+
+
+def encode_layer(name: str, features: list[tuple[str, list, dict]], extent: int = EXTENT) -> bytes:
+    """
+    A Layer message from (geometry type, [(x, y), ...] in tile coordinates, properties) features.
+    Empty properties are left out.
+    """
+    keys, values = {}, {}
+    body = bytearray(_message(1, name.encode()))
+
+    for feature_id, (geometry_type, coordinates, properties) in enumerate(features, start=1):
+        geometry = _geometry(geometry_type, [(round(x), round(y)) for x, y in coordinates])
+        if geometry is None:
+            continue
+
+        tags = []
+        for key, value in properties.items():
+            if value is None:
+                continue
+            tags.append(keys.setdefault(key, len(keys)))
+            tags.append(values.setdefault((type(value), value), len(values)))
+
+        feature = _key(1, VARINT) + _varint(feature_id)
+        if tags:
+            feature += _packed(2, tags)
+        feature += _key(3, VARINT) + _varint(GEOMETRY_TYPES[geometry_type])
+        feature += _packed(4, geometry)
+        body += _message(2, feature)
+
+    for key in keys:
+        body += _message(3, key.encode())
+    for _, value in values:
+        body += _message(4, _value(value))
+    body += _key(5, VARINT) + _varint(extent)
+    body += _key(15, VARINT) + _varint(2)
+    return bytes(body)
+
+
+def encode_tile(layers: dict[str, list[tuple[str, list, dict]]], extent: int = EXTENT) -> bytes:
+    """A Tile message with one layer per name, empty layers are left out."""
+    return b"".join(_message(3, encode_layer(name, features, extent)) for name, features in layers.items() if features)
+
+
+def clip_line(points: list[tuple[float, float]], low: float, high: float) -> list[list[tuple[float, float]]]:
+    """
+    The parts of a polyline inside the square from ``low`` to ``high`` on both axes
+    (Liang-Barsky per segment). A line leaving and entering the square again is split.
+    """
+    parts = []
+    current = []
+    for (x0, y0), (x1, y1) in zip(points, points[1:]):
+        dx, dy = x1 - x0, y1 - y0
+        t0, t1 = 0.0, 1.0
+        for p, q in ((-dx, x0 - low), (dx, high - x0), (-dy, y0 - low), (dy, high - y0)):
+            if p == 0:
+                if q < 0:
+                    t0, t1 = 1.0, 0.0
+                    break
+                continue
+            t = q / p
+            if p < 0:
+                t0 = max(t0, t)
+            else:
+                t1 = min(t1, t)
+        if t0 > t1:
+            if current:
+                parts.append(current)
+                current = []
+            continue
+
+        start = (x0 + t0 * dx, y0 + t0 * dy)
+        end = (x0 + t1 * dx, y0 + t1 * dy)
+        if not current:
+            current = [start]
+        current.append(end)
+        if t1 < 1.0:
+            parts.append(current)
+            current = []
+
+    if current:
+        parts.append(current)
+    return parts
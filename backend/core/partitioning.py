@@ -0,0 +1,207 @@
+"""
+Opt-in monthly range partitioning of gps_data on ``timestamp`` (GPS_DATA_PARTITIONING).
+
+Partitions are named ``gps_data_pYYYY_MM`` and created on demand by insert_points, the
+JobManager creates the next month's ahead of time so inserts rarely have to. Each one
+carries its own owner/point unique index, since PostgreSQL does not allow expression unique
+indexes on the partitioned table itself. Queries with a time range only scan the matching
+months, and a whole month can be detached or dropped without touching the other rows.
+"""
+from datetime import datetime, timedelta
+import threading
+
+from sqlalchemy import event, text
+
+from .config import Config
+from .extensions import RoutingSession, db
+from .models import LATITUDE_COLUMN, LONGITUDE_COLUMN
+
+
+# serializes partition creation between transactions, CREATE TABLE IF NOT EXISTS alone races
+PARTITION_LOCK_ID = 0x67707364
+
+CREATED_PARTITIONS = "created_partitions"
+
+# (year, month) of partitions known to exist, so inserts do not look them up every time
+_known_partitions: set[tuple[int, int]] = set()
+_known_partitions_lock = threading.Lock()
+
+
+def partition_name(year: int, month: int) -> str:
+    return f"gps_data_p{year:04d}_{month:02d}"
+
+
+def month_range(first: datetime, last: datetime):
+    """Yield (year, month) for every month from ``first`` to ``last``, inclusive."""
+    year, month = first.year, first.month
+    while (year, month) <= (last.year, last.month):
+        yield year, month
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+
+
+def is_partitioned() -> bool:
+    return db.session.execute(text(
+        "SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass('gps_data')"
+    )).first() is not None
+
+
+def create_partition(year: int, month: int, parent: str = "gps_data"):
+    name = partition_name(year, month)
+    start = datetime(year, month, 1)
+    end = datetime(year + month // 12, month % 12 + 1, 1)
+    db.session.execute(text(
+        f"CREATE TABLE IF NOT EXISTS {name} PARTITION OF {parent} "
+        f"FOR VALUES FROM ('{start.date()}') TO ('{end.date()}')"
+    ))
+    db.session.execute(text(
+        f"CREATE UNIQUE INDEX IF NOT EXISTS {name}_owner_point "
+        f"ON {name} (owner_id, timestamp, {LATITUDE_COLUMN}, {LONGITUDE_COLUMN})"
+    ))
+
+
+def ensure_partitions(timestamps):
+    """
+    Create the partitions needed for ``timestamps`` in the current transaction.
+    Timezone-aware values may be shifted into a neighbouring month when stored,
+    so the months of the day before and after are covered as well.
+    """
+    months = set()
+    for timestamp in timestamps:
+        for shifted in (timestamp - timedelta(days=1), timestamp, timestamp + timedelta(days=1)):
+            months.add((shifted.year, shifted.month))
+
+    with _known_partitions_lock:
+        months -= _known_partitions
+    if not months:
+        return
+
+    db.session.execute(text("SELECT pg_advisory_xact_lock(:id)"), {"id": PARTITION_LOCK_ID})
+    existing = {name for (name,) in db.session.execute(
+        text("SELECT relname FROM pg_class WHERE relname = ANY(:names)"),
+        {"names": [partition_name(year, month) for year, month in months]},
+    )}
+    created = set()
+    for year, month in sorted(months):
+        if partition_name(year, month) not in existing:
+            create_partition(year, month)
+            created.add((year, month))
+
+    with _known_partitions_lock:
+        _known_partitions.update(months - created)
+    # partitions created here only exist once the transaction commits
+    db.session.info.setdefault(CREATED_PARTITIONS, set()).update(created)
+
+
+@event.listens_for(RoutingSession, "after_commit")
+def _remember_partitions(session):
+    created = session.info.pop(CREATED_PARTITIONS, None)
+    if created:
+        with _known_partitions_lock:
+            _known_partitions.update(created)
+
+
+@event.listens_for(RoutingSession, "after_rollback")
+def _forget_partitions(session):
+    session.info.pop(CREATED_PARTITIONS, None)
+
+
+def create_upcoming_partitions():
+    """Create the partitions of this and the next month, the caller commits."""
+    now = datetime.now()
+    ensure_partitions({now, datetime(now.year + now.month // 12, now.month % 12 + 1, 1)})
+
+
+def drop_empty_partitions(before: datetime) -> int:
+    """
+    Drop the partitions of months ending before ``before`` that hold no rows anymore, e.g. once
+    every owner's points of the month were archived. Unlike the row deletes, this leaves no dead
+    tuples behind for vacuum. The caller commits. Returns the number of dropped partitions.
+    """
+    if not is_partitioned():
+        return 0
+
+    db.session.execute(text("SELECT pg_advisory_xact_lock(:id)"), {"id": PARTITION_LOCK_ID})
+    names = [name for (name,) in db.session.execute(text(
+        "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+        "WHERE i.inhparent = 'gps_data'::regclass"
+    ))]
+
+    dropped = 0
+    for name in names:
+        try:
+            start = datetime.strptime(name, "gps_data_p%Y_%m")
+        except ValueError:
+            continue
+        if datetime(start.year + start.month // 12, start.month % 12 + 1, 1) > before:
+            continue
+        if db.session.execute(text(f"SELECT 1 FROM {name} LIMIT 1")).first():
+            continue
+
+        with _known_partitions_lock:
+            _known_partitions.discard((start.year, start.month))
+        db.session.execute(text(f"DROP TABLE {name}"))
+        dropped += 1
+    return dropped
+
+
+def migrate_gps_data_partitioning():
+    """
+    With GPS_DATA_PARTITIONING, turn an existing plain gps_data table into a table partitioned
+    by month. Rows are copied into the new table in one transaction, so this takes a while
+    (and twice the disk space) on large databases. It cannot be reverted by unsetting the option.
+    """
+    if not Config.GPS_DATA_PARTITIONING:
+        return
+
+    if is_partitioned():
+        # tables partitioned before the place foreign key was carried over
+        place_key_exists = db.session.execute(text(
+            "SELECT 1 FROM pg_constraint WHERE conrelid = 'gps_data'::regclass AND contype = 'f' AND confrelid = 'place'::regclass"
+        )).first()
+        if not place_key_exists:
+            db.session.execute(text("ALTER TABLE gps_data ADD FOREIGN KEY (place_id) REFERENCES place (id)"))
+            db.session.commit()
+        return
+
+    print("Partitioning gps_data by month, this can take a while...")
+
+    # indexes to recreate on the new table. The owner/point unique index lives on the partitions instead
+    index_defs = [indexdef for (indexdef,) in db.session.execute(text("""
+        SELECT pg_get_indexdef(i.indexrelid) FROM pg_index i
+        WHERE i.indrelid = 'gps_data'::regclass AND NOT i.indisprimary AND NOT i.indisunique
+    """))]
+    columns = ", ".join(f'"{name}"' for (name,) in db.session.execute(text("""
+        SELECT column_name FROM information_schema.columns
+        WHERE table_schema = current_schema() AND table_name = 'gps_data' AND is_generated = 'NEVER'
+        ORDER BY ordinal_position
+    """)))
+    sequence = db.session.execute(text("SELECT pg_get_serial_sequence('gps_data', 'id')")).scalar()
+
+    db.session.execute(text(f"ALTER SEQUENCE {sequence} OWNED BY NONE"))
+    db.session.execute(text("""
+        CREATE TABLE gps_data_partitioned (LIKE gps_data INCLUDING DEFAULTS INCLUDING CONSTRAINTS INCLUDING GENERATED)
+        PARTITION BY RANGE (timestamp)
+    """))
+    # the partition key has to be part of the primary key
+    db.session.execute(text("ALTER TABLE gps_data_partitioned ADD CONSTRAINT gps_data_partitioned_pkey PRIMARY KEY (id, timestamp)"))
+
+    first, last = db.session.execute(text("SELECT MIN(timestamp), MAX(timestamp) FROM gps_data")).one()
+    if first is not None:
+        for year, month in month_range(first, last):
+            create_partition(year, month, parent="gps_data_partitioned")
+
+    db.session.execute(text(f"INSERT INTO gps_data_partitioned ({columns}) SELECT {columns} FROM gps_data"))
+    db.session.execute(text("DROP TABLE gps_data"))
+    db.session.execute(text("ALTER TABLE gps_data_partitioned RENAME TO gps_data"))
+    db.session.execute(text("ALTER TABLE gps_data RENAME CONSTRAINT gps_data_partitioned_pkey TO gps_data_pkey"))
+    db.session.execute(text(f"ALTER SEQUENCE {sequence} OWNED BY gps_data.id"))
+
+    db.session.execute(text('ALTER TABLE gps_data ADD FOREIGN KEY (user_id) REFERENCES "user" (id)'))
+    db.session.execute(text("ALTER TABLE gps_data ADD FOREIGN KEY (trace_id) REFERENCES additional_trace (id)"))
+    db.session.execute(text('ALTER TABLE gps_data ADD FOREIGN KEY (import_id) REFERENCES "import" (id)'))
+    db.session.execute(text("ALTER TABLE gps_data ADD FOREIGN KEY (place_id) REFERENCES place (id)"))
+    for indexdef in index_defs:
+        db.session.execute(text(indexdef))
+
+    db.session.commit()
+    print("gps_data is now partitioned by month.")
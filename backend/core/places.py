@@ -0,0 +1,82 @@
+"""
+Dictionary of reverse geocoding results.
+
+Every distinct (country, city, state, postal_code, street, street_number) result is stored
+once in the place table, keyed by an md5 of its fields, and gps_data rows only reference it
+by place_id. ``place_ids`` resolves results to ids in bulk, creating missing places.
+"""
+import hashlib
+
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+from .cache import TTLCache
+from .extensions import db
+from .models import Place
+
+
+PLACE_FIELDS = ("country", "city", "state", "postal_code", "street", "street_number")
+
+# separator between the fields and marker for missing ones in the key, see place_key_sql
+KEY_SEPARATOR = "\x1f"
+KEY_NULL = "\x1e"
+
+
+def place_key_sql(table: str) -> str:
+    """The place key computed in SQL over the place columns of ``table``, see place_key."""
+    fields = ", ".join(f"COALESCE({table}.{name}, E'\\x1e')" for name in PLACE_FIELDS)
+    return f"md5(concat_ws(E'\\x1f', {fields}))"
+
+
+# place key -> id. Only committed places are cached, see place_ids
+place_cache = TTLCache(maxsize=10000, ttl=24 * 3600)
+
+
+def place_key(place: tuple) -> str:
+    return hashlib.md5(KEY_SEPARATOR.join(KEY_NULL if value is None else value for value in place).encode()).hexdigest()
+
+
+def photon_place(properties: dict) -> tuple:
+    """The place of the properties of a Photon reverse geocoding feature."""
+    return (
+        properties.get("country"),
+        properties.get("city"),
+        properties.get("state"),
+        properties.get("postcode"),
+        properties.get("street"),
+        properties.get("housenumber"),
+    )
+
+
+def place_ids(places: list) -> list:
+    """
+    The place ids of ``places`` (tuples in PLACE_FIELDS order), in the same order.
+    Missing places are inserted in the current transaction. Empty places have no id.
+    """
+    keys = [place_key(place) if place and any(value is not None for value in place) else None for place in places]
+
+    ids = {}
+    missing = {}
+    for key, place in zip(keys, places):
+        if key is None or key in ids or key in missing:
+            continue
+        place_id = place_cache.get(key)
+        if place_id is None:
+            missing[key] = place
+        else:
+            ids[key] = place_id
+
+    if missing:
+        inserted = set(db.session.execute(
+            pg_insert(Place)
+            .values([{"key": key, **dict(zip(PLACE_FIELDS, place))} for key, place in missing.items()])
+            .on_conflict_do_nothing(index_elements=["key"])
+            .returning(Place.key)
+        ).scalars())
+
+        for key, place_id in db.session.query(Place.key, Place.id).filter(Place.key.in_(missing)):
+            ids[key] = place_id
+            # places inserted here only exist once the caller commits
+            if key not in inserted:
+                place_cache.set(key, place_id)
+
+    return [ids.get(key) for key in keys]
@@ -0,0 +1,100 @@
+"""
+Per-owner data versions, and a cache of the responses computed from an owner's data.
+
+Everything that changes an owner's points or statistics calls ``data_changed`` in its
+transaction. Once that commits, the owner's version is bumped. ``cached_response`` keys
+responses by (endpoint, owner, version, parameters), so a repeated request for unchanged
+data is a dictionary lookup, and answers If-None-Match with 304 Not Modified. Responses of
+older versions are never looked up again and age out of the byte-bounded LRU.
+
+Versions are kept in memory: the web server, the background jobs and the ingest queue all
+run in this process.
+"""
+import hashlib
+import threading
+import time
+import uuid
+
+from flask import Response, g, make_response, request
+from sqlalchemy import event
+
+from .cache import SizedLRUCache
+from .config import Config
+from .extensions import RoutingSession, db
+
+
+# part of every ETag, so ETags from before a restart do not match
+INSTANCE = uuid.uuid4().hex
+
+CHANGED_OWNERS = "changed_owners"
+
+# owner_id -> (version, time.monotonic() of the last change)
+_versions: dict[str, tuple[int, float]] = {}
+_versions_lock = threading.Lock()
+
+# (endpoint, owner_id, version, params) -> (status, headers, body)
+response_cache = SizedLRUCache(maxbytes=Config.RESPONSE_CACHE_MB * 1024 * 1024, size=lambda entry: len(entry[2]))
+
+
+def data_changed(owner_ids):
+    """Bump the data version of ``owner_ids`` once the current transaction commits."""
+    db.session.info.setdefault(CHANGED_OWNERS, set()).update(str(owner_id) for owner_id in owner_ids if owner_id)
+
+
+@event.listens_for(RoutingSession, "after_commit")
+def _bump_versions(session):
+    owners = session.info.pop(CHANGED_OWNERS, None)
+    if not owners:
+        return
+
+    now = time.monotonic()
+    with _versions_lock:
+        for owner_id in owners:
+            version, _ = _versions.get(owner_id, (0, 0.0))
+            _versions[owner_id] = (version + 1, now)
+
+
+@event.listens_for(RoutingSession, "after_rollback")
+def _forget_changes(session):
+    session.info.pop(CHANGED_OWNERS, None)
+
+
+def data_version(owner_id) -> tuple[int, float]:
+    """The data version of an owner and when it last changed."""
+    with _versions_lock:
+        return _versions.get(str(owner_id), (0, 0.0))
+
+
+def cached_response(name: str, params, build) -> Response:
+    """
+    The response of ``build()`` for the current owner (g.trace_query), cached until the
+    owner's data changes. ``params`` holds everything else the response depends on and
+    needs a stable repr. Only 200 responses are cached.
+    """
+    owner_id = str(g.trace_query["owner_id"])
+    version, changed_at = data_version(owner_id)
+
+    # the read replica may not have the latest change yet, what it returns now must not be kept
+    if Config.SQLALCHEMY_BINDS and time.monotonic() - changed_at < Config.DB_REPLICA_MAX_LAG:
+        return make_response(build())
+
+    key = (name, owner_id, version, params)
+    etag = hashlib.md5(f"{INSTANCE}:{key!r}".encode()).hexdigest()
+
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        entry = response_cache.get(key)
+        if entry is None:
+            response = make_response(build())
+            if response.status_code != 200:
+                return response
+            response_cache.set(key, (response.status_code, list(response.headers.items()), response.get_data()))
+        else:
+            status, headers, body = entry
+            response = Response(body, status=status, headers=headers)
+
+    response.set_etag(etag)
+    # browsers keep the response, but ask whether it is still current before using it
+    response.headers["Cache-Control"] = "private, no-cache"
+    return response
@@ -3,12 +3,16 @@ from datetime import datetime
 from flask import jsonify, redirect, request, g, session, url_for
 from flask_restx import Resource, fields, Namespace
 from flask_restx.reqparse import RequestParser
-from sqlalchemy import func
 
+from ..archive import archived_geocoded_counts, archived_point_count
 from ..config import Config
-from ..extensions import db
-from ..models import DailyStatistic, GPSData, User
-from ..utils import api_key_required
+from ..ingest import (
+    IngestTimeoutError, InvalidPointError, decode_binary_batch, ingest_queue, spooled_row_chunks,
+    parse_batch_entry, parse_overland_feature, parse_owntracks,
+)
+from ..models import DailyStatistic, GPSData, Place
+from ..response_cache import cached_response
+from ..utils import api_key_owner, api_key_required, read_replica
 
 # Create a dedicated namespace for the GPS routes
 api_gps_ns = Namespace("gps", description="GPS Data operations")
@@ -89,48 +93,20 @@ class GPSBatch(Resource):
     @api_key_required
     def post(self):
         """Submit batch GPS data (requires a valid API key)."""
-        data = request.json or {}
-        gps_entries = data.get("gps_data")
-
-        if not gps_entries or not isinstance(gps_entries, list):
-            return {"error": "Invalid data format"}, 400
-
-        # The user from the valid API key is in g.current_user
-        user = g.current_user
-        trace = g.current_trace
-
-        user_id = user.id
-        trace_id = None
-        if trace:
-            user_id = None
-            trace_id = trace.id
-
-        # Save each GPS entry
-        for entry in gps_entries:
-            ts_str = entry.get("timestamp")
-            try:
-                # Attempt to parse the timestamp as ISO 8601
-                ts = datetime.fromtimestamp(int(ts_str), tz=datetime.now().astimezone().tzinfo)  # handle UTC 'Z'
-            except:
-                ts = datetime.now()  # fallback if parse fails
-
-            gps_record = GPSData(
-                user_id=user_id,
-                trace_id=trace_id,
-                timestamp=ts,
-                latitude=round(float(entry["latitude"]), 8),
-                longitude=round(float(entry["longitude"]), 8),
-                horizontal_accuracy=round(float(entry.get("horizontal_accuracy")), 8),
-                altitude=round(float(entry.get("altitude")), 8),
-                vertical_accuracy=round(float(entry.get("vertical_accuracy")), 8),
-                heading=round(float(entry.get("heading")), 8),
-                heading_accuracy=round(float(entry.get("heading_accuracy")), 8),
-                speed=round(float(entry.get("speed")), 8),
-                speed_accuracy=round(float(entry.get("speed_accuracy")), 8),
-            )
-            db.session.add(gps_record)
-
-        db.session.commit()
+        # The owner of the valid API key is in g.owner_ids
+        user_id, trace_id = g.owner_ids
+
+        # Parse and validate "gps_data" from the request stream, then store it chunk by chunk
+        try:
+            chunks = spooled_row_chunks(request.stream, "gps_data", parse_batch_entry, user_id, trace_id)
+        except InvalidPointError as e:
+            return {"error": str(e)}, 400
+
+        try:
+            ingest_queue.submit_chunks(chunks)
+        except IngestTimeoutError as e:
+            return {"error": str(e)}, 503
+
         return {"message": "GPS data added successfully"}, 201
 
 
@@ -244,64 +220,19 @@ class OverlandGPSBatch(Resource):
         """
         Submit GeoJSON-style GPS data from Overland (requires a valid API key).
         """
-        # Parse request JSON
-        data = request.json or {}
-        locations = data.get("locations")
-
-        if not locations or not isinstance(locations, list):
-            return {"error": "Invalid data format: 'locations' should be a list"}, 400
-
-        user = g.current_user  # Retrieved from @api_key_required decorator
-        trace = g.current_trace
-
-        user_id = user.id
-        trace_id = None
-        if trace:
-            user_id = None
-            trace_id = trace.id
-
-        for feature in locations:
-            # Validate that it follows the GeoJSON Feature structure
-            if feature.get("type") != "Feature":
-                continue  # or return an error if you'd rather fail early
-
-            geometry = feature.get("geometry", {})
-            properties = feature.get("properties", {})
-
-            # Ensure geometry is a "Point" with [longitude, latitude]
-            coords = geometry.get("coordinates", [])
-            if len(coords) != 2 or geometry.get("type") != "Point":
-                continue  # or handle invalid geometry
-
-            longitude, latitude = coords[0], coords[1]
-
-            # Parse timestamp, default to now if parsing fails
-            ts_str = properties.get("timestamp")
-            try:
-                ts = datetime.fromisoformat(ts_str) # e.g. "2025-04-19T20:12:44Z"
-            except Exception:
-                ts = datetime.now()
-
-            # Create a GPSData record
-            gps_record = GPSData(
-                user_id=user_id,
-                trace_id=trace_id,
-                timestamp=ts,
-                latitude=latitude,
-                longitude=longitude,
-                horizontal_accuracy=properties.get("horizontal_accuracy"),
-                vertical_accuracy=properties.get("vertical_accuracy"),
-                altitude=properties.get("altitude"),
-                speed=properties.get("speed"),
-                speed_accuracy=properties.get("speed_accuracy"),
-                heading=properties.get("course"),  # "course" is equivalent to heading
-                heading_accuracy=properties.get("course_accuracy"),
-                # Additional fields can be added as needed
-            )
-
-            db.session.add(gps_record)
-
-        db.session.commit()
+        user_id, trace_id = g.owner_ids  # Retrieved from @api_key_required decorator
+
+        # Parse and validate "locations" from the request stream, features that are not GeoJSON points are skipped
+        try:
+            chunks = spooled_row_chunks(request.stream, "locations", parse_overland_feature, user_id, trace_id)
+        except InvalidPointError as e:
+            return {"error": str(e)}, 400
+
+        try:
+            ingest_queue.submit_chunks(chunks)
+        except IngestTimeoutError as e:
+            return {"error": str(e)}, 503
+
         return {"result": "ok"}, 201
 
 
@@ -323,77 +254,64 @@ class OwntracksGPS(Resource):
         # Parse request JSON
         data = request.json or {}
 
-        user = g.current_user
-        trace = g.current_trace
-
-        # In your existing logic: if a trace object is present,
-        # you store GPS data under trace_id with no user_id; otherwise you store under user_id.
-        user_id = user.id
-        trace_id = None
-        if trace:
-            user_id = None
-            trace_id = trace.id
-
-        # The OwnTracks payload uses epoch timestamps in "tst"
-        # and lat/lon in "lat"/"lon", etc.
-        # We'll parse only the data your system tracks.
-
-        # 1) Timestamp
-        #    - primary is "tst" (epoch seconds)
-        #    - if needed, fallback to other fields (e.g., "isotst"), or default to now on parse error
-        timestamp = None
-        if "tst" in data:
-            try:
-                timestamp = datetime.fromtimestamp(int(data["tst"]), tz=datetime.now().astimezone().tzinfo)
-            except:
-                timestamp = datetime.now()
-        else:
-            # Optional fallback if "tst" is missing
-            timestamp = datetime.now()
-
-        # 2) Latitude / Longitude
-        latitude = data.get("lat")
-        longitude = data.get("lon")
-
-        # 3) Horizontal accuracy ("acc")
-        horizontal_accuracy = data.get("acc")
-
-        # 4) Altitude ("alt")
-        altitude = data.get("alt")
-
-        # 5) Vertical accuracy ("vac")
-        vertical_accuracy = data.get("vac")
-
-        # 6) Heading / speed / heading_accuracy / speed_accuracy are
-        #    not provided in this example payload, so they're set to None.
-        heading = None
-        heading_accuracy = None
-        speed = None
-        speed_accuracy = None
-
-        # Create and store the GPSData record
-        gps_record = GPSData(
-            user_id=user_id,
-            trace_id=trace_id,
-            timestamp=timestamp,
-            latitude=latitude,
-            longitude=longitude,
-            horizontal_accuracy=horizontal_accuracy,
-            altitude=altitude,
-            vertical_accuracy=vertical_accuracy,
-            heading=heading,
-            heading_accuracy=heading_accuracy,
-            speed=speed,
-            speed_accuracy=speed_accuracy,
-        )
-        db.session.add(gps_record)
-        db.session.commit()
+        # Only location messages carry a point, others (e.g. "lwt", "transition") are acknowledged and dropped
+        if data.get("_type", "location") != "location":
+            return {"result": "ok"}, 201
+
+        # If a trace is attached to the API key, the point is stored under the trace instead of the user
+        user_id, trace_id = g.owner_ids
+
+        try:
+            row = parse_owntracks(data, user_id, trace_id)
+        except InvalidPointError as e:
+            return {"error": str(e)}, 400
+
+        try:
+            ingest_queue.submit([row])
+        except IngestTimeoutError as e:
+            return {"error": str(e)}, 503
 
         return {"result": "ok"}, 201
 
 
 
 
+@api_gps_ns.route("/binary")
+class BinaryGPSBatch(Resource):
+    """
+    Endpoint to accept compact columnar binary batches, e.g. from high-rate trackers or bridges.
+    """
+
+    @api_gps_ns.expect(api_key_parser)
+    @api_gps_ns.response(201, "Success", overland_success_response_model)
+    @api_gps_ns.response(401, "Unauthorized", unauthorized_response_model)
+    @api_key_required
+    def post(self):
+        """
+        Submit a columnar binary GPS batch (requires a valid API key).
+
+        All values are little-endian. The body starts with a 20 byte header:
+        "WPDB", u8 version (1), u8 column flags, u16 reserved, u32 point count, i64 base timestamp (epoch seconds).
+        It is followed by int32 timestamp deltas in seconds (the first relative to the base timestamp),
+        int32 latitudes and int32 longitudes in degrees * 1e7, and one float32 column per set flag bit,
+        in the order horizontal_accuracy, altitude, vertical_accuracy, heading, heading_accuracy, speed,
+        speed_accuracy. NaN marks a missing value.
+        """
+        user_id, trace_id = g.owner_ids
+
+        try:
+            rows = decode_binary_batch(request.get_data(), user_id, trace_id)
+        except InvalidPointError as e:
+            return {"error": str(e)}, 400
+
+        try:
+            ingest_queue.submit(rows)
+        except IngestTimeoutError as e:
+            return {"error": str(e)}, 503
+
+        return {"result": "ok"}, 201
+
+
 
 api_account_ns = Namespace("account", description="Account operations")
 
@@ -403,7 +321,7 @@ class AccountLogin(Resource):
     @api_key_required
     def get(self):
         """Login with an API key."""
-        user = g.current_user
+        user, _ = api_key_owner()
         session["user_id"] = str(user.id)
 
         return redirect(url_for("web.home"))
@@ -457,12 +375,20 @@ class AccountStats(Resource):
     @api_account_ns.response(200, "Success", stats_model)
     @api_account_ns.response(401, "Unauthorized", unauthorized_response_model)
     @api_key_required
+    @read_replica
     def get(self):
-        """Get user statistics (requires a valid API key)."""
-        
-        total_points = GPSData.query.filter_by(**g.trace_query).count()
-        total_geocoded = GPSData.query.filter_by(**g.trace_query).filter(GPSData.reverse_geocoded == True).count()
-        total_not_geocoded = GPSData.query.filter_by(**g.trace_query).filter(GPSData.reverse_geocoded == True).filter(GPSData.country == None).count()
+        """Get user statistics (requires a valid API key). Supports If-None-Match."""
+        return cached_response("account_stats", (), self.statistics)
+
+    def statistics(self):
+        total_points = GPSData.query.filter_by(**g.trace_query).count() + archived_point_count(g.trace_query)
+        archived_geocoded, archived_unplaced = archived_geocoded_counts(g.trace_query)
+        total_geocoded = GPSData.query.filter_by(**g.trace_query).filter(GPSData.reverse_geocoded == True).count() + archived_geocoded
+        total_not_geocoded = (
+            GPSData.query.filter_by(**g.trace_query).filter(GPSData.reverse_geocoded == True)
+            .outerjoin(Place, GPSData.place_id == Place.id).filter(Place.country == None)
+            .count()
+        ) + archived_unplaced
         stats: list[DailyStatistic] = DailyStatistic.query.filter_by(**g.trace_query).all()
 
         # We'll group stats by year
@@ -599,11 +525,14 @@ class AccountYearStats(Resource):
     @api_account_ns.response(200, "Success", year_stats_model)
     @api_account_ns.response(401, "Unauthorized", unauthorized_response_model)
     @api_key_required
+    @read_replica
     def get(self, year):
         """
         Get yearly statistics for the logged-in user (requires a valid API key).
         """
-        total_points = GPSData.query.filter_by(**g.trace_query).filter(func.extract("year", GPSData.timestamp) == year).count()
+        total_points = GPSData.query.filter_by(**g.trace_query).filter(
+            GPSData.timestamp >= datetime(year, 1, 1), GPSData.timestamp < datetime(year + 1, 1, 1)
+        ).count() + archived_point_count(g.trace_query, year)
 
         stats = DailyStatistic.query.filter_by(**g.trace_query, year=year).all()
 
@@ -1,15 +1,18 @@
 from io import BytesIO
 from PIL import Image, ImageDraw, ImageFilter
 from collections import defaultdict, namedtuple
+from itertools import chain
 from datetime import datetime, timedelta, timezone
 import gzip
+import heapq
+import hmac
+import ipaddress
 import math
 import os
 import re
 import traceback
 import uuid
 import time
-import psycopg2
 import json
 from flask import (
     Blueprint, Response, make_response, render_template, request, redirect, send_file, stream_with_context, url_for, 
@@ -19,11 +22,23 @@ from flask.views import MethodView
 import requests
 from sqlalchemy import Integer, Numeric, cast, func, text
 
+from ..archive import archived_geocoded_counts, archived_point_count, archived_points, restore_archived, with_archived
 from ..background.jobs import JOB_TYPES, ImportJob
 from ..background import job_manager
-from ..models import DailyStatistic, Import, User, GPSData, db, AdditionalTrace
-from ..utils import login_required
+from ..importers import IMPORT_FORMATS, detect_import_format
+from ..ingest import InvalidPointError, mark_days_dirty, mark_days_dirty_for
+from ..map_format import MAP_MIMETYPE, encode_map_rows
+from ..cache import TTLCache
+from ..metrics import cache_lookup, record_query, registry
+from ..mvt import EXTENT, clip_line, encode_tile
+from ..response_cache import cached_response, data_version
+from ..simplify import TILE_SIZE, fit_zoom, grid_cell_sql, simplify
+from ..track_levels import map_row, track_level_rows
+from ..models import LATITUDE_SQL, LONGITUDE_SQL, ApiKey, DailyStatistic, Import, Place, User, GPSData, db, AdditionalTrace
+from ..utils import api_key_cache, bbox_filter, bbox_filter_sql, login_required, read_replica
 from ..config import Config
+from ..database import execute, raw_cursor
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
 from werkzeug.utils import secure_filename
 
 web_bp = Blueprint("web", __name__)
@@ -99,7 +114,7 @@ class JobsView(MethodView):
         if request.args.get("update"):
             return jsonify(jobs)
 
-        return render_template("jobs.jinja", jobs=jobs, photon_active=len(Config.PHOTON_SERVER_HOST) != 0)
+        return render_template("jobs.jinja", jobs=jobs, photon_active=len(Config.PHOTON_SERVER_HOST) != 0, archive_active=Config.ARCHIVE_AFTER_MONTHS > 0, track_levels_active=bool(Config.TRACK_LEVEL_ZOOMS))
     
     def post(self):
 
@@ -146,14 +161,25 @@ class JobsView(MethodView):
 class StatsView(MethodView):
     decorators = [login_required]
 
+    @read_replica
     def get(self):
+        # the navigation bar shows the user's traces, the page is cached per state of it
         user = g.current_user
-        trace = g.current_trace
-        
-
-        total_points = GPSData.query.filter_by(**g.trace_query).count()
-        total_geocoded = GPSData.query.filter_by(**g.trace_query).filter(GPSData.reverse_geocoded == True).count()
-        total_not_geocoded = GPSData.query.filter_by(**g.trace_query).filter(GPSData.reverse_geocoded == True).filter(GPSData.country == None).count()
+        navigation = (
+            str(user.id), user.is_admin, str(g.current_trace.id) if g.current_trace else None,
+            tuple((str(trace.id), trace.name) for trace in g.available_traces),
+        )
+        return cached_response("stats", navigation, self.stats_page)
+
+    def stats_page(self):
+        total_points = GPSData.query.filter_by(**g.trace_query).count() + archived_point_count(g.trace_query)
+        archived_geocoded, archived_unplaced = archived_geocoded_counts(g.trace_query)
+        total_geocoded = GPSData.query.filter_by(**g.trace_query).filter(GPSData.reverse_geocoded == True).count() + archived_geocoded
+        total_not_geocoded = (
+            GPSData.query.filter_by(**g.trace_query).filter(GPSData.reverse_geocoded == True)
+            .outerjoin(Place, GPSData.place_id == Place.id).filter(Place.country == None)
+            .count()
+        ) + archived_unplaced
         stats: list[DailyStatistic] = DailyStatistic.query.filter_by(**g.trace_query).all()
 
         # We'll group stats by year
@@ -239,13 +265,16 @@ class StatsView(MethodView):
 class YearlyStatsView(MethodView):
     decorators = [login_required]
 
+    @read_replica
     def get(self, year):
         user = g.current_user
 
         if not year:
             return "Missing year", 400
         
-        total_points = GPSData.query.filter_by(**g.trace_query).filter(func.extract("year", GPSData.timestamp) == year).count()
+        total_points = GPSData.query.filter_by(**g.trace_query).filter(
+            GPSData.timestamp >= datetime(year, 1, 1), GPSData.timestamp < datetime(year + 1, 1, 1)
+        ).count() + archived_point_count(g.trace_query, year)
 
         stats: list[DailyStatistic] = DailyStatistic.query.filter_by(**g.trace_query, year=year).all()
 
@@ -415,11 +444,14 @@ class PointsView(MethodView):
                     selected_ids = []
 
                 if selected_ids:
+                    restore_archived(g.trace_query, ids=selected_ids)
+
                     # Delete all points matching these IDs for this user
-                    GPSData.query\
+                    points_query = GPSData.query\
                         .filter_by(**g.trace_query)\
-                        .filter(GPSData.id.in_(selected_ids)
-                    ).delete(synchronize_session=False)
+                        .filter(GPSData.id.in_(selected_ids))
+                    mark_days_dirty_for(points_query)
+                    points_query.delete(synchronize_session=False)
                     db.session.commit()
 
         # Retrieve current query parameters to maintain state after action
@@ -440,7 +472,7 @@ class PointsView(MethodView):
 
 class ImportsView(MethodView):
     decorators = [login_required]
-    ALLOWED_EXTENSIONS = {"json"}
+    ALLOWED_EXTENSIONS = {"json", "geojson", "gpx"}
 
     def get(self):
         user = g.current_user
@@ -457,10 +489,13 @@ class ImportsView(MethodView):
                 "total_entries": imp.total_entries,
                 "total_imported": GPSData.query.filter_by(**g.trace_query, import_id=imp.id).count(),
                 "done_importing": imp.done_importing,
+                "error": imp.error,
+                "skipped_entries": imp.skipped_entries,
             })
 
 
-        return render_template("imports.jinja", imports=imports)
+        formats = list(dict.fromkeys(label for label, _, _ in IMPORT_FORMATS.values()))
+        return render_template("imports.jinja", imports=imports, formats=formats)
 
     def post(self):
         user = g.current_user
@@ -479,7 +514,7 @@ class ImportsView(MethodView):
             return "Unknown action", 400
 
     def upload_json_file(self, user):
-        """Handle the form submission where a user uploads a JSON file."""
+        """Handle the form submission where a user uploads an import file in one of the IMPORT_FORMATS."""
         file = request.files.get("json_file")
         if not file or file.filename == "":
             return "No file selected", 400
@@ -489,7 +524,7 @@ class ImportsView(MethodView):
         name = os.path.splitext(filename)[0]
         ext = os.path.splitext(filename)[1].lower()
         if ext.replace(".", "") not in self.ALLOWED_EXTENSIONS:
-            return "Invalid file type. Only .json allowed.", 400
+            return "Invalid file type. Only .json, .geojson and .gpx allowed.", 400
 
         # Save file to disk with a unique name to avoid collisions
         # Example: "user_<filename>_<user_id>_<uuid>.json"
@@ -497,14 +532,13 @@ class ImportsView(MethodView):
         save_path = os.path.join(Config.UPLOAD_FOLDER, unique_name)
         file.save(save_path)
 
-        # parse file
-        with open(save_path, "r") as f:
-            data = f.read()
-
+        # only check the format here, the entries are counted while importing
         try:
-            json_data = json.loads(data)
-        except json.JSONDecodeError:
-            return "Invalid JSON file", 400
+            with open(save_path, "rb") as f:
+                detect_import_format(f)
+        except InvalidPointError:
+            os.remove(save_path)
+            return "Unsupported file format", 400
         
         kwarg = {"user_id": user.id}
         if g.current_trace:
@@ -516,7 +550,7 @@ class ImportsView(MethodView):
             filename=unique_name,
             original_filename=filename,
             created_at=datetime.now(timezone.utc),
-            total_entries=len(json_data)
+            total_entries=0
         )
         db.session.add(new_import)
         db.session.commit()
@@ -556,9 +590,14 @@ class ImportsView(MethodView):
             if not import_record:
                 return "Import not found or not yours", 404
 
+        # Archived months with points of this import have to be back in gps_data to delete them
+        restore_archived({"owner_id": import_record.owner_id}, import_id=import_record.id)
+
         # First delete associated GPSData by this import_id
         # Note the "import_id" in GPSData is a string field, so match accordingly
-        GPSData.query.filter_by(import_id=str(import_record.id)).delete(synchronize_session=False)
+        points_query = GPSData.query.filter_by(import_id=str(import_record.id))
+        mark_days_dirty_for(points_query)
+        points_query.delete(synchronize_session=False)
 
         # Remove the import record itself
         db.session.delete(import_record)
@@ -580,6 +619,7 @@ class ExportsView(MethodView):
         # Render a simple page that has a button to trigger the download
         return render_template("exports.jinja")
 
+    @read_replica
     def post(self):
         user = g.current_user
 
@@ -591,6 +631,8 @@ class ExportsView(MethodView):
             .order_by(GPSData.timestamp.asc())
             .yield_per(1000)
         )
+        # archived months are older than every live point
+        points_query = chain(archived_points(g.trace_query), points_query)
 
         def generate_json():
             """
@@ -710,17 +752,21 @@ class MapView(MethodView):
         
         return s
     
+    @read_replica
     def post(self):
-        """Fetch GPS data using psycopg2 and return JSON."""
+        """Fetch GPS data using psycopg2 and return JSON, cached until the owner's data changes."""
 
         data: dict = request.json
+        response_format = request.accept_mimetypes.best_match(["application/json", MAP_MIMETYPE])
+        return cached_response("map", (json.dumps(data, sort_keys=True), response_format), lambda: self.map_data(data, response_format))
+
+    def map_data(self, data: dict, response_format: str):
 
         try:
             ne_lat = float(data.get("ne_lat"))
             ne_lng = float(data.get("ne_lng"))
             sw_lat = float(data.get("sw_lat"))
             sw_lng = float(data.get("sw_lng"))
-            # zoom = int(data.get("zoom", 10))
 
             ne_lat += 0.01
             ne_lng += 0.01
@@ -738,118 +784,153 @@ class MapView(MethodView):
         
         fetch_interpolated = bool(data.get("fetch_interpolated", True))
 
-        
-
-        user = g.current_user
-        
-        time1 = time.time()
-
-        conn = psycopg2.connect(
-            dbname=Config.DB_NAME,
-            user=Config.DB_USER,
-            password=Config.DB_PASS,
-            host=Config.DB_HOST
-        )
-        cursor = conn.cursor()
+        # without zoom the simplification fits the whole result on the screen
+        zoom = data.get("zoom")
+        zoom = float(zoom) if isinstance(zoom, (int, float)) else None
 
         max_points_count = 3000
         filters = ""
+        filter_params = []
 
         if end_date:
             end_date = end_date + " 23:59:59"
         
         if start_date and end_date:
-            filters = f"AND timestamp BETWEEN '{start_date}' AND '{end_date}'"
+            filters = "AND timestamp BETWEEN %s AND %s"
+            filter_params = [start_date, end_date]
         elif start_date:
-            filters = f"AND timestamp >= '{start_date}'"
+            filters = "AND timestamp >= %s"
+            filter_params = [start_date]
         elif end_date:
-            filters = f"AND timestamp <= '{end_date}'"
+            filters = "AND timestamp <= %s"
+            filter_params = [end_date]
 
         # filters += " AND horizontal_accuracy < 20"
 
 
-        user_trace_id = f"trace_id = '{g.current_trace.id}'" if g.current_trace else f"user_id = '{user.id}'"
+        owner_id = g.trace_query["owner_id"]
 
-        if ne_lat is None and ne_lng is None and sw_lat is None and sw_lng is None and fetch_interpolated:
-            query = f"""
-                WITH filtered_data AS (
-                    SELECT id, user_id, timestamp, latitude, longitude, horizontal_accuracy,
-                        altitude, vertical_accuracy, heading, heading_accuracy, speed, speed_accuracy,
-                        ROW_NUMBER() OVER (ORDER BY timestamp) AS row_num,
-                        COUNT(*) OVER () AS total
-                    FROM gps_data
-                    WHERE {user_trace_id}
-                    {filters}
-                )
-                SELECT id, user_id, timestamp, latitude, longitude, horizontal_accuracy,
-                    altitude, vertical_accuracy, heading, heading_accuracy, speed, speed_accuracy
-                FROM filtered_data
-                WHERE total <= {max_points_count} 
-                OR row_num % CEIL(total::FLOAT / {max_points_count})::INTEGER = 1
-                ORDER BY timestamp;
-            """
-        
-        elif not fetch_interpolated: # or (time_delta != 0 and time_delta < 60 * 60 * 25):
-            query = f"""
-                SELECT id, user_id, timestamp, latitude, longitude, horizontal_accuracy,
-                    altitude, vertical_accuracy, heading, heading_accuracy, speed, speed_accuracy
-                FROM gps_data
-                WHERE {user_trace_id}
-                {filters}
-                ORDER BY timestamp;
-            """
-        else:
-            query = f"""
-                WITH filtered_data AS (
-                    SELECT id, user_id, timestamp, latitude, longitude, horizontal_accuracy,
-                        altitude, vertical_accuracy, heading, heading_accuracy, speed, speed_accuracy,
-                        ROW_NUMBER() OVER (ORDER BY timestamp) AS row_num,
-                        COUNT(*) OVER () AS total
-                    FROM gps_data
-                    WHERE {user_trace_id}
-                    AND latitude BETWEEN {sw_lat} AND {ne_lat}
-                    AND longitude BETWEEN {sw_lng} AND {ne_lng}
-                    {filters}
-                )
-                SELECT id, user_id, timestamp, latitude, longitude, horizontal_accuracy,
-                    altitude, vertical_accuracy, heading, heading_accuracy, speed, speed_accuracy
-                FROM filtered_data
-                WHERE total <= {max_points_count} 
-                OR row_num % CEIL(total::FLOAT / {max_points_count})::INTEGER = 1
-                ORDER BY timestamp;
-            """
-
-        cursor.execute(query)
+        has_bbox = not (ne_lat is None and ne_lng is None and sw_lat is None and sw_lng is None)
 
-        time2 = time.time()
+        start = datetime.strptime(start_date, "%Y-%m-%d") if start_date else None
+        end = datetime.strptime(end_date, "%Y-%m-%d %H:%M:%S") if end_date else None
 
-        rows = cursor.fetchall()
+        # zoomed out, the precomputed levels answer without reading gps_data
+        rows = track_level_rows(
+            g.trace_query, zoom, start, end, (sw_lat, sw_lng, ne_lat, ne_lng) if has_bbox else None
+        ) if fetch_interpolated else None
 
-        gps_data = []
-        for row in rows:
-            gps_data.append({
-                "id": row[0],
-                "uid": row[1],
-                "t": row[2].astimezone(timezone.utc).isoformat() if row[2] else None,
-                "lat": row[3],
-                "lng": row[4],
-                "ha": row[5],
-                "a": row[6],
-                "va": row[7],
-                "h": row[8],
-                "ha2": row[9],
-                "s": row[10],
-                "sa": row[11],
-            })
+        if rows is not None:
+            rows, total = simplify(rows, max_points_count, Config.MAP_SIMPLIFY_TOLERANCE, zoom)
+            interpolated = True
+        else:
+            # Archived months are merged into the live rows before the simplification
+            archived = archived_points(
+                g.trace_query, start=start, end=end,
+                bbox=(sw_lat, sw_lng, ne_lat, ne_lng) if has_bbox and fetch_interpolated else None,
+            )
 
-        cursor.close()
-        conn.close()
+            if has_bbox and fetch_interpolated:
+                owner_filter, params = bbox_filter(owner_id, sw_lat, sw_lng, ne_lat, ne_lng)
+            else:
+                owner_filter, params = "owner_id = %s", [str(owner_id)]
+            params += filter_params
 
-        print(f"/gps_data: Time to data: {time2 - time1:.3f}s")
+            points = f"""
+                SELECT id, user_id, timestamp, {LATITUDE_SQL} AS latitude, {LONGITUDE_SQL} AS longitude, horizontal_accuracy,
+                    altitude, vertical_accuracy, heading, heading_accuracy, speed, speed_accuracy
+                FROM gps_data
+                WHERE {owner_filter}
+                {filters}
+            """
+            query = f"{points} ORDER BY timestamp"
 
-        # return jsonify(gps_data)
-        response = self.compress(gps_data)
-        response.headers["Is-Interpolated"] = len(gps_data) >= max_points_count - 100
+            if fetch_interpolated and zoom is None:
+                # the whole result is fitted on the screen, the zoom for that comes from its extent
+                cursor = raw_cursor()
+                try:
+                    query_start = time.perf_counter()
+                    execute(cursor, f"SELECT MIN(latitude), MIN(longitude), MAX(latitude), MAX(longitude) FROM ({points}) points", params)
+                    record_query(time.perf_counter() - query_start)
+                    south, west, north, east = cursor.fetchone()
+                finally:
+                    cursor.close()
+
+                corners = [(south, west), (north, east)] if south is not None else []
+                if archived:
+                    corners += [
+                        (min(point.latitude for point in archived), min(point.longitude for point in archived)),
+                        (max(point.latitude for point in archived), max(point.longitude for point in archived)),
+                    ]
+                if corners:
+                    zoom = fit_zoom(corners)
+
+            if fetch_interpolated and zoom is not None:
+                # Runs of points in the same tolerance-sized pixel cell are collapsed to their first
+                # point in the database, the simplification would drop the others anyway.
+                # The last point stays, it is the current end of the track.
+                cell_x, cell_y = grid_cell_sql("latitude", "longitude")
+                cells = 2 ** zoom * TILE_SIZE / Config.MAP_SIMPLIFY_TOLERANCE
+                query = f"""
+                    SELECT id, user_id, timestamp, latitude, longitude, horizontal_accuracy,
+                        altitude, vertical_accuracy, heading, heading_accuracy, speed, speed_accuracy
+                    FROM (
+                        SELECT *, LAG(cell_x) OVER w AS previous_x, LAG(cell_y) OVER w AS previous_y, LEAD(id) OVER w AS next_id
+                        FROM (SELECT *, {cell_x} AS cell_x, {cell_y} AS cell_y FROM ({points}) points) cells
+                        WINDOW w AS (ORDER BY timestamp)
+                    ) runs
+                    WHERE previous_x IS NULL OR next_id IS NULL OR (cell_x, cell_y) <> (previous_x, previous_y)
+                    ORDER BY timestamp
+                """
+                params = [cells, cells] + params
+
+            # the simplification reads the rows once as they stream in, so they are fetched in batches
+            cursor = raw_cursor(name="map_data" if fetch_interpolated else None)
+            cursor.itersize = 10000
+            try:
+                # raw cursors bypass the SQLAlchemy events, so time the statement here
+                query_start = time.perf_counter()
+                execute(cursor, query, params)
+                record_query(time.perf_counter() - query_start)
+
+                rows = iter(cursor)
+                if archived:
+                    rows = heapq.merge(rows, [map_row(point) for point in archived], key=lambda row: row[2])
+
+                if fetch_interpolated:
+                    rows, total = simplify(rows, max_points_count, Config.MAP_SIMPLIFY_TOLERANCE, zoom)
+                    interpolated = len(rows) < total
+                else:
+                    rows = list(rows)
+                    interpolated = False
+            finally:
+                cursor.close()
+
+        # the columnar format skips building a dict per point, and gzip has less to do on it
+        if response_format == MAP_MIMETYPE:
+            response = self.compress(encode_map_rows(rows), MAP_MIMETYPE, 6)
+        else:
+            gps_data = []
+            for row in rows:
+                gps_data.append({
+                    "id": row[0],
+                    "uid": row[1],
+                    "t": row[2].astimezone(timezone.utc).isoformat() if row[2] else None,
+                    "lat": row[3],
+                    "lng": row[4],
+                    "ha": row[5],
+                    "a": row[6],
+                    "va": row[7],
+                    "h": row[8],
+                    "ha2": row[9],
+                    "s": row[10],
+                    "sa": row[11],
+                })
+
+            # return jsonify(gps_data)
+            response = self.compress(json.dumps(gps_data).encode('utf8'), 'application/json')
+        response.headers["Vary"] = "Accept"
+        response.headers["Is-Interpolated"] = interpolated
 
         return response
 
@@ -863,34 +944,38 @@ class MapView(MethodView):
         if not isinstance(ids, list) or not ids:
             return "'ids' must be a non-empty array of IDs", 400
 
+        restore_archived(g.trace_query, ids=ids)
+
         # Bulk-delete all matching points belonging to the user
         # (and matching any extra filters in g.trace_query)
         points = GPSData.query.filter_by(**g.trace_query).filter(GPSData.id.in_(ids)).all()
         if not points:
             return "No points found for the given IDs", 404
         
+        mark_days_dirty([(point.user_id, point.trace_id, point.timestamp.date()) for point in points])
         for point in points:
             db.session.delete(point)
         db.session.commit()
 
         return jsonify({"deleted_ids": ids}), 200
     
-    def compress(self, data):
-        data = json.dumps(data).encode('utf8')
-        content = gzip.compress(data, 9)
+    def compress(self, data, content_type, level=9):
+        content = gzip.compress(data, level)
         response = make_response(content)
         response.headers['Content-length'] = len(content)
         response.headers['Content-Original-Length'] = len(data)
-        response.headers['Content-Type'] = 'application/json'
+        response.headers['Content-Type'] = content_type
         response.headers['Content-Encoding'] = 'gzip'
         return response
     
 class HeatMapDataView(MethodView):
     decorators = [login_required]
 
+    @read_replica
     def get(self):
-        user = g.current_user
+        return cached_response("heatmap", (), self.heatmap_data)
 
+    def heatmap_data(self):
         data = GPSData.query.with_entities(
             func.string_agg(
                 func.concat(
@@ -902,6 +987,13 @@ class HeatMapDataView(MethodView):
             )
         ).filter_by(**g.trace_query).scalar()
 
+        archived = "\n".join(
+            f"{round(point.latitude * 10000)},{round(point.longitude * 10000)}"
+            for point in archived_points(g.trace_query)
+        )
+        if archived:
+            data = f"{data}\n{archived}" if data else archived
+
         return self.compress(data)
     
     def compress(self, data):
@@ -1022,6 +1114,7 @@ class ManageUsersView(MethodView):
                 return "User not found", 404
             db.session.delete(user)
             db.session.commit()
+            api_key_cache.clear()
 
         elif action == "add_user":
             email = request.form.get("email")
@@ -1088,6 +1181,7 @@ class ManageTracesView(MethodView):
                 return "Trace not found", 404
             db.session.delete(trace)
             db.session.commit()
+            api_key_cache.clear()
 
         elif action == "add_trace":
             name = request.form.get("name")
@@ -1163,9 +1257,9 @@ class AccountView(MethodView):
         if "custom_api_key" in request.args:
             custom_api_key = request.args.get("custom_api_key")
             if custom_api_key:
-                key_exists = custom_api_key in [x[0] for x in sum([u.api_keys for u in User.query.all()], [])]
+                key_exists = ApiKey.query.filter_by(key=custom_api_key).first() is not None
                 if not key_exists:
-                    user.api_keys.append((custom_api_key, None))
+                    db.session.add(ApiKey(key=custom_api_key, user_id=user.id))
                     db.session.commit()
                     return "OK", 200
                 else:
@@ -1173,18 +1267,18 @@ class AccountView(MethodView):
             else:
                 return "Missing custom_api_key", 400
 
-        api_keys = user.api_keys
+        api_keys: list[ApiKey] = ApiKey.query.filter_by(user_id=user.id).order_by(ApiKey.created_at).all()
         traces = AdditionalTrace.query.filter_by(owner_id=user.id).all()
 
         api_key_list = []
-        for key, trace_id in api_keys:
+        for api_key in api_keys:
             name = "Main Trace"
-            if trace_id:
-                trace = AdditionalTrace.query.filter_by(id=trace_id).first()
+            if api_key.trace_id:
+                trace = AdditionalTrace.query.filter_by(id=api_key.trace_id).first()
                 if trace:
                     name = trace.name
 
-            api_key_list.append((key, trace_id, name))
+            api_key_list.append((api_key.key, api_key.trace_id, name))
 
         return render_template("account.jinja", api_keys=api_key_list, available_traces=traces)
 
@@ -1196,14 +1290,15 @@ class AccountView(MethodView):
             if len(trace_id) == 0 or not AdditionalTrace.query.filter_by(id=trace_id).first():
                 trace_id = None
 
-            user.api_keys.append((uuid.uuid4().hex, trace_id))
+            db.session.add(ApiKey(key=uuid.uuid4().hex, user_id=user.id, trace_id=trace_id))
             db.session.commit()
 
         if "delete_key" in request.form:
             api_key = request.form.get("api_key")
             if api_key:
-                user.api_keys = [(key, trace_id) for key, trace_id in user.api_keys if key != api_key]
+                ApiKey.query.filter_by(key=api_key, user_id=user.id).delete(synchronize_session=False)
                 db.session.commit()
+                api_key_cache.pop(api_key)
 
         if "update_account" in request.form:
             new_email = request.form.get("new_email")
@@ -1248,21 +1343,24 @@ class FullBleedBackground(MethodView):
     def get(self):
         global full_bleed_background_img_store, full_bleed_background_date_store
 
-        if g.current_user.id in full_bleed_background_img_store and full_bleed_background_date_store[g.current_user.id] > datetime.now() - timedelta(hours=12):
+        cached = g.current_user.id in full_bleed_background_img_store and full_bleed_background_date_store[g.current_user.id] > datetime.now() - timedelta(hours=12)
+        cache_lookup("full_bleed_background", cached)
+        if cached:
             resp = make_response(self.serve_pil_image(full_bleed_background_img_store[g.current_user.id]))
             resp.headers["Cache-Control"] = "public, max-age=43200"  # 12 hours
             resp.headers["Expires"] = (datetime.now() + timedelta(hours=12)).strftime("%a, %d %b %Y %H:%M:%S GMT")
             return resp
 
         # get last point
-        last_point: GPSData = GPSData.query.filter_by(user_id = g.current_user.id).order_by(GPSData.timestamp.desc()).first()
+        last_point: GPSData = GPSData.query.filter_by(owner_id=g.current_user.id).order_by(GPSData.timestamp.desc()).first()
         if not last_point:
             return "No points found", 404
         # get all points within 10000m of the last point
-        points = GPSData.query.filter_by(user_id = g.current_user.id).filter(
-            GPSData.latitude.between(last_point.latitude - 0.1, last_point.latitude + 0.1),
-            GPSData.longitude.between(last_point.longitude - 0.1, last_point.longitude + 0.1)
-        ).order_by(GPSData.timestamp.asc()).all()
+        points = GPSData.query.filter(text(bbox_filter_sql(
+            g.current_user.id,
+            last_point.latitude - 0.1, last_point.longitude - 0.1,
+            last_point.latitude + 0.1, last_point.longitude + 0.1,
+        ))).order_by(GPSData.timestamp.asc()).all()
         if not points:
             return "No points found", 404
         # generate image
@@ -1515,26 +1613,26 @@ class MapTileView(MethodView):
         return st[-1].c
 
     # -----------------------------------------------------------------------
+    @read_replica
     def get(self, z: int, x: int, y: int):
-        user_id = g.current_user.id
+        owner_id = g.trace_query["owner_id"]
 
         # Check if the tile is already cached
-        if (z, x, y) in map_tile_data_store:
-            img = map_tile_data_store[(z, x, y)]
+        cache_lookup("map_tile", (owner_id, z, x, y) in map_tile_data_store)
+        if (owner_id, z, x, y) in map_tile_data_store:
+            img = map_tile_data_store[(owner_id, z, x, y)]
             buf = BytesIO(); img.save(buf, "PNG"); buf.seek(0)
             return send_file(buf, mimetype="image/png")
 
         w, s, e, n = self.tile_bounds(z, x, y)
 
         sql = text(
-            """SELECT latitude, longitude, speed, "timestamp"
+            f"""SELECT {LATITUDE_SQL} AS latitude, {LONGITUDE_SQL} AS longitude, speed, "timestamp"
                FROM gps_data
-               WHERE user_id=:uid
-                 AND latitude BETWEEN :s AND :n
-                 AND longitude BETWEEN :w AND :e
+               WHERE {bbox_filter_sql(owner_id, s, w, n, e)}
                ORDER BY "timestamp" """
         )
-        rows = db.session.execute(sql, dict(uid=user_id, s=s, n=n, w=w, e=e)).fetchall()
+        rows = with_archived(db.session.execute(sql).fetchall(), g.trace_query, bbox=(s, w, n, e))
         if not rows:
             img = Image.new("RGBA", (self.TILE_SIZE, self.TILE_SIZE), (0, 0, 0, 0))
             buf = BytesIO()
@@ -1548,7 +1646,7 @@ class MapTileView(MethodView):
         buf = BytesIO(); img.save(buf, "PNG"); buf.seek(0)
 
         # Cache the tile
-        map_tile_data_store[(z, x, y)] = img
+        map_tile_data_store[(owner_id, z, x, y)] = img
 
         return send_file(buf, mimetype="image/png")
 
@@ -1570,13 +1668,7 @@ class MapTileView(MethodView):
             xa -= ox; ya -= oy; xb -= ox; yb -= oy
 
             # colour for this pair / point
-            speed_val = (
-                (a.speed + b.speed) / 2.0
-                if a.speed is not None and b.speed is not None
-                else self.haversine(a.lat, a.lon, b.lat, b.lon)
-                   / max((b.ts - a.ts).total_seconds(), 1)
-            )
-            colour = self.colour_for_speed(speed_val)
+            colour = self.colour_for_speed(self.pair_speed(a, b))
 
             dist = self.haversine(a.lat, a.lon, b.lat, b.lon)
 
@@ -1597,6 +1689,13 @@ class MapTileView(MethodView):
         return img
 
     # -----------------------------------------------------------------------
+    @classmethod
+    def pair_speed(cls, a, b):
+        """Speed between two points in m/s, from their recorded speeds or the distance."""
+        if a.speed is not None and b.speed is not None:
+            return (a.speed + b.speed) / 2.0
+        return cls.haversine(a.lat, a.lon, b.lat, b.lon) / max((b.ts - a.ts).total_seconds(), 1)
+
     @staticmethod
     def haversine(lat1, lon1, lat2, lon2):
         R = 6371000.0
@@ -1609,6 +1708,155 @@ class MapTileView(MethodView):
 
 
 
+# (owner_id, z, x, y, start_date, end_date) -> encoded tile
+vector_tile_cache = TTLCache(maxsize=2048, ttl=300)
+
+
+class VectorTileView(MethodView):
+    """
+    Serve /tiles/<z>/<x>/<y>.mvt as a Mapbox Vector Tile with a "tracks" layer: the points of
+    the tile, simplified for its zoom, as line strings with their mean speed in m/s. Points
+    further than MapTileView.MAX_POINT_DISTANCE from both neighbours are point features, like
+    the dots of the PNG tiles. Optional start_date/end_date (YYYY-MM-DD) limit the range.
+    """
+
+    decorators = [login_required]
+
+    LAYER = "tracks"
+    BUFFER = 256  # tile units drawn outside the tile, so lines join at the edges
+    SPEED_STEP = 10 / 3.6  # a line is split where the speed crosses a multiple of 10 km/h
+    METERS_PER_DEGREE = 111320  # of latitude
+
+    @read_replica
+    def get(self, z: int, x: int, y: int):
+        owner_id = g.trace_query["owner_id"]
+        start_date = request.args.get("start_date")
+        end_date = request.args.get("end_date")
+
+        # the data version makes tiles of changed data miss the cache, like cached_response
+        version, changed_at = data_version(owner_id)
+        key = (owner_id, version, z, x, y, start_date, end_date)
+        data = vector_tile_cache.get(key)
+        if data is None:
+            try:
+                start = datetime.strptime(start_date, "%Y-%m-%d") if start_date else None
+                end = datetime.strptime(end_date + " 23:59:59", "%Y-%m-%d %H:%M:%S") if end_date else None
+            except ValueError:
+                return "Invalid date", 400
+
+            data = encode_tile({self.LAYER: self.features(self.points(owner_id, z, x, y, start, end), z, x, y)})
+            # the read replica may not have the latest change yet
+            if not (Config.SQLALCHEMY_BINDS and time.monotonic() - changed_at < Config.DB_REPLICA_MAX_LAG):
+                vector_tile_cache.set(key, data)
+
+        response = Response(data, mimetype="application/vnd.mapbox-vector-tile")
+        response.headers["Cache-Control"] = "private, max-age=300"
+        return response
+
+    def query_bounds(self, z, x, y):
+        """
+        (west, south, east, north) of the tile and its BUFFER, widened by MAX_POINT_DISTANCE.
+        Only segments up to that long are drawn as lines, so both ends of every line crossing
+        the buffered tile are inside, even if no point lies in the tile itself.
+        """
+        n = 2 ** z
+        pad = self.BUFFER / EXTENT  # in tiles
+
+        def merc2lat(ty): return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * ty / n))))
+
+        margin_lat = MapTileView.MAX_POINT_DISTANCE / self.METERS_PER_DEGREE
+        north = merc2lat(y - pad) + margin_lat
+        south = merc2lat(y + 1 + pad) - margin_lat
+        margin_lon = margin_lat / max(math.cos(math.radians(min(max(abs(south), abs(north)), 89))), 0.01)
+
+        return (
+            max((x - pad) / n * 360.0 - 180.0 - margin_lon, -180),
+            max(south, -85.05112878),
+            min((x + 1 + pad) / n * 360.0 - 180.0 + margin_lon, 180),
+            min(north, 85.05112878),
+        )
+
+    def points(self, owner_id, z, x, y, start, end):
+        w, s, e, n = self.query_bounds(z, x, y)
+
+        filters = ""
+        params = {}
+        if start:
+            filters += ' AND "timestamp" >= :start'
+            params["start"] = start
+        if end:
+            filters += ' AND "timestamp" <= :end'
+            params["end"] = end
+
+        sql = text(
+            f"""SELECT {LATITUDE_SQL} AS latitude, {LONGITUDE_SQL} AS longitude, speed, "timestamp"
+               FROM gps_data
+               WHERE {bbox_filter_sql(owner_id, s, w, n, e)}{filters}
+               ORDER BY "timestamp" """
+        )
+        rows = with_archived(db.session.execute(sql, params).fetchall(), g.trace_query, start, end, bbox=(s, w, n, e))
+        return [MapTileView.Point(r.latitude, r.longitude, r.speed, r.timestamp) for r in rows]
+
+    def features(self, pts, z, tx, ty):
+        scale = EXTENT / MapTileView.TILE_SIZE
+        ox, oy = tx * MapTileView.TILE_SIZE, ty * MapTileView.TILE_SIZE
+
+        def tile_xy(p):
+            px, py = MapTileView.latlon_to_pixel(p.lat, p.lon, z)
+            return (px - ox) * scale, (py - oy) * scale
+
+        # tracks end where two points are too far apart to connect
+        tracks = [[]]
+        for a, b in zip([None] + pts[:-1], pts):
+            if a is not None and MapTileView.haversine(a.lat, a.lon, b.lat, b.lon) > MapTileView.MAX_POINT_DISTANCE:
+                tracks.append([])
+            tracks[-1].append(b)
+
+        features = []
+        for track in tracks:
+            if len(track) == 1:
+                px, py = tile_xy(track[0])
+                if 0 <= px < EXTENT and 0 <= py < EXTENT:
+                    features.append(("Point", [(px, py)], {"speed": track[0].speed}))
+                continue
+
+            kept, _ = simplify(
+                track, len(track), Config.MAP_SIMPLIFY_TOLERANCE, z, position=lambda p: (p.lat, p.lon)
+            )
+
+            # consecutive pairs in the same speed step form one line
+            runs = []
+            for a, b in zip(kept[:-1], kept[1:]):
+                speed = MapTileView.pair_speed(a, b)
+                step = int(speed // self.SPEED_STEP)
+                if runs and runs[-1][0] == step:
+                    runs[-1][1].append(b)
+                    runs[-1][2].append(speed)
+                else:
+                    runs.append((step, [a, b], [speed]))
+
+            for _, run, speeds in runs:
+                for part in clip_line([tile_xy(p) for p in run], -self.BUFFER, EXTENT + self.BUFFER):
+                    features.append(("LineString", part, {"speed": round(sum(speeds) / len(speeds), 2)}))
+
+        return features
+
+
+
+class MetricsView(MethodView):
+    """Prometheus scrape endpoint. Requires METRICS_TOKEN, without one it only answers local requests."""
+
+    def get(self):
+        if Config.METRICS_TOKEN:
+            if not hmac.compare_digest(request.headers.get("Authorization", ""), f"Bearer {Config.METRICS_TOKEN}"):
+                return "Unauthorized", 401
+        elif not ipaddress.ip_address(request.remote_addr or "0.0.0.0").is_loopback:
+            return "Forbidden, set METRICS_TOKEN to scrape from other hosts", 403
+
+        return Response(generate_latest(registry), mimetype=CONTENT_TYPE_LATEST)
+
+
+
 # Register the class-based views with the Blueprint
 web_bp.add_url_rule("/", view_func=HomeView.as_view("home"))
 web_bp.add_url_rule("/login", view_func=LoginView.as_view("login"), methods=["GET", "POST"])
@@ -1616,6 +1864,7 @@ web_bp.add_url_rule("/logout", view_func=LogoutView.as_view("logout"))
 web_bp.add_url_rule("/set_trace_id", view_func=SetTraceView.as_view("set_trace_id"), methods=["POST"])
 web_bp.add_url_rule("/full_bleed_background.png", view_func=FullBleedBackground.as_view("full_bleed_background"))
 web_bp.add_url_rule("/tiles/<int:z>/<int:x>/<int:y>.png", view_func=MapTileView.as_view("map_tile"))
+web_bp.add_url_rule("/tiles/<int:z>/<int:x>/<int:y>.mvt", view_func=VectorTileView.as_view("vector_tile"))
 web_bp.add_url_rule("/map", view_func=MapView.as_view("map"), methods=["GET", "POST", "DELETE"])
 web_bp.add_url_rule("/map/heatmap_data.csv", view_func=HeatMapDataView.as_view("heatmap_data"))
 web_bp.add_url_rule("/map/speed", view_func=SpeedMapView.as_view("speed_map"), methods=["GET", "POST"])
@@ -1628,3 +1877,4 @@ web_bp.add_url_rule("/manage_traces", view_func=ManageTracesView.as_view("manage
 web_bp.add_url_rule("/jobs", view_func=JobsView.as_view("jobs"), methods=["GET", "POST"])
 web_bp.add_url_rule("/imports", view_func=ImportsView.as_view("imports"), methods=["GET", "POST"])
 web_bp.add_url_rule("/exports", view_func=ExportsView.as_view("exports"), methods=["GET", "POST"])
+web_bp.add_url_rule("/metrics", view_func=MetricsView.as_view("metrics"))
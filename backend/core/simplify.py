@@ -0,0 +1,146 @@
+"""
+Shape-preserving simplification of GPS tracks for the map.
+
+Points are projected to Web Mercator pixels at the zoom the map is shown at. While the rows
+stream in, a radial distance filter drops every point closer than the pixel tolerance to the
+last kept one. Douglas-Peucker then removes the points that lie within the tolerance of the
+simplified line. While more than ``max_points`` remain, the tolerance is raised, so the
+deviation from the recorded track stays as small as the budget allows. Unlike keeping every
+Nth row, corners and short trips survive, and nothing that lands on the same pixel is sent.
+"""
+import math
+
+
+TILE_SIZE = 256
+MAX_LATITUDE = 85.05112878  # the Web Mercator square
+MAX_ZOOM = 22
+# Douglas-Peucker only runs once the radial passes got the points down to this many times the budget
+RADIAL_BUDGET_FACTOR = 10
+
+
+def project(lat: float, lon: float, zoom: float) -> tuple[float, float]:
+    """Web Mercator pixel coordinates of a point at ``zoom``, like the tiles of the map."""
+    n = 2 ** zoom * TILE_SIZE
+    siny = math.sin(math.radians(max(-MAX_LATITUDE, min(MAX_LATITUDE, lat))))
+    return (lon + 180) / 360 * n, (0.5 - math.log((1 + siny) / (1 - siny)) / (4 * math.pi)) * n
+
+
+def grid_cell_sql(latitude: str, longitude: str) -> tuple[str, str]:
+    """
+    SQL expressions of the grid cell of a point, ``project`` in SQL divided by the cell size.
+    Each takes one %s parameter, the number of cells around the world (2 ** zoom * TILE_SIZE / pixels per cell).
+    """
+    siny = f"sin(radians(LEAST(GREATEST({latitude}, -{MAX_LATITUDE}), {MAX_LATITUDE})))"
+    return (
+        f"floor(({longitude} + 180) / 360 * %s)",
+        f"floor((0.5 - ln((1 + {siny}) / (1 - {siny})) / (4 * pi())) * %s)",
+    )
+
+
+def fit_zoom(positions: list[tuple[float, float]], size: int = 1024) -> float:
+    """The zoom at which the (lat, lon) ``positions`` fit into ``size`` pixels."""
+    xs, ys = zip(*(project(lat, lon, 0) for lat, lon in positions))
+    span = max(max(xs) - min(xs), max(ys) - min(ys))
+    if span <= 0:
+        return MAX_ZOOM
+    return max(0.0, min(MAX_ZOOM, math.log2(size / span)))
+
+
+def douglas_peucker(xs: list[float], ys: list[float], tolerance: float) -> list[int]:
+    """Indexes of the points to keep so no removed point is further than ``tolerance`` from the line."""
+    count = len(xs)
+    if count < 3:
+        return list(range(count))
+
+    keep = [False] * count
+    keep[0] = keep[-1] = True
+    tolerance2 = tolerance * tolerance
+
+    stack = [(0, count - 1)]
+    while stack:
+        first, last = stack.pop()
+        ax, ay = xs[first], ys[first]
+        dx, dy = xs[last] - ax, ys[last] - ay
+        length2 = dx * dx + dy * dy
+
+        max_distance2, index = tolerance2, None
+        for i in range(first + 1, last):
+            px, py = xs[i] - ax, ys[i] - ay
+            if length2 > 0:
+                t = max(0.0, min(1.0, (px * dx + py * dy) / length2))
+                px, py = px - t * dx, py - t * dy
+            distance2 = px * px + py * py
+            if distance2 > max_distance2:
+                max_distance2, index = distance2, i
+
+        if index is not None:
+            keep[index] = True
+            stack.append((first, index))
+            stack.append((index, last))
+
+    return [i for i in range(count) if keep[i]]
+
+
+def radial_distance(xs: list[float], ys: list[float], indexes: list[int], tolerance: float) -> list[int]:
+    """The ``indexes`` of points at least ``tolerance`` away from the point kept before them, and the last one."""
+    if not indexes:
+        return indexes
+
+    tolerance2 = tolerance * tolerance
+    kept = [indexes[0]]
+    for i in indexes[1:-1]:
+        if (xs[i] - xs[kept[-1]]) ** 2 + (ys[i] - ys[kept[-1]]) ** 2 >= tolerance2:
+            kept.append(i)
+    if len(indexes) > 1:
+        kept.append(indexes[-1])
+    return kept
+
+
+def simplify(rows, max_points: int, tolerance: float, zoom: float = None, position=lambda row: (row[3], row[4])) -> tuple[list, int]:
+    """
+    Simplify an iterable of rows ordered by time to at most ``max_points`` rows, with a
+    ``tolerance`` in pixels at ``zoom``. If that keeps too many points, the tolerance is raised
+    until the budget is met. ``position`` returns the (lat, lon) of a row. Without zoom, the one
+    fitting all rows into 1024 pixels is used, which needs all rows in memory first.
+    Returns the kept rows and the number of rows read.
+    """
+    if zoom is None:
+        rows = list(rows)
+        if not rows:
+            return [], 0
+        zoom = fit_zoom([position(row) for row in rows])
+
+    tolerance2 = tolerance * tolerance
+    kept, xs, ys = [], [], []
+    total = 0
+    last_row = last_xy = None
+    for row in rows:
+        total += 1
+        x, y = project(*position(row), zoom)
+        last_row = row
+        if kept and (x - xs[-1]) ** 2 + (y - ys[-1]) ** 2 < tolerance2:
+            last_xy = (x, y)
+            continue
+        kept.append(row)
+        xs.append(x)
+        ys.append(y)
+        last_xy = None
+
+    # the current end of the track stays, even if it is close to the point before
+    if last_xy is not None:
+        kept.append(last_row)
+        xs.append(last_xy[0])
+        ys.append(last_xy[1])
+
+    # far above the budget, coarser radial passes are much cheaper than Douglas-Peucker
+    indexes = list(range(len(kept)))
+    while len(indexes) > RADIAL_BUDGET_FACTOR * max_points:
+        tolerance *= 2
+        indexes = radial_distance(xs, ys, indexes, tolerance)
+
+    indexes = [indexes[i] for i in douglas_peucker([xs[i] for i in indexes], [ys[i] for i in indexes], tolerance)]
+    while len(indexes) > max_points:
+        tolerance *= 1.5
+        indexes = [indexes[i] for i in douglas_peucker([xs[i] for i in indexes], [ys[i] for i in indexes], tolerance)]
+
+    return [kept[i] for i in indexes], total
@@ -0,0 +1,213 @@
+"""
+Precomputed multi-resolution tracks for the map.
+
+For every day of an owner and every zoom in TRACK_LEVEL_ZOOMS, a TrackLevel row holds the
+day's points simplified (see simplify.py) to MAP_SIMPLIFY_TOLERANCE pixels at the zoom above,
+so each level serves its own zoom and the next one. UpdateDailyStatisticsJob rebuilds the
+levels of dirty days, BuildTrackLevelsJob the whole history of a user.
+
+MapView.post answers zooms up to the highest level from here once the owner's levels are
+complete (a TrackLevelOwner row for the current zooms): it reads one small row per day, and
+the raw points only of dirty days whose levels are not rebuilt yet.
+"""
+from datetime import date, datetime, time, timedelta, timezone
+from itertools import groupby
+
+from sqlalchemy import func
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+from .archive import decode_points, encode_points, with_archived
+from .cache import TTLCache
+from .config import Config
+from .extensions import db
+from .models import ArchivedMonth, DailyStatisticDirty, GPSData, TrackLevel, TrackLevelOwner
+from .response_cache import data_changed
+from .simplify import fit_zoom, simplify
+
+
+# uncovered days read from gps_data, with more the caller queries gps_data for the whole range
+MAX_RAW_DAYS = 7
+
+# track level id -> decoded points. Rebuilding a day creates new rows
+track_level_cache = TTLCache(maxsize=Config.TRACK_LEVEL_CACHE_SIZE, ttl=3600)
+
+
+def map_row(point) -> tuple:
+    """The row MapView.post sends for a GPSData or ArchivedPoint."""
+    return (
+        point.id, str(point.user_id) if point.user_id else None, point.timestamp, point.latitude, point.longitude,
+        point.horizontal_accuracy, point.altitude, point.vertical_accuracy, point.heading, point.heading_accuracy,
+        point.speed, point.speed_accuracy,
+    )
+
+
+def level_zoom(zoom: float) -> int | None:
+    """The level serving ``zoom``, None above the highest one."""
+    zooms = sorted(Config.TRACK_LEVEL_ZOOMS)
+    if not zooms or zoom > zooms[-1] + 1:
+        return None
+    return max([level for level in zooms if level <= zoom], default=zooms[0])
+
+
+def build_levels(points: list) -> list[TrackLevel]:
+    """TrackLevel rows for ``points`` (of one owner, sorted by timestamp), one per day and zoom."""
+    levels = []
+    for day, day_points in groupby(points, key=lambda point: point.timestamp.date()):
+        day_points = list(day_points)
+        for zoom in Config.TRACK_LEVEL_ZOOMS:
+            kept, _ = simplify(
+                day_points, len(day_points), Config.MAP_SIMPLIFY_TOLERANCE, zoom + 1,
+                position=lambda point: (point.latitude, point.longitude),
+            )
+            levels.append(TrackLevel(
+                user_id=day_points[0].user_id,
+                trace_id=day_points[0].trace_id,
+                day=day,
+                zoom=zoom,
+                point_count=len(kept),
+                min_latitude=min(point.latitude for point in kept),
+                max_latitude=max(point.latitude for point in kept),
+                min_longitude=min(point.longitude for point in kept),
+                max_longitude=max(point.longitude for point in kept),
+                data=encode_points(kept),
+            ))
+    return levels
+
+
+def rebuild_days(query_kwargs: dict, days: list[date], points: list):
+    """
+    Replace the levels of an owner's ``days`` with ones built from ``points``, which are
+    all of the owner's points on these days. The caller commits.
+    """
+    if not Config.TRACK_LEVEL_ZOOMS:
+        return
+
+    TrackLevel.query.filter_by(**query_kwargs).filter(TrackLevel.day.in_(days)).delete(synchronize_session=False)
+    db.session.add_all(build_levels(points))
+    data_changed([query_kwargs["owner_id"]])
+
+
+def zooms_key() -> str:
+    return ",".join(str(zoom) for zoom in sorted(Config.TRACK_LEVEL_ZOOMS))
+
+
+def levels_complete(owner_id) -> bool:
+    """Whether every day of the owner has levels for the current TRACK_LEVEL_ZOOMS."""
+    return db.session.query(
+        TrackLevelOwner.query.filter_by(owner_id=owner_id, zooms=zooms_key()).exists()
+    ).scalar()
+
+
+def mark_levels_complete(owner_id):
+    """Record that all days of the owner have levels. The caller commits."""
+    values = {"zooms": zooms_key(), "built_at": datetime.now(timezone.utc)}
+    db.session.execute(
+        pg_insert(TrackLevelOwner)
+        .values(owner_id=owner_id, **values)
+        .on_conflict_do_update(index_elements=["owner_id"], set_=values)
+    )
+
+
+def owner_months(query_kwargs: dict) -> list[date]:
+    """First days of the months in which an owner has live or archived points."""
+    month = func.date_trunc("month", GPSData.timestamp)
+    months = {value.date() for (value,) in db.session.query(month).select_from(GPSData).filter_by(**query_kwargs).distinct()}
+    months.update(value for (value,) in db.session.query(ArchivedMonth.month).filter_by(**query_kwargs))
+    return sorted(months)
+
+
+def _day_filter(column, start: datetime = None, end: datetime = None) -> list:
+    filters = []
+    if start is not None:
+        filters.append(column >= start.date())
+    if end is not None:
+        filters.append(column <= end.date())
+    return filters
+
+
+def _decoded(levels: list) -> dict[int, list]:
+    """Decoded points by id of (id, user_id, trace_id) level rows, loading the blobs of uncached ones at once."""
+    points = {}
+    missing = {}
+    for level_id, user_id, trace_id in levels:
+        cached = track_level_cache.get(level_id)
+        if cached is None:
+            missing[level_id] = (user_id, trace_id)
+        else:
+            points[level_id] = cached
+
+    if missing:
+        for level_id, data in db.session.query(TrackLevel.id, TrackLevel.data).filter(TrackLevel.id.in_(missing)):
+            points[level_id] = decode_points(data, *missing[level_id])
+            track_level_cache.set(level_id, points[level_id])
+    return points
+
+
+def track_level_rows(query_kwargs: dict, zoom: float = None, start: datetime = None, end: datetime = None, bbox: tuple = None) -> list | None:
+    """
+    Map rows (see map_row) of an owner's points from ``start`` to ``end`` (whole days) inside
+    the (south, west, north, east) ``bbox``, taken from the level serving ``zoom``, or the zoom
+    fitting the whole range. Sorted by timestamp. None if the levels can not answer.
+    """
+    zooms = sorted(Config.TRACK_LEVEL_ZOOMS)
+    # until BuildTrackLevelsJob finished, days without levels can not be told apart from days without points
+    if not zooms or not levels_complete(query_kwargs["owner_id"]):
+        return None
+
+    if zoom is None:
+        south, north, west, east = db.session.query(
+            func.min(TrackLevel.min_latitude), func.max(TrackLevel.max_latitude),
+            func.min(TrackLevel.min_longitude), func.max(TrackLevel.max_longitude),
+        ).filter_by(**query_kwargs, zoom=zooms[0]).filter(*_day_filter(TrackLevel.day, start, end)).one()
+        if south is None:
+            return None
+        zoom = fit_zoom([(south, west), (north, east)])
+
+    level = level_zoom(zoom)
+    if level is None:
+        return None
+
+    levels = (
+        db.session.query(
+            TrackLevel.id, TrackLevel.user_id, TrackLevel.trace_id, TrackLevel.day,
+            TrackLevel.min_latitude, TrackLevel.max_latitude, TrackLevel.min_longitude, TrackLevel.max_longitude,
+        )
+        .filter_by(**query_kwargs, zoom=level).filter(*_day_filter(TrackLevel.day, start, end))
+        .all()
+    )
+
+    # every day has levels, days with changed points are dirty until their levels are rebuilt
+    raw_days = {day for (day,) in db.session.query(DailyStatisticDirty.day).filter(
+        func.coalesce(DailyStatisticDirty.trace_id, DailyStatisticDirty.user_id) == query_kwargs["owner_id"],
+        *_day_filter(DailyStatisticDirty.day, start, end),
+    )}
+    if len(raw_days) > MAX_RAW_DAYS:
+        return None
+
+    def inside(point):
+        return bbox is None or (bbox[0] <= point.latitude <= bbox[2] and bbox[1] <= point.longitude <= bbox[3])
+
+    levels = [
+        level_row for level_row in levels
+        if level_row.day not in raw_days and (bbox is None or (
+            level_row.max_latitude >= bbox[0] and level_row.min_latitude <= bbox[2]
+            and level_row.max_longitude >= bbox[1] and level_row.min_longitude <= bbox[3]
+        ))
+    ]
+    decoded = _decoded([(level_row.id, level_row.user_id, level_row.trace_id) for level_row in levels])
+    points = [point for level_row in levels for point in decoded[level_row.id] if inside(point)]
+
+    for day in raw_days:
+        day_start = datetime.combine(day, time.min)
+        day_end = day_start + timedelta(days=1)
+        day_points = (
+            GPSData.query.filter_by(**query_kwargs)
+            .filter(GPSData.timestamp >= day_start, GPSData.timestamp < day_end)
+            .order_by(GPSData.timestamp)
+            .all()
+        )
+        day_points = with_archived(day_points, query_kwargs, day_start, day_end - timedelta(microseconds=1), bbox)
+        points.extend(point for point in day_points if inside(point))
+
+    points.sort(key=lambda point: point.timestamp)
+    return [map_row(point) for point in points]
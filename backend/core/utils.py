@@ -1,14 +1,26 @@
 import os
 import traceback
+import uuid
 import flask
 
 from flask import session, redirect, url_for, g
 from functools import wraps
 
-import psycopg2
-from .models import User, AdditionalTrace
+from sqlalchemy import text
+from .archive import decode_points
+from .cache import TTLCache
+from .models import User, AdditionalTrace, ApiKey
 from .config import Config
-from .models import GPSData, Import, User, db
+from .models import (
+    LATITUDE_COLUMN, LATITUDE_SQL, LONGITUDE_COLUMN, LONGITUDE_SQL,
+    ArchivedMonth, DailyStatistic, GPSData, Import, User, db, stored_coordinate,
+)
+from .partitioning import is_partitioned, migrate_gps_data_partitioning
+from .places import PLACE_FIELDS, place_key_sql
+
+# api key -> (user_id, trace_id), so ingest requests skip the api_key table lookup
+# and load no ORM objects at all
+api_key_cache = TTLCache(maxsize=Config.API_KEY_CACHE_SIZE, ttl=Config.API_KEY_CACHE_TTL)
 
 def login_required(f):
     """Decorator to ensure the user is logged in (session-based) for HTML routes."""
@@ -27,9 +39,7 @@ def login_required(f):
 
         g.current_trace = get_current_trace()
 
-        g.trace_query = {"user_id": g.current_user.id}
-        if g.current_trace:
-            g.trace_query = {"trace_id": g.current_trace.id}
+        g.trace_query = {"owner_id": (g.current_trace or g.current_user).id}
 
 
 
@@ -41,27 +51,61 @@ def login_required(f):
         return f(*args, **kwargs)
     return decorated_function
 
+def read_replica(f):
+    """
+    Decorator for read-only views: their queries go to the read replica while it is
+    available and not lagging too far behind, see extensions.RoutingSession.
+    """
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        g.read_replica = True
+        return f(*args, **kwargs)
+    return decorated_function
+
 def api_key_required(f):
     """Decorator for REST endpoints that requires an API key."""
     @wraps(f)
     def decorated_function(*args, **kwargs):
         api_key = flask.request.args.get("api_key")
-        user = User.get_user_from_api_key(api_key)
-        trace = User.get_trace_from_api_key(api_key)
+        user_id, trace_id = resolve_api_key(api_key)
 
-        if not user:
+        if not user_id:
             return {"error": "Invalid or missing API key"}, 401
-        
-        g.current_user = user
-        g.current_trace = trace
 
-        g.trace_query = {"user_id": g.current_user.id}
-        if g.current_trace:
-            g.trace_query = {"trace_id": g.current_trace.id}
+        # views that need the User or AdditionalTrace load them with api_key_owner()
+        g.api_key_ids = (user_id, trace_id)
+        # the (user_id, trace_id) new points are stored under, see ingest.owner_ids
+        g.owner_ids = (None, str(trace_id)) if trace_id else (str(user_id), None)
+
+        g.trace_query = {"owner_id": trace_id or user_id}
 
         return f(*args, **kwargs)
     return decorated_function
 
+def resolve_api_key(api_key):
+    """Return the (user_id, trace_id) pair an API key belongs to, or (None, None) if it is unknown."""
+    if not api_key:
+        return None, None
+
+    ids = api_key_cache.get(api_key)
+    if ids is None:
+        entry = ApiKey.query.filter_by(key=api_key).first()
+        if not entry:
+            return None, None
+
+        ids = (entry.user_id, entry.trace_id)
+        api_key_cache.set(api_key, ids)
+
+    return ids
+
+def api_key_owner():
+    """The (user, trace) of the API key of the current request, loaded on first use."""
+    if "current_user" not in g:
+        user_id, trace_id = g.api_key_ids
+        g.current_user = User.query.get(user_id)
+        g.current_trace = AdditionalTrace.query.get(trace_id) if trace_id else None
+    return g.current_user, g.current_trace
+
 def get_current_user():
     """Return the currently logged-in user object (or None) using the session."""
     if "user_id" in session:
@@ -85,12 +129,7 @@ def create_default_user():
 
 
     # Code to manually update the database schema
-    conn = psycopg2.connect(
-        dbname=Config.DB_NAME,
-        user=Config.DB_USER,
-        password=Config.DB_PASS,
-        host=Config.DB_HOST
-    )
+    conn = db.engine.raw_connection()
     cursor = conn.cursor()
 
     # #user_id = db.Column(UUID(as_uuid=True), db.ForeignKey("user.id"), nullable=True) # change nullable to true
@@ -127,7 +166,7 @@ def create_default_user():
 
 
 
-    db.create_all()
+    db.create_all(bind_key=None)  # not on the read replica
 
     # make sure the tables conform to the latest schema
     db.session.commit()
@@ -158,9 +197,271 @@ def create_default_user():
     #     db.session.add(user)
     #     db.session.commit()
 
+# tables with the generated owner_id column, see models.GPSData.owner_id
+OWNER_TABLES = ("gps_data", "daily_statistic", "import", "archived_month")
+
+def migrate_owner_id():
+    """
+    Add the generated owner_id column to tables created before it existed, and move indexes
+    over COALESCE(trace_id, user_id) onto it under their old names. Adding the column rewrites
+    the table, so this takes a while on large databases.
+    """
+    for table in OWNER_TABLES:
+        column_exists = db.session.execute(text(
+            "SELECT 1 FROM information_schema.columns "
+            "WHERE table_schema = current_schema() AND table_name = :table AND column_name = 'owner_id'"
+        ), {"table": table}).first()
+        if column_exists:
+            continue
+
+        print(f"Adding owner_id column to {table}, this can take a while...")
+        db.session.execute(text(
+            f'ALTER TABLE "{table}" ADD COLUMN owner_id UUID GENERATED ALWAYS AS (COALESCE(trace_id, user_id)) STORED'
+        ))
+
+    # indexes of partitions that belong to an index of the partitioned table are replaced along with it
+    old_indexes = db.session.execute(text("""
+        SELECT index.relname, pg_get_indexdef(i.indexrelid) FROM pg_index i
+        JOIN pg_class index ON index.oid = i.indexrelid
+        JOIN pg_class t ON t.oid = i.indrelid
+        WHERE (t.relname = ANY(:tables) OR t.relname LIKE 'gps_data\\_p%')
+          AND pg_get_indexdef(i.indexrelid) LIKE '%COALESCE(trace_id, user_id)%'
+          AND i.indexrelid NOT IN (SELECT inhrelid FROM pg_inherits)
+    """), {"tables": list(OWNER_TABLES)}).fetchall()
+    for name, indexdef in old_indexes:
+        print(f"Moving index {name} onto owner_id...")
+        db.session.execute(text(f'DROP INDEX "{name}"'))
+        db.session.execute(text(indexdef.replace("COALESCE(trace_id, user_id)", "owner_id")))
+
+    for model in (DailyStatistic, Import):
+        for index in model.__table__.indexes:
+            index.create(db.session.connection(), checkfirst=True)
+
+    db.session.commit()
+
+def migrate_gps_data_unique_index():
+    """Remove duplicate points and add the owner/point unique index to an existing gps_data table."""
+    if is_partitioned():
+        return  # the partitions carry this index, see partitioning.create_partition
+
+    index_exists = db.session.execute(
+        text("SELECT 1 FROM pg_indexes WHERE tablename = 'gps_data' AND indexname = 'uq_gps_data_owner_point'")
+    ).first()
+    if index_exists:
+        return
+
+    print("Removing duplicate GPS points before adding unique index...")
+    db.session.execute(text(f"""
+        DELETE FROM gps_data a
+        USING gps_data b
+        WHERE a.id > b.id
+          AND a.owner_id = b.owner_id
+          AND a.timestamp = b.timestamp
+          AND a.{LATITUDE_COLUMN} = b.{LATITUDE_COLUMN}
+          AND a.{LONGITUDE_COLUMN} = b.{LONGITUDE_COLUMN}
+    """))
+
+    for index in GPSData.__table__.indexes:
+        if index.name == "uq_gps_data_owner_point":
+            index.create(db.session.connection())
+
+    db.session.commit()
+
+# the float8 measurement columns that become float4 in the compact layout
+COMPACT_MEASUREMENT_COLUMNS = (
+    "horizontal_accuracy", "altitude", "vertical_accuracy", "heading", "heading_accuracy", "speed", "speed_accuracy",
+)
+
+def migrate_gps_data_compact():
+    """
+    With GPS_DATA_COMPACT, convert gps_data to the compact layout (see models.COORDINATE_SCALE).
+    This rewrites the table once and cannot be reverted by unsetting the option. Points that
+    only differed below 1e-7 degrees become duplicates and are removed first.
+    """
+    if not Config.GPS_DATA_COMPACT:
+        return
+
+    column_exists = db.session.execute(text(
+        "SELECT 1 FROM information_schema.columns "
+        "WHERE table_schema = current_schema() AND table_name = 'gps_data' AND column_name = 'latitude_e7'"
+    )).first()
+    if column_exists:
+        return
+
+    print("Converting gps_data to the compact layout, this can take a while...")
+    db.session.execute(text("""
+        DELETE FROM gps_data a
+        USING gps_data b
+        WHERE a.id > b.id
+          AND a.owner_id = b.owner_id
+          AND a.timestamp = b.timestamp
+          AND ROUND(a.latitude * 1e7) = ROUND(b.latitude * 1e7)
+          AND ROUND(a.longitude * 1e7) = ROUND(b.longitude * 1e7)
+    """))
+
+    # the generated geometry depends on the coordinates, migrate_gps_data_geometry adds it again
+    db.session.execute(text("ALTER TABLE gps_data DROP COLUMN IF EXISTS geom"))
+
+    measurements = ", ".join(f"ALTER COLUMN {name} TYPE real" for name in COMPACT_MEASUREMENT_COLUMNS)
+    db.session.execute(text(f"""
+        ALTER TABLE gps_data
+        ALTER COLUMN latitude TYPE integer USING ROUND(latitude * 1e7),
+        ALTER COLUMN longitude TYPE integer USING ROUND(longitude * 1e7),
+        {measurements}
+    """))
+    db.session.execute(text("ALTER TABLE gps_data RENAME COLUMN latitude TO latitude_e7"))
+    db.session.execute(text("ALTER TABLE gps_data RENAME COLUMN longitude TO longitude_e7"))
+    db.session.commit()
+    print("gps_data now uses the compact layout.")
+
+def migrate_gps_data_places():
+    """
+    Move the reverse geocoding columns of an existing gps_data table into the place table
+    (see places.py) and replace them with place_id. Every distinct result becomes one place.
+    """
+    column_exists = db.session.execute(text(
+        "SELECT 1 FROM information_schema.columns "
+        "WHERE table_schema = current_schema() AND table_name = 'gps_data' AND column_name = 'country'"
+    )).first()
+    if not column_exists:
+        return
+
+    print("Moving reverse geocoding results of gps_data into the place table, this can take a while...")
+    fields = ", ".join(PLACE_FIELDS)
+    any_field = " OR ".join(f"gps_data.{name} IS NOT NULL" for name in PLACE_FIELDS)
+
+    db.session.execute(text("ALTER TABLE gps_data ADD COLUMN IF NOT EXISTS place_id INTEGER REFERENCES place (id)"))
+    db.session.execute(text(f"""
+        INSERT INTO place (key, {fields})
+        SELECT DISTINCT ON (key) {place_key_sql("gps_data")} AS key, {fields}
+        FROM gps_data
+        WHERE {any_field}
+        ON CONFLICT (key) DO NOTHING
+    """))
+    db.session.execute(text(f"""
+        UPDATE gps_data SET place_id = place.id
+        FROM place
+        WHERE ({any_field}) AND place.key = {place_key_sql("gps_data")}
+    """))
+    db.session.execute(text("ALTER TABLE gps_data " + ", ".join(f"DROP COLUMN {name}" for name in PLACE_FIELDS)))
+    db.session.execute(text("CREATE INDEX IF NOT EXISTS ix_gps_data_owner_place ON gps_data (owner_id, place_id)"))
+    db.session.commit()
+    print("gps_data now references the place table.")
+
+def migrate_gps_data_geometry():
+    """
+    With POSTGIS_ENABLED, add a generated point geometry column to gps_data and a GiST index
+    over owner and geometry, so bounding box queries of one owner become index scans.
+    The column is generated from latitude/longitude, so every insert and update maintains it.
+    """
+    if not Config.POSTGIS_ENABLED:
+        return
+
+    index_exists = db.session.execute(
+        text("SELECT 1 FROM pg_indexes WHERE tablename = 'gps_data' AND indexname = 'ix_gps_data_owner_geom'")
+    ).first()
+    if index_exists:
+        return
+
+    print("Adding PostGIS geometry column and spatial index to gps_data...")
+    db.session.execute(text("CREATE EXTENSION IF NOT EXISTS postgis"))
+    db.session.execute(text("CREATE EXTENSION IF NOT EXISTS btree_gist"))  # uuid in the GiST index
+    db.session.execute(text(f"""
+        ALTER TABLE gps_data ADD COLUMN IF NOT EXISTS geom geometry(Point, 4326)
+        GENERATED ALWAYS AS (ST_SetSRID(ST_MakePoint({LONGITUDE_SQL}, {LATITUDE_SQL}), 4326)) STORED
+    """))
+    db.session.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_gps_data_owner_geom ON gps_data USING gist (owner_id, geom)"
+    ))
+    db.session.commit()
+
+def migrate_archived_month_geocoded():
+    """Add the reverse geocoding counts (see models.ArchivedMonth.geocoded_count) to existing archives."""
+    column_exists = db.session.execute(text(
+        "SELECT 1 FROM information_schema.columns "
+        "WHERE table_schema = current_schema() AND table_name = 'archived_month' AND column_name = 'geocoded_count'"
+    )).first()
+    if column_exists:
+        return
+
+    print("Counting reverse geocoded points of archived months...")
+    db.session.execute(text(
+        "ALTER TABLE archived_month ADD COLUMN geocoded_count INTEGER NOT NULL DEFAULT 0, "
+        "ADD COLUMN unplaced_count INTEGER NOT NULL DEFAULT 0"
+    ))
+    for archive in ArchivedMonth.query.yield_per(16):
+        points = decode_points(archive.data)
+        archive.geocoded_count = sum(1 for point in points if point.reverse_geocoded)
+        archive.unplaced_count = sum(1 for point in points if point.reverse_geocoded and point.country is None)
+        db.session.flush()
+    db.session.commit()
+
+def migrate_import_error():
+    """Add the error and skipped_entries columns to an existing import table."""
+    db.session.execute(text('ALTER TABLE "import" ADD COLUMN IF NOT EXISTS error VARCHAR(255)'))
+    db.session.execute(text('ALTER TABLE "import" ADD COLUMN IF NOT EXISTS skipped_entries INTEGER DEFAULT 0'))
+    db.session.commit()
+
+def migrate_archived_month_ids():
+    """
+    Add the id range and import ids (see models.ArchivedMonth.min_id) to archives created
+    before they existed. Every archive is decoded once to fill them.
+    """
+    column_exists = db.session.execute(text(
+        "SELECT 1 FROM information_schema.columns "
+        "WHERE table_schema = current_schema() AND table_name = 'archived_month' AND column_name = 'min_id'"
+    )).first()
+    if column_exists:
+        return
+
+    print("Adding point id ranges to archived months...")
+    db.session.execute(text(
+        "ALTER TABLE archived_month ADD COLUMN min_id INTEGER, ADD COLUMN max_id INTEGER, "
+        "ADD COLUMN import_ids UUID[] NOT NULL DEFAULT '{}'"
+    ))
+    for archive in ArchivedMonth.query.yield_per(16):
+        points = decode_points(archive.data)
+        archive.min_id = min(point.id for point in points)
+        archive.max_id = max(point.id for point in points)
+        archive.import_ids = sorted({uuid.UUID(point.import_id) for point in points if point.import_id})
+        db.session.flush()
+    db.session.execute(text("ALTER TABLE archived_month ALTER COLUMN min_id SET NOT NULL, ALTER COLUMN max_id SET NOT NULL"))
+    db.session.commit()
+
+def bbox_filter(owner_id, south: float, west: float, north: float, east: float) -> tuple[str, list]:
+    """
+    SQL condition with psycopg2 placeholders for the points of one owner inside a bounding box,
+    and its parameters. Uses the spatial index when POSTGIS_ENABLED is set.
+    """
+    owner_id = str(uuid.UUID(str(owner_id)))
+    south, west, north, east = float(south), float(west), float(north), float(east)
+
+    if Config.POSTGIS_ENABLED:
+        return "owner_id = %s AND geom && ST_MakeEnvelope(%s, %s, %s, %s, 4326)", [owner_id, west, south, east, north]
+
+    return (
+        f"owner_id = %s AND {LATITUDE_COLUMN} BETWEEN %s AND %s AND {LONGITUDE_COLUMN} BETWEEN %s AND %s",
+        [owner_id, stored_coordinate(south), stored_coordinate(north), stored_coordinate(west), stored_coordinate(east)],
+    )
+
+def bbox_filter_sql(owner_id, south: float, west: float, north: float, east: float) -> str:
+    """bbox_filter with the parameters inlined, they are only a uuid and numbers."""
+    sql, params = bbox_filter(owner_id, south, west, north, east)
+    return sql % tuple(f"'{param}'" if isinstance(param, str) else param for param in params)
+
 def check_db():
     """Check if the database is empty and create a default user."""
 
+    migrate_owner_id()
+    migrate_gps_data_compact()
+    migrate_gps_data_places()
+    migrate_gps_data_unique_index()
+    migrate_gps_data_partitioning()
+    migrate_gps_data_geometry()
+    migrate_archived_month_ids()
+    migrate_archived_month_geocoded()
+    migrate_import_error()
+
     # check for any files in the upload folder that are not in the database
     for file in os.listdir(Config.UPLOAD_FOLDER):
         if not Import.query.filter_by(filename=file).first():
@@ -184,6 +485,21 @@ def check_db():
                 total_entries=total_entries
             )
 
+
+    # move api keys from the legacy json column on the user into the api_key table
+    for user in User.query.all():
+        if not user.api_keys:
+            continue
+
+        for key, trace_id in user.api_keys:
+            if ApiKey.query.filter_by(key=key).first():
+                continue
+
+            trace = AdditionalTrace.query.get(trace_id) if trace_id else None
+            db.session.add(ApiKey(key=key, user_id=user.id, trace_id=trace.id if trace else None))
+
+        user.api_keys = []
+        db.session.commit()
     
     for import_obj in Import.query.all():
         if import_obj.filename == "":
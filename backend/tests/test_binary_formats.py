@@ -0,0 +1,155 @@
+"""Round trips and broken input for the binary formats: WPDB (ingest), WPDA (archive) and WPDM (map)."""
+from array import array
+from datetime import datetime, timedelta, timezone
+import math
+import uuid
+
+import pytest
+import zstandard
+
+from core.archive import ARCHIVE_FLOAT_COLUMNS, ARCHIVE_STRING_COLUMNS, ArchivedPoint, decode_points, encode_points
+from core.ingest import BINARY_COORD_SCALE, BINARY_HEADER, BINARY_MAGIC, BINARY_VERSION, InvalidPointError, decode_binary_batch
+from core.map_format import decode_map_rows, encode_map_rows
+
+
+USER_ID = uuid.uuid4()
+BASE = datetime(2024, 5, 1, 12, 0, 0)
+
+
+def binary_batch(points: list[tuple], optional: dict = None) -> bytes:
+    """WPDB payload of (timestamp, latitude, longitude) points, ``optional`` maps a column bit to its values."""
+    optional = optional or {}
+    timestamps = [math.floor(ts.replace(tzinfo=timezone.utc).timestamp()) for ts, _, _ in points]
+    base = timestamps[0] if points else 0
+    flags = sum(1 << bit for bit in optional)
+
+    payload = BINARY_HEADER.pack(BINARY_MAGIC, BINARY_VERSION, flags, 0, len(points), base)
+    payload += array("i", [b - a for a, b in zip([base] + timestamps, timestamps)]).tobytes()
+    payload += array("i", [round(lat * BINARY_COORD_SCALE) for _, lat, _ in points]).tobytes()
+    payload += array("i", [round(lon * BINARY_COORD_SCALE) for _, _, lon in points]).tobytes()
+    for bit in sorted(optional):
+        payload += array("f", (math.nan if value is None else value for value in optional[bit])).tobytes()
+    return payload
+
+
+def archived_points(count: int) -> list[ArchivedPoint]:
+    points = []
+    for i in range(count):
+        floats = [None if (i + j) % 3 == 0 else float(i + j) for j in range(len(ARCHIVE_FLOAT_COLUMNS))]
+        strings = [None if i % 2 else f"{name}-{i % 4}" for name in ARCHIVE_STRING_COLUMNS]
+        points.append(ArchivedPoint(
+            1000 + i * 7, USER_ID, None, BASE + timedelta(seconds=i * 30, microseconds=i),
+            52.5 + i * 1e-4, -13.4 - i * 1e-4, *floats, i % 2 == 0, *strings,
+        ))
+    return points
+
+
+def map_rows(count: int) -> list[tuple]:
+    return [
+        (
+            2 ** 31 - 1000 + i * 3, str(USER_ID) if i % 3 else None,
+            (BASE + timedelta(seconds=i * 45)).replace(tzinfo=timezone.utc),
+            -33.9 + i * 1e-4, 151.2 + i * 1e-4,
+            5.0, None, None, float(i % 360), None, 1.5 * i, None,
+        )
+        for i in range(count)
+    ]
+
+
+def test_binary_batch_round_trip():
+    points = [(BASE + timedelta(seconds=i * 10), 48.1 + i * 1e-5, 11.5 - i * 1e-5) for i in range(50)]
+    accuracies = [None if i % 5 == 0 else 4.0 for i in range(50)]
+    rows = decode_binary_batch(binary_batch(points, {0: accuracies}), USER_ID, None)
+
+    assert len(rows) == len(points)
+    for row, (ts, lat, lon), accuracy in zip(rows, points, accuracies):
+        assert row[0] == USER_ID and row[1] is None
+        assert row[3] == ts.replace(tzinfo=timezone.utc)
+        assert row[4] == pytest.approx(lat, abs=1e-7)
+        assert row[5] == pytest.approx(lon, abs=1e-7)
+        assert row[6] == accuracy
+        assert row[7:13] == (None,) * 6
+
+
+def test_binary_batch_empty():
+    assert decode_binary_batch(binary_batch([]), USER_ID, None) == []
+
+
+@pytest.mark.parametrize("length", [0, 5, BINARY_HEADER.size, BINARY_HEADER.size + 4, -1])
+def test_binary_batch_truncated(length):
+    data = binary_batch([(BASE, 1.0, 2.0), (BASE, 3.0, 4.0)])
+    with pytest.raises(InvalidPointError):
+        decode_binary_batch(data[:length], USER_ID, None)
+
+
+def test_binary_batch_unknown_format():
+    data = binary_batch([(BASE, 1.0, 2.0)])
+    with pytest.raises(InvalidPointError):
+        decode_binary_batch(b"XXXX" + data[4:], USER_ID, None)
+
+
+@pytest.mark.parametrize("latitude, longitude", [(90.5, 0.0), (-91.0, 0.0), (0.0, 180.5), (0.0, -200.0)])
+def test_binary_batch_out_of_range(latitude, longitude):
+    data = binary_batch([(BASE, 10.0, 10.0), (BASE, latitude, longitude)])
+    with pytest.raises(InvalidPointError):
+        decode_binary_batch(data, USER_ID, None)
+
+
+def test_archive_round_trip():
+    points = archived_points(100)
+    decoded = decode_points(encode_points(points), USER_ID, None)
+
+    assert len(decoded) == len(points)
+    for point, original in zip(decoded, points):
+        assert point.id == original.id
+        assert point.timestamp == original.timestamp
+        assert point.latitude == pytest.approx(original.latitude, abs=1e-7)
+        assert point.longitude == pytest.approx(original.longitude, abs=1e-7)
+        for name in ARCHIVE_FLOAT_COLUMNS:
+            assert getattr(point, name) == pytest.approx(getattr(original, name))
+        assert point.reverse_geocoded == original.reverse_geocoded
+        for name in ARCHIVE_STRING_COLUMNS:
+            assert getattr(point, name) == getattr(original, name)
+
+
+def test_archive_empty():
+    assert decode_points(encode_points([])) == []
+
+
+def test_archive_truncated_blob():
+    data = encode_points(archived_points(100))
+    for length in (0, 4, len(data) // 2, len(data) - 1):
+        with pytest.raises(ValueError):
+            decode_points(data[:length])
+
+
+def test_archive_truncated_payload():
+    payload = zstandard.ZstdDecompressor().decompress(encode_points(archived_points(100)))
+    for length in (0, 5, 20, len(payload) // 2, len(payload) - 1):
+        with pytest.raises(ValueError):
+            decode_points(zstandard.ZstdCompressor().compress(payload[:length]))
+
+
+def test_map_round_trip():
+    rows = map_rows(100)
+    decoded = decode_map_rows(encode_map_rows(rows))
+
+    assert len(decoded) == len(rows)
+    for row, original in zip(decoded, rows):
+        assert row[0] == original[0]
+        assert row[1] == original[1]
+        assert row[2] == original[2]
+        assert row[3] == pytest.approx(original[3], abs=1e-7)
+        assert row[4] == pytest.approx(original[4], abs=1e-7)
+        assert row[5:] == pytest.approx(original[5:])
+
+
+def test_map_empty():
+    assert decode_map_rows(encode_map_rows([])) == []
+
+
+def test_map_truncated():
+    data = encode_map_rows(map_rows(100))
+    for length in (0, 10, 30, len(data) // 2, len(data) - 1):
+        with pytest.raises(ValueError):
+            decode_map_rows(data[:length])